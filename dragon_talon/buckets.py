@@ -0,0 +1,80 @@
+"""Monthly bucketed layout of the daily snapshot collections
+
+One document per natural entity (xiaoqu, house) and month instead of one per day::
+
+    {"house_id": 107102, "month": "2021-01", <static fields, latest values>,
+     "first_date": ..., "last_date": ...,
+     "days": {"17": {<daily fields>}, "18": {<daily fields>}}}
+
+Fields that describe the listing (``bucket_static_fields`` of the item class) are
+stored once per bucket, each day only keeps the fields that move from day to day.
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Mapping, Optional, Tuple
+
+from pymongo import UpdateOne
+
+_CRAWL_TZ = timezone(timedelta(hours=8))
+
+
+def is_bucketed(item_cls) -> bool:
+    return hasattr(item_cls, "bucket_key")
+
+
+def bucket_collection_name(item_cls) -> str:
+    return f"{item_cls.item_name}_monthly"
+
+
+def bucket_key(item_cls) -> Tuple[str, ...]:
+    return item_cls.bucket_key + ("month",)
+
+
+def daily_fields(item_cls) -> Tuple[str, ...]:
+    skipped = set(item_cls.bucket_key) | set(item_cls.bucket_static_fields) | {"date_"}
+    return tuple(name for name in item_cls.__slots__ if name not in skipped)
+
+
+def bucket_day(date_: datetime) -> Tuple[str, str]:
+    """(month, day) of the bucket and its ``days`` entry holding a crawl date"""
+    if date_.tzinfo is not None:
+        date_ = date_.astimezone(_CRAWL_TZ)
+    return date_.strftime("%Y-%m"), str(date_.day)
+
+
+def bucket_update(doc: Mapping, item_cls) -> UpdateOne:
+    month, day = bucket_day(doc["date_"])
+    bucket_filter = {field: doc[field] for field in item_cls.bucket_key}
+    bucket_filter["month"] = month
+    to_set = {field: doc[field] for field in item_cls.bucket_static_fields}
+    # re-crawling a day overwrites that day, like the upsert of the document layout
+    to_set[f"days.{day}"] = {field: doc[field] for field in daily_fields(item_cls)}
+    return UpdateOne(
+        bucket_filter,
+        {"$set": to_set, "$min": {"first_date": doc["date_"]}, "$max": {"last_date": doc["date_"]}},
+        upsert=True,
+    )
+
+
+def iter_daily_documents(bucket: Mapping, item_cls) -> Iterator[dict]:
+    """Expand a bucket back into the per-day documents of the document layout, by date"""
+    year, month = map(int, bucket["month"].split("-"))
+    for day, daily in sorted(bucket["days"].items(), key=lambda kv: int(kv[0])):
+        doc = {field: bucket[field] for field in item_cls.bucket_key + item_cls.bucket_static_fields}
+        doc["date_"] = datetime(year, month, int(day), tzinfo=_CRAWL_TZ)
+        doc.update(daily)
+        yield {name: doc[name] for name in item_cls.__slots__}
+
+
+def price_history(
+    collection, item_cls, entity_id, since: Optional[datetime] = None
+) -> Iterator[dict]:
+    """Per-day documents of one xiaoqu/house, reading one bucket per month"""
+    (key_field,) = item_cls.bucket_key
+    query = {key_field: entity_id}
+    if since is not None:
+        query["last_date"] = {"$gte": since}
+    for bucket in collection.find(query, sort=[("month", 1)]):
+        for doc in iter_daily_documents(bucket, item_cls):
+            if since is None or doc["date_"] >= since:
+                yield doc
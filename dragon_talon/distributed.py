@@ -0,0 +1,418 @@
+"""Several crawl workers sharing one request queue
+
+``DistributedScheduler`` replaces scrapy's scheduler. Requests go to a queue shared by
+every worker of the crawl job, keyed by fingerprint, so the queue doubles as the
+dedup set: the first worker running the start requests seeds the crawl, the others'
+copies are dropped. Before that, ``DUPEFILTER_CLASS`` is consulted as by scrapy's
+scheduler, so the URLs SeenUrlDupeFilter holds fresh (``SEEN_URL_TTLS``) are not
+queued; its index is local to the worker. Workers lease batches of requests; a lease
+is renewed by heartbeats while the request waits, downloads and is parsed, and ends
+once its callback output went through (``signals.page_parsed``) or raised. Requests
+that never reach their callback (failed downloads, filtered error statuses) end when
+the worker runs idle. Requests of a dead worker are leased again when their lease
+expires, up to ``DISTRIBUTED_MAX_ATTEMPTS`` times.
+
+Requests with ``meta["distributed_local"]`` only make sense in the process that made
+them, like the logins of AccountPoolMiddleware: they skip the queue and go to the
+worker's own buffer.
+
+Queue backends: ``MongoRequestQueue`` (a collection of the crawl database) and
+``SqliteRequestQueue``, a stand-in for workers on one host.
+"""
+
+import os
+import pickle
+import socket
+import sqlite3
+import time
+from collections import deque
+from typing import Deque, List, Optional, Set, Tuple
+
+import pymongo
+from bson.binary import Binary
+from loguru import logger
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument
+from scrapy import signals as scrapy_signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.misc import load_object
+from twisted.internet import task
+
+from . import db, signals
+from .frontier import crawl_job, fingerprint, request_from_dict, request_to_dict
+
+PENDING = 0
+LEASED = 1
+DONE = 2
+
+
+class MongoRequestQueue:
+    """Request queue in the ``crawl_queue`` collection, one document per job and key"""
+
+    COLLECTION = "crawl_queue"
+
+    def __init__(self, mongo_cli: pymongo.MongoClient):
+        self._mongo_cli = mongo_cli
+        self._col = mongo_cli.get_database(db.DB_NAME).get_collection(self.COLLECTION)
+        self._col.create_indexes(
+            [
+                IndexModel([("job", ASCENDING), ("state", ASCENDING), ("priority", DESCENDING)]),
+                IndexModel([("job", ASCENDING), ("owner", ASCENDING), ("state", ASCENDING)]),
+            ]
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(db.get_mongo_client())
+
+    def push(self, job: str, key: str, request_blob: bytes, priority: int) -> bool:
+        try:
+            self._col.insert_one(
+                {
+                    "_id": f"{job}/{key}",
+                    "job": job,
+                    "state": PENDING,
+                    "priority": priority,
+                    "request": Binary(request_blob),
+                    "attempts": 0,
+                    "owner": None,
+                    "lease_expires": 0.0,
+                }
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    def lease(
+        self, job: str, owner: str, num: int, lease_secs: float, max_attempts: int
+    ) -> List[Tuple[str, bytes]]:
+        now = time.time()
+        leasable = {
+            "job": job,
+            "attempts": {"$lt": max_attempts},
+            "$or": [{"state": PENDING}, {"state": LEASED, "lease_expires": {"$lt": now}}],
+        }
+        leased = []
+        for _ in range(num):
+            doc = self._col.find_one_and_update(
+                leasable,
+                {
+                    "$set": {"state": LEASED, "owner": owner, "lease_expires": now + lease_secs},
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("priority", DESCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc is None:
+                break
+            leased.append((doc["_id"].split("/", 1)[1], bytes(doc["request"])))
+        return leased
+
+    def renew(self, job: str, owner: str, keys: List[str], lease_secs: float):
+        self._col.update_many(
+            {"_id": {"$in": [f"{job}/{key}" for key in keys]}, "owner": owner, "state": LEASED},
+            {"$set": {"lease_expires": time.time() + lease_secs}},
+        )
+
+    def release(self, job: str, owner: str, keys: List[str]):
+        self._col.update_many(
+            {"_id": {"$in": [f"{job}/{key}" for key in keys]}, "owner": owner, "state": LEASED},
+            {"$set": {"state": PENDING, "owner": None}, "$inc": {"attempts": -1}},
+        )
+
+    def ack(self, job: str, key: str):
+        # the request body is only needed to lease it again, drop it once done
+        self._col.update_one(
+            {"_id": f"{job}/{key}"}, {"$set": {"state": DONE, "request": None, "owner": None}}
+        )
+
+    def unfinished(self, job: str, max_attempts: int) -> int:
+        return self._col.count_documents(
+            {
+                "job": job,
+                "state": {"$ne": DONE},
+                "$or": [
+                    {"attempts": {"$lt": max_attempts}},
+                    {"lease_expires": {"$gte": time.time()}},
+                ],
+            }
+        )
+
+    def close(self):
+        self._mongo_cli.close()
+
+
+class SqliteRequestQueue:
+    """Request queue in a sqlite file, shared by workers on one host"""
+
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # autocommit, leases take an explicit write lock
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS crawl_queue ("
+            " job TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " state INTEGER NOT NULL,"
+            " priority INTEGER NOT NULL,"
+            " request BLOB,"
+            " attempts INTEGER NOT NULL,"
+            " owner TEXT,"
+            " lease_expires REAL NOT NULL,"
+            " PRIMARY KEY (job, key))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS crawl_queue_lease ON crawl_queue (job, state, priority)"
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get("DISTRIBUTED_SQLITE_PATH"))
+
+    def push(self, job: str, key: str, request_blob: bytes, priority: int) -> bool:
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO crawl_queue VALUES (?, ?, ?, ?, ?, 0, NULL, 0)",
+            (job, key, PENDING, priority, request_blob),
+        )
+        return cursor.rowcount == 1
+
+    def lease(
+        self, job: str, owner: str, num: int, lease_secs: float, max_attempts: int
+    ) -> List[Tuple[str, bytes]]:
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            leased = self._conn.execute(
+                "SELECT key, request FROM crawl_queue"
+                " WHERE job = ? AND attempts < ?"
+                " AND (state = ? OR (state = ? AND lease_expires < ?))"
+                " ORDER BY priority DESC LIMIT ?",
+                (job, max_attempts, PENDING, LEASED, now, num),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE crawl_queue SET state = ?, owner = ?, lease_expires = ?,"
+                " attempts = attempts + 1 WHERE job = ? AND key = ?",
+                [(LEASED, owner, now + lease_secs, job, key) for key, _ in leased],
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return leased
+
+    def renew(self, job: str, owner: str, keys: List[str], lease_secs: float):
+        self._conn.executemany(
+            "UPDATE crawl_queue SET lease_expires = ?"
+            " WHERE job = ? AND key = ? AND owner = ? AND state = ?",
+            [(time.time() + lease_secs, job, key, owner, LEASED) for key in keys],
+        )
+
+    def release(self, job: str, owner: str, keys: List[str]):
+        self._conn.executemany(
+            "UPDATE crawl_queue SET state = ?, owner = NULL, attempts = attempts - 1"
+            " WHERE job = ? AND key = ? AND owner = ? AND state = ?",
+            [(PENDING, job, key, owner, LEASED) for key in keys],
+        )
+
+    def ack(self, job: str, key: str):
+        self._conn.execute(
+            "UPDATE crawl_queue SET state = ?, request = NULL, owner = NULL"
+            " WHERE job = ? AND key = ?",
+            (DONE, job, key),
+        )
+
+    def unfinished(self, job: str, max_attempts: int) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM crawl_queue WHERE job = ? AND state != ?"
+            " AND (attempts < ? OR lease_expires >= ?)",
+            (job, DONE, max_attempts, time.time()),
+        ).fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+class DistributedScheduler:
+    """Scheduler pulling requests from a queue shared with the other workers of the job"""
+
+    # retry counters of RetryMiddleware and AdaptiveThrottleMiddleware
+    _RETRY_META = ("retry_times", "throttle_retry_times")
+
+    def __init__(
+        self,
+        crawler,
+        queue,
+        job: str,
+        worker_id: str,
+        lease_secs: float = 300,
+        lease_batch: int = 16,
+        max_attempts: int = 3,
+        poll_secs: float = 5,
+        dupefilter=None,
+    ):
+        self._crawler = crawler
+        self._stats = crawler.stats
+        self._queue = queue
+        self._job = job
+        self._worker_id = worker_id
+        self._lease_secs = lease_secs
+        self._lease_batch = lease_batch
+        self._max_attempts = max_attempts
+        self._poll_secs = poll_secs
+        self._dupefilter = dupefilter
+        self._spider = None
+        self._buffer: Deque[Tuple[Optional[str], object]] = deque()
+        # leased by this worker and not done yet
+        self._leased_keys: Set[str] = set()
+        # out of the downloader, waiting for their callback
+        self._downloaded_keys: Set[str] = set()
+        self._next_poll = 0.0
+        self._heartbeat: Optional[task.LoopingCall] = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        queue_cls = load_object(settings.get("DISTRIBUTED_QUEUE_BACKEND"))
+        worker_id = settings.get("DISTRIBUTED_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+        dupefilter_cls = load_object(settings.get("DUPEFILTER_CLASS"))
+        if hasattr(dupefilter_cls, "from_crawler"):
+            dupefilter = dupefilter_cls.from_crawler(crawler)
+        else:
+            dupefilter = dupefilter_cls.from_settings(settings)
+        return cls(
+            crawler,
+            queue_cls.from_crawler(crawler),
+            crawl_job(crawler),
+            worker_id,
+            lease_secs=settings.getfloat("DISTRIBUTED_LEASE_SECS", 300),
+            lease_batch=settings.getint(
+                "DISTRIBUTED_LEASE_BATCH", settings.getint("CONCURRENT_REQUESTS")
+            ),
+            max_attempts=settings.getint("DISTRIBUTED_MAX_ATTEMPTS", 3),
+            poll_secs=settings.getfloat("DISTRIBUTED_POLL_SECS", 5),
+            dupefilter=dupefilter,
+        )
+
+    def open(self, spider):
+        self._spider = spider
+        signal_manager = self._crawler.signals
+        signal_manager.connect(self._request_left, signal=scrapy_signals.request_left_downloader)
+        signal_manager.connect(self._page_parsed, signal=signals.page_parsed)
+        signal_manager.connect(self._spider_error, signal=scrapy_signals.spider_error)
+        signal_manager.connect(self._spider_idle, signal=scrapy_signals.spider_idle)
+        if self._dupefilter is not None:
+            self._dupefilter.open()
+        self._heartbeat = task.LoopingCall(self._renew_leases)
+        self._heartbeat.start(self._lease_secs / 3, now=False)
+        logger.info(f"distributed job {self._job}: worker {self._worker_id} joined")
+
+    def close(self, reason: str):
+        if self._heartbeat is not None and self._heartbeat.running:
+            self._heartbeat.stop()
+        # hand the requests this worker will not download back to the others
+        buffered = [key for key, _ in self._buffer if key is not None]
+        if buffered:
+            self._queue.release(self._job, self._worker_id, buffered)
+        self._buffer.clear()
+        self._queue.close()
+        if self._dupefilter is not None:
+            self._dupefilter.close(reason)
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def has_pending_requests(self) -> bool:
+        return bool(self._buffer)
+
+    def enqueue_request(self, request) -> bool:
+        if request.meta.get("distributed_local"):
+            self._buffer.appendleft((None, request))
+            return True
+        if (
+            not request.dont_filter
+            and self._dupefilter is not None
+            and self._dupefilter.request_seen(request)
+        ):
+            self._stats.inc_value("distributed/filtered")
+            return False
+        request_dict = request_to_dict(request, spider=self._spider)
+        key = self._key(request)
+        if not self._queue.push(self._job, key, pickle.dumps(request_dict), request.priority):
+            self._stats.inc_value("distributed/duplicates")
+            return False
+        self._stats.inc_value("distributed/enqueued")
+        return True
+
+    def next_request(self):
+        if not self._buffer and time.monotonic() >= self._next_poll:
+            self._lease()
+        if not self._buffer:
+            return None
+        key, request = self._buffer.popleft()
+        return request
+
+    @classmethod
+    def _key(cls, request) -> str:
+        key = fingerprint(request)
+        if request.dont_filter:
+            # a retry of a request done earlier in the job
+            retries = [request.meta.get(meta, 0) for meta in cls._RETRY_META]
+            if any(retries):
+                key = f"{key}-retry-{'-'.join(map(str, retries))}"
+        return key
+
+    def _lease(self):
+        leased = self._queue.lease(
+            self._job, self._worker_id, self._lease_batch, self._lease_secs, self._max_attempts
+        )
+        if not leased:
+            # nothing to do for now, don't query the queue on every engine tick
+            self._next_poll = time.monotonic() + self._poll_secs
+            return
+        self._stats.inc_value("distributed/leased", len(leased))
+        for key, request_blob in leased:
+            request = request_from_dict(pickle.loads(request_blob), spider=self._spider)
+            request.meta["distributed_key"] = key
+            self._buffer.append((key, request))
+            self._leased_keys.add(key)
+
+    def _request_left(self, request, spider):
+        key = request.meta.get("distributed_key")
+        if key is not None and key in self._leased_keys:
+            self._downloaded_keys.add(key)
+
+    def _page_parsed(self, response, spider):
+        self._ack(response.meta.get("distributed_key"))
+
+    def _spider_error(self, failure, response, spider):
+        self._ack(response.meta.get("distributed_key"))
+
+    def _ack(self, key: Optional[str]):
+        if key is None or key not in self._leased_keys:
+            return
+        self._leased_keys.discard(key)
+        self._downloaded_keys.discard(key)
+        self._queue.ack(self._job, key)
+        self._stats.inc_value("distributed/acked")
+
+    def _ack_downloaded(self):
+        # nothing is downloading or parsing on an idle worker: these never reached their
+        # callback, failed downloads and error statuses, the retry middlewares enqueue
+        # their retries
+        for key in list(self._downloaded_keys):
+            self._ack(key)
+
+    def _renew_leases(self):
+        if self._leased_keys:
+            self._queue.renew(self._job, self._worker_id, list(self._leased_keys), self._lease_secs)
+
+    def _spider_idle(self, spider):
+        self._ack_downloaded()
+        # other workers may still add requests from the pages they are downloading
+        unfinished = self._queue.unfinished(self._job, self._max_attempts)
+        if unfinished:
+            self._next_poll = 0.0
+            logger.debug(f"distributed job {self._job}: {unfinished} requests left, waiting")
+            raise DontCloseSpider
@@ -0,0 +1,142 @@
+import os
+import re
+import sqlite3
+import time
+from typing import List, Optional, Sequence, Set, Tuple
+
+from loguru import logger
+from scrapy.dupefilters import BaseDupeFilter
+
+from . import signals
+from .frontier import fingerprint
+from .middelwares import blocked_reason
+
+
+def compact_fingerprint(request) -> int:
+    # first 64 bits of the sha1 fingerprint as a signed sqlite INTEGER
+    return int(fingerprint(request)[:16], 16) - (1 << 63)
+
+
+class SeenUrlIndex:
+    """Persistent index of fetched URLs, one 64-bit fingerprint and expiry per URL
+
+    Stored as the INTEGER PRIMARY KEY b-tree of a sqlite table, so millions of
+    URLs take tens of MB and a lookup is a single index probe.
+    """
+
+    _COMMIT_EVERY = 1000
+
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen (fp INTEGER PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        self._uncommitted = 0
+
+    def is_fresh(self, fp: int, now: float) -> bool:
+        row = self._conn.execute("SELECT expires_at FROM seen WHERE fp = ?", (fp,)).fetchone()
+        return row is not None and row[0] > now
+
+    def add(self, fp: int, expires_at: float):
+        self._conn.execute("INSERT OR REPLACE INTO seen VALUES (?, ?)", (fp, expires_at))
+        self._uncommitted += 1
+        if self._uncommitted >= self._COMMIT_EVERY:
+            self.commit()
+
+    def evict_expired(self, now: float) -> int:
+        evicted = self._conn.execute("DELETE FROM seen WHERE expires_at <= ?", (now,)).rowcount
+        self.commit()
+        return evicted
+
+    def commit(self):
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+
+class SeenUrlDupeFilter(BaseDupeFilter):
+    """Scheduler dupefilter consulting a SeenUrlIndex
+
+    A URL is recorded once its callback went through without error (see
+    PageParsedMiddleware), with the TTL of the first ``SEEN_URL_TTLS`` pattern
+    matching it, and is filtered until that TTL expires. Pages the throttle took for
+    an anti-bot answer are not recorded. Requests scheduled in this run but not
+    parsed yet are filtered in memory. Without ``SEEN_URL_INDEX_PATH`` it only dedups
+    within the run.
+    """
+
+    def __init__(
+        self,
+        index: Optional[SeenUrlIndex],
+        ttl_patterns: List[Tuple[str, float]],
+        default_ttl: float,
+        stats=None,
+        block_markers: Sequence[str] = ("captcha", "login", "verify"),
+    ):
+        self._index = index
+        self._ttl_patterns = [(re.compile(pattern), ttl) for pattern, ttl in ttl_patterns]
+        self._default_ttl = default_ttl
+        self._stats = stats
+        self._block_markers = list(block_markers)
+        self._scheduled: Set[int] = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get("SEEN_URL_INDEX_PATH")
+        dupefilter = cls(
+            SeenUrlIndex(path) if path else None,
+            settings.getlist("SEEN_URL_TTLS"),
+            settings.getfloat("SEEN_URL_DEFAULT_TTL", 12 * 3600),
+            crawler.stats,
+            settings.getlist(
+                "ADAPTIVE_THROTTLE_BLOCK_URL_MARKERS", ["captcha", "login", "verify"]
+            ),
+        )
+        crawler.signals.connect(dupefilter._page_parsed, signal=signals.page_parsed)
+        return dupefilter
+
+    def open(self):
+        if self._index is not None:
+            evicted = self._index.evict_expired(time.time())
+            logger.info(f"seen url index: {evicted} expired urls evicted")
+
+    def close(self, reason):
+        if self._index is not None:
+            self._index.close()
+
+    def request_seen(self, request) -> bool:
+        fp = compact_fingerprint(request)
+        if fp in self._scheduled:
+            return True
+        if self._index is not None and self._index.is_fresh(fp, time.time()):
+            if self._stats is not None:
+                self._stats.inc_value("seen_url_index/filtered")
+            return True
+        self._scheduled.add(fp)
+        return False
+
+    def _ttl(self, url: str) -> float:
+        for pattern, ttl in self._ttl_patterns:
+            if pattern.search(url):
+                return ttl
+        return self._default_ttl
+
+    def _page_parsed(self, response, spider):
+        request = response.request
+        if self._index is None or response.status != 200:
+            return
+        if blocked_reason(request, response, self._block_markers):
+            # the throttle gave up on it, fetch it again next time
+            return
+        fp = compact_fingerprint(request)
+        self._index.add(fp, time.time() + self._ttl(request.url))
+        # the index filters it from now on
+        self._scheduled.discard(fp)
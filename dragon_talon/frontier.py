@@ -0,0 +1,301 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator, List, Optional
+
+import scrapy
+from loguru import logger
+from scrapy import signals as scrapy_signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer, task
+from w3lib.url import canonicalize_url
+
+from . import signals
+
+try:
+    from scrapy.utils.request import request_from_dict
+except ImportError:  # scrapy < 2.6
+    from scrapy.utils.reqser import request_from_dict, request_to_dict
+else:
+
+    def request_to_dict(request: scrapy.Request, spider: scrapy.Spider) -> dict:
+        return request.to_dict(spider=spider)
+
+
+def fingerprint(request: scrapy.Request) -> str:
+    return hashlib.sha1(f"{request.method} {canonicalize_url(request.url)}".encode()).hexdigest()
+
+
+def crawl_job(crawler) -> str:
+    # one job per spider and day unless given, so that the workers of a distributed
+    # crawl agree on it without talking to each other
+    job = crawler.settings.get("FRONTIER_JOB")
+    if not job:
+        today = datetime.now(timezone(timedelta(hours=8))).strftime("%Y%m%d")
+        job = f"{crawler.spidercls.name}-{today}"
+    return job
+
+
+class SqliteFrontier:
+    """Durable record of the requests of one crawl job
+
+    A request is PENDING once yielded, PARSED once its callback has returned and DONE
+    once the items of that callback are persisted. It is FAILED when its callback (or
+    HttpErrorMiddleware) raised, or when a finished crawl left it PENDING: download
+    errors, ignored requests and requests dropped by the dupefilter never reach the
+    spider middlewares, and failed requests are not resumed. Writes are committed together in
+    ``checkpoint`` so a crash never leaves a DONE parent without its PENDING children.
+
+    Without a job name the newest job of the spider with unfinished requests is
+    resumed, so a crawl restarted after midnight still picks up where it stopped;
+    a new job is started when there is none.
+    """
+
+    PENDING = 0
+    PARSED = 1
+    DONE = 2
+    FAILED = 3
+
+    def __init__(self, path: str, job: Optional[str], spider_name: str):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS frontier ("
+            " job TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL,"
+            " state INTEGER NOT NULL,"
+            " request BLOB,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (job, fingerprint))"
+        )
+        self._conn.commit()
+        if not job:
+            job = self._unfinished_job(spider_name)
+        if not job:
+            started = datetime.now(timezone(timedelta(hours=8))).strftime("%Y%m%d-%H%M%S")
+            job = f"{spider_name}-{started}"
+        self._job = job
+
+    @property
+    def job(self) -> str:
+        return self._job
+
+    def _unfinished_job(self, spider_name: str) -> Optional[str]:
+        prefix = f"{spider_name}-"
+        row = self._conn.execute(
+            "SELECT job FROM frontier WHERE substr(job, 1, ?) = ? AND state IN (?, ?)"
+            " GROUP BY job ORDER BY MAX(updated_at) DESC LIMIT 1",
+            (len(prefix), prefix, self.PENDING, self.PARSED),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def is_done(self, fp: str) -> bool:
+        row = self._conn.execute(
+            "SELECT state FROM frontier WHERE job = ? AND fingerprint = ?", (self._job, fp)
+        ).fetchone()
+        return row is not None and row[0] == self.DONE
+
+    def add_pending(self, fp: str, request_dict: dict):
+        self._conn.execute(
+            "INSERT OR IGNORE INTO frontier VALUES (?, ?, ?, ?, ?)",
+            (self._job, fp, self.PENDING, pickle.dumps(request_dict), time.time()),
+        )
+
+    def mark_parsed(self, fp: str):
+        self._conn.execute(
+            "UPDATE frontier SET state = ?, updated_at = ? WHERE job = ? AND fingerprint = ?",
+            (self.PARSED, time.time(), self._job, fp),
+        )
+
+    def mark_failed(self, fp: str):
+        self._conn.execute(
+            "UPDATE frontier SET state = ?, request = NULL, updated_at = ?"
+            " WHERE job = ? AND fingerprint = ?",
+            (self.FAILED, time.time(), self._job, fp),
+        )
+
+    def fail_pending(self) -> int:
+        cursor = self._conn.execute(
+            "UPDATE frontier SET state = ?, request = NULL, updated_at = ?"
+            " WHERE job = ? AND state = ?",
+            (self.FAILED, time.time(), self._job, self.PENDING),
+        )
+        self._conn.commit()
+        return cursor.rowcount
+
+    def checkpoint(self, done_fps: Iterable[str]):
+        # the request body is only needed to resume, drop it once done
+        self._conn.executemany(
+            "UPDATE frontier SET state = ?, request = NULL, updated_at = ?"
+            " WHERE job = ? AND fingerprint = ?",
+            [(self.DONE, time.time(), self._job, fp) for fp in done_fps],
+        )
+        self._conn.commit()
+
+    def unfinished_requests(self) -> Iterator[dict]:
+        cursor = self._conn.execute(
+            "SELECT request FROM frontier WHERE job = ? AND state IN (?, ?)",
+            (self._job, self.PENDING, self.PARSED),
+        )
+        for (request_blob,) in cursor:
+            yield pickle.loads(request_blob)
+
+    def count(self, state: int) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM frontier WHERE job = ? AND state = ?", (self._job, state)
+        ).fetchone()[0]
+
+    def clear(self):
+        self._conn.execute("DELETE FROM frontier WHERE job = ?", (self._job,))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class FrontierMiddleware:
+    """Spider middleware that makes a crawl resumable through a SqliteFrontier
+
+    Every request a callback yields is recorded, requests already done in this job
+    are dropped, and a restarted crawl re-issues the unfinished requests instead of
+    the start requests. A finished crawl clears its job, so the next one starts over
+    from the start requests whatever failed. Parsed requests only become done after the
+    ``signals.checkpoint`` handlers (the Mongo pipeline flush) have fired.
+    """
+
+    def __init__(self, crawler, path: str, job: Optional[str], checkpoint_secs: float):
+        self._crawler = crawler
+        self._frontier = SqliteFrontier(path, job, crawler.spidercls.name)
+        self._job = self._frontier.job
+        self._checkpoint_secs = checkpoint_secs
+        self._parsed_fps: List[str] = []
+        self._checkpoint_loop: Optional[task.LoopingCall] = None
+        crawler.signals.connect(self._spider_opened, signal=scrapy_signals.spider_opened)
+        crawler.signals.connect(self._spider_closed, signal=scrapy_signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get("FRONTIER_PATH")
+        if not path:
+            raise NotConfigured
+        return cls(
+            crawler,
+            path,
+            settings.get("FRONTIER_JOB"),
+            settings.getfloat("FRONTIER_CHECKPOINT_SECS", 60),
+        )
+
+    def _spider_opened(self, spider):
+        logger.info(f"frontier job {self._job}")
+        self._checkpoint_loop = task.LoopingCall(self._checkpoint)
+        self._checkpoint_loop.start(self._checkpoint_secs, now=False)
+
+    def _spider_closed(self, spider, reason):
+        if self._checkpoint_loop is not None and self._checkpoint_loop.running:
+            self._checkpoint_loop.stop()
+        # pipelines are closed, hence flushed, before spider_closed is sent
+        self._frontier.checkpoint(self._parsed_fps)
+        self._parsed_fps = []
+        if reason == "finished":
+            # nothing is scheduled or downloading anymore, what is still pending is lost
+            lost = self._frontier.fail_pending()
+            if lost:
+                logger.warning(f"frontier job {self._job}: {lost} requests never got parsed")
+                self._crawler.stats.inc_value("frontier/failed", lost)
+            self._frontier.clear()
+        else:
+            unfinished = self._frontier.count(SqliteFrontier.PENDING) + self._frontier.count(
+                SqliteFrontier.PARSED
+            )
+            logger.info(f"frontier job {self._job}: {unfinished} requests left to resume")
+        self._frontier.close()
+
+    @defer.inlineCallbacks
+    def _checkpoint(self):
+        parsed_fps, self._parsed_fps = self._parsed_fps, []
+        send_catch_log_async = getattr(self._crawler.signals, "send_catch_log_async", None)
+        if send_catch_log_async is not None:  # scrapy >= 2.14
+            yield defer.ensureDeferred(send_catch_log_async(signal=signals.checkpoint))
+        else:
+            yield self._crawler.signals.send_catch_log_deferred(signal=signals.checkpoint)
+        self._frontier.checkpoint(parsed_fps)
+        self._crawler.stats.inc_value("frontier/checkpoints")
+
+    async def process_start(self, start):  # scrapy >= 2.13
+        resumed = self._resumed_requests(self._crawler.spider)
+        if resumed:
+            for request in resumed:
+                yield request
+            return
+        async for output in start:
+            if isinstance(output, scrapy.Request):
+                for request in self._record_requests([output], self._crawler.spider):
+                    yield request
+            else:
+                yield output
+
+    def process_start_requests(self, start_requests, spider):
+        resumed = self._resumed_requests(spider)
+        if resumed:
+            yield from resumed
+            return
+        yield from self._record_requests(start_requests, spider)
+
+    def _resumed_requests(self, spider) -> List[scrapy.Request]:
+        resumed = []
+        for request_dict in self._frontier.unfinished_requests():
+            request = request_from_dict(request_dict, spider=spider)
+            # parsed requests are already in the seen url index, their items may not be saved
+            request.dont_filter = True
+            resumed.append(request)
+        if resumed:
+            logger.info(f"frontier job {self._job}: resumed {len(resumed)} requests")
+            self._crawler.stats.set_value("frontier/resumed", len(resumed))
+        return resumed
+
+    def process_spider_output(self, response, result, spider):
+        for output in result:
+            if isinstance(output, scrapy.Request):
+                yield from self._record_requests([output], spider)
+            else:
+                yield output
+        self._mark_parsed(response)
+
+    async def process_spider_output_async(self, response, result, spider):  # scrapy >= 2.7
+        async for output in result:
+            if isinstance(output, scrapy.Request):
+                for request in self._record_requests([output], spider):
+                    yield request
+            else:
+                yield output
+        self._mark_parsed(response)
+
+    def process_spider_exception(self, response, exception, spider):
+        fp = response.request.meta.get("frontier_fingerprint")
+        if fp is not None:
+            self._frontier.mark_failed(fp)
+            self._crawler.stats.inc_value("frontier/failed")
+
+    def _mark_parsed(self, response):
+        fp = response.request.meta.get("frontier_fingerprint")
+        if fp is not None:
+            self._frontier.mark_parsed(fp)
+            self._parsed_fps.append(fp)
+
+    def _record_requests(self, requests: Iterable[scrapy.Request], spider):
+        for request in requests:
+            fp = fingerprint(request)
+            if self._frontier.is_done(fp):
+                self._crawler.stats.inc_value("frontier/skipped_done")
+                continue
+            # the fingerprint travels in meta so redirected responses still match it
+            request.meta["frontier_fingerprint"] = fp
+            self._frontier.add_pending(fp, request_to_dict(request, spider=spider))
+            yield request
@@ -0,0 +1,268 @@
+"""Nearest-xiaoqu queries over the xiaoqu_info coordinates
+
+The xiaoqu page gives its coordinates as ``[longitude, latitude]``, stored as they come
+in ``north_latitude`` / ``east_latitude``. MongoPipeline adds a normalized GeoJSON
+point to every xiaoqu_info document, under a 2dsphere index::
+
+    {"xiaoqu_id": "5011000010000", ..., "location": {"type": "Point",
+     "coordinates": [121.562411, 31.226381]}}
+
+``nearest`` and ``within_radius`` run one ``$geoNear`` query a point and join the
+results with the latest ask price of xiaoqu_daily_stats. For batches of points (every
+metro station of a city, thousands of POIs) ``XiaoquSnapshot`` loads the locations and
+prices once into an in-process KD-tree and answers each point without a round trip.
+"""
+
+import heapq
+import math
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from . import buckets, items
+
+EARTH_RADIUS_M = 6371008.8
+LOCATION_FIELD = "location"
+
+_PROJECTION = {"_id": 0, "xiaoqu_id": 1, "name": 1, "district": 1, "area": 1, LOCATION_FIELD: 1}
+# points of a KD-tree leaf, scanned linearly
+_LEAF_SIZE = 16
+
+
+class LatestPrice(NamedTuple):
+    date_: datetime
+    ask_avg_price: int
+
+
+class NearbyXiaoqu(NamedTuple):
+    xiaoqu_id: str
+    name: str
+    district: Optional[str]
+    area: Optional[str]
+    longitude: float
+    latitude: float
+    distance_m: float
+    # latest xiaoqu_daily_stats, None when the xiaoqu was never listed
+    price: Optional[LatestPrice]
+
+
+def location(first: Optional[float], second: Optional[float]) -> Optional[dict]:
+    """GeoJSON point of the page coordinates, None when they are missing or out of range
+
+    The page sends longitude first, a pair whose second value can only be a longitude
+    is taken as swapped.
+    """
+    if first is None or second is None:
+        return None
+    longitude, latitude = float(first), float(second)
+    if abs(latitude) > 90 >= abs(longitude):
+        longitude, latitude = latitude, longitude
+    if abs(longitude) > 180 or abs(latitude) > 90 or (longitude == 0 and latitude == 0):
+        return None
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+
+def latest_prices(
+    database, xiaoqu_ids: Optional[Iterable[str]] = None, bucketed: bool = False
+) -> Dict[str, LatestPrice]:
+    """Latest ask price per xiaoqu, of every xiaoqu when xiaoqu_ids is None"""
+    match = {} if xiaoqu_ids is None else {"xiaoqu_id": {"$in": list(xiaoqu_ids)}}
+    stats_cls = items.XiaoquDailyStats
+    if bucketed:
+        collection = database.get_collection(buckets.bucket_collection_name(stats_cls))
+        prices = {}
+        # the latest month first, then its latest day
+        for bucket in collection.find(match, sort=[("xiaoqu_id", 1), ("month", -1)]):
+            if bucket["xiaoqu_id"] in prices:
+                continue
+            *_, doc = buckets.iter_daily_documents(bucket, stats_cls)
+            prices[bucket["xiaoqu_id"]] = LatestPrice(doc["date_"], doc["ask_avg_price"])
+        return prices
+    cursor = database.get_collection(stats_cls.item_name).aggregate(
+        [
+            {"$match": match},
+            {"$sort": {"xiaoqu_id": 1, "date_": -1}},
+            {
+                "$group": {
+                    "_id": "$xiaoqu_id",
+                    "date_": {"$first": "$date_"},
+                    "ask_avg_price": {"$first": "$ask_avg_price"},
+                }
+            },
+        ]
+    )
+    return {doc["_id"]: LatestPrice(doc["date_"], doc["ask_avg_price"]) for doc in cursor}
+
+
+def _geo_near(
+    database,
+    longitude: float,
+    latitude: float,
+    max_distance_m: Optional[float],
+    limit: Optional[int],
+    bucketed: bool,
+) -> List[NearbyXiaoqu]:
+    geo_near = {
+        "near": {"type": "Point", "coordinates": [longitude, latitude]},
+        "key": LOCATION_FIELD,
+        "distanceField": "distance_m",
+        "spherical": True,
+    }
+    if max_distance_m is not None:
+        geo_near["maxDistance"] = max_distance_m
+    pipeline: List[dict] = [{"$geoNear": geo_near}]
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": dict(_PROJECTION, distance_m=1)})
+    docs = list(database.get_collection(items.XiaoquInfo.item_name).aggregate(pipeline))
+    prices = latest_prices(database, [doc["xiaoqu_id"] for doc in docs], bucketed)
+    return [_nearby(doc, doc["distance_m"], prices.get(doc["xiaoqu_id"])) for doc in docs]
+
+
+def nearest(
+    database, longitude: float, latitude: float, k: int = 10, bucketed: bool = False
+) -> List[NearbyXiaoqu]:
+    """The k xiaoqu nearest to the point, nearest first"""
+    return _geo_near(database, longitude, latitude, None, k, bucketed)
+
+
+def within_radius(
+    database, longitude: float, latitude: float, radius_m: float, bucketed: bool = False
+) -> List[NearbyXiaoqu]:
+    """The xiaoqu within radius_m meters of the point, nearest first"""
+    return _geo_near(database, longitude, latitude, radius_m, None, bucketed)
+
+
+def _nearby(doc: dict, distance_m: float, price: Optional[LatestPrice]) -> NearbyXiaoqu:
+    longitude, latitude = doc[LOCATION_FIELD]["coordinates"]
+    return NearbyXiaoqu(
+        xiaoqu_id=doc["xiaoqu_id"],
+        name=doc["name"],
+        district=doc.get("district"),
+        area=doc.get("area"),
+        longitude=longitude,
+        latitude=latitude,
+        distance_m=distance_m,
+        price=price,
+    )
+
+
+def _unit_vector(longitude: float, latitude: float) -> Tuple[float, float, float]:
+    lon, lat = math.radians(longitude), math.radians(latitude)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def _chord(distance_m: float) -> float:
+    # straight-line distance through the unit sphere, monotonic in the great-circle one
+    return 2 * math.sin(min(distance_m / EARTH_RADIUS_M, math.pi) / 2)
+
+
+def _arc_m(chord: float) -> float:
+    return 2 * EARTH_RADIUS_M * math.asin(min(chord / 2, 1.0))
+
+
+class XiaoquSnapshot:
+    """In-process KD-tree of the xiaoqu locations and their latest prices
+
+    Built over the unit vectors of the locations, so the chord distance stands in for
+    the great-circle distance and no bounding box breaks at the poles or the date line.
+    A snapshot reflects the collections as they were loaded, build a new one after a
+    crawl.
+    """
+
+    def __init__(self, docs: Iterable[dict], prices: Optional[Dict[str, LatestPrice]] = None):
+        prices = prices or {}
+        self._entries: List[Tuple[dict, Optional[LatestPrice]]] = []
+        points = []
+        for doc in docs:
+            point = doc.get(LOCATION_FIELD)
+            if not point:
+                continue
+            points.append(_unit_vector(*point["coordinates"]) + (len(self._entries),))
+            self._entries.append((doc, prices.get(doc["xiaoqu_id"])))
+        self._root = self._build(points, 0)
+
+    @classmethod
+    def load(cls, database, bucketed: bool = False) -> "XiaoquSnapshot":
+        collection = database.get_collection(items.XiaoquInfo.item_name)
+        docs = collection.find({LOCATION_FIELD: {"$exists": True}}, projection=_PROJECTION)
+        return cls(docs, latest_prices(database, bucketed=bucketed))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @classmethod
+    def _build(cls, points: list, depth: int):
+        # a leaf is a list of points, a node a (axis, split, left, right) tuple
+        if len(points) <= _LEAF_SIZE:
+            return points
+        axis = depth % 3
+        points.sort(key=lambda point: point[axis])
+        middle = len(points) // 2
+        return (
+            axis,
+            points[middle][axis],
+            cls._build(points[:middle], depth + 1),
+            cls._build(points[middle:], depth + 1),
+        )
+
+    def _result(self, index: int, chord_sq: float) -> NearbyXiaoqu:
+        doc, price = self._entries[index]
+        return _nearby(doc, _arc_m(math.sqrt(chord_sq)), price)
+
+    def within_radius(
+        self, longitude: float, latitude: float, radius_m: float
+    ) -> List[NearbyXiaoqu]:
+        """The xiaoqu within radius_m meters of the point, nearest first"""
+        x, y, z = query = _unit_vector(longitude, latitude)
+        limit_sq = _chord(radius_m) ** 2
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                for px, py, pz, index in node:
+                    chord_sq = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+                    if chord_sq <= limit_sq:
+                        found.append((chord_sq, index))
+                continue
+            axis, split, left, right = node
+            diff = query[axis] - split
+            if diff < 0 or diff * diff <= limit_sq:
+                stack.append(left)
+            if diff >= 0 or diff * diff <= limit_sq:
+                stack.append(right)
+        found.sort()
+        return [self._result(index, chord_sq) for chord_sq, index in found]
+
+    def nearest(self, longitude: float, latitude: float, k: int = 10) -> List[NearbyXiaoqu]:
+        """The k xiaoqu nearest to the point, nearest first"""
+        if k <= 0:
+            return []
+        query = _unit_vector(longitude, latitude)
+        # max-heap of the k best so far, as (-chord_sq, index)
+        best: List[Tuple[float, int]] = []
+        self._nearest(self._root, query, k, best)
+        return [self._result(index, -neg_sq) for neg_sq, index in sorted(best, reverse=True)]
+
+    def _nearest(self, node, query: Sequence[float], k: int, best: list):
+        x, y, z = query
+        if isinstance(node, list):
+            for px, py, pz, index in node:
+                chord_sq = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+                if len(best) < k:
+                    heapq.heappush(best, (-chord_sq, index))
+                elif chord_sq < -best[0][0]:
+                    heapq.heapreplace(best, (-chord_sq, index))
+            return
+        axis, split, left, right = node
+        diff = query[axis] - split
+        near, far = (left, right) if diff < 0 else (right, left)
+        self._nearest(near, query, k, best)
+        if len(best) < k or diff * diff < -best[0][0]:
+            self._nearest(far, query, k, best)
+
+    def within_radius_batch(
+        self, points: Iterable[Tuple[float, float]], radius_m: float
+    ) -> List[List[NearbyXiaoqu]]:
+        """within_radius of every (longitude, latitude) point, in order"""
+        return [self.within_radius(longitude, latitude, radius_m) for longitude, latitude in points]
@@ -0,0 +1,232 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional, Tuple, Union
+
+from loguru import logger
+from scrapy.extensions.httpcache import DummyPolicy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+from w3lib.url import canonicalize_url
+
+from .middelwares import blocked_reason
+
+try:
+    import zstandard
+except ImportError:  # optional, pip install dragon_talon[httpcache]
+    zstandard = None
+
+_CODEC_ZLIB = 0
+_CODEC_ZSTD = 1
+
+# request.meta["cache_policy"] values understood by PageTypeCachePolicy
+CACHE_REFRESH = "refresh"  # never served from the cache, the download replaces the entry
+CACHE_PREFER = "prefer"  # served from the cache whatever its age, within the retention
+# a TTL valid until the end of the crawl day (UTC+8), for pages with daily data
+TTL_DAILY = "daily"
+
+_CRAWL_TZ = timezone(timedelta(hours=8))
+
+
+def cache_key(request) -> bytes:
+    """sha1 of method, canonical url and body, like scrapy's default request fingerprint"""
+    key = hashlib.sha1()
+    key.update(request.method.encode())
+    key.update(canonicalize_url(request.url).encode())
+    key.update(request.body or b"")
+    return key.digest()
+
+
+class _Codec:
+    def __init__(self, zstd_level: int):
+        if zstandard is not None:
+            self.codec = _CODEC_ZSTD
+            self._compressor = zstandard.ZstdCompressor(level=zstd_level)
+            self._decompressor = zstandard.ZstdDecompressor()
+        else:
+            logger.warning("zstandard is not installed, http cache falls back to zlib")
+            self.codec = _CODEC_ZLIB
+
+    def compress(self, data: bytes) -> bytes:
+        if self.codec == _CODEC_ZSTD:
+            return self._compressor.compress(data)
+        return zlib.compress(data)
+
+    def decompress(self, data: bytes, codec: int) -> bytes:
+        if codec == _CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("zstd compressed http cache entry, zstandard is not installed")
+            return self._decompressor.decompress(data)
+        return zlib.decompress(data)
+
+
+class SqliteCacheStorage:
+    """HTTPCACHE_STORAGE keeping every response of a spider in one sqlite file
+
+    ``{HTTPCACHE_DIR}/{spider name}.sqlite`` holds one row per request fingerprint with
+    the headers and body compressed by zstd (zlib without zstandard installed).
+    Entries older than ``HTTPCACHE_EXPIRATION_SECS`` are deleted in bulk through the
+    stored_at index when the spider opens, instead of file by file.
+    """
+
+    _COMMIT_EVERY = 200
+
+    def __init__(self, settings):
+        self._cache_dir = data_path(settings["HTTPCACHE_DIR"], createdir=True)
+        self._expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self._codec = _Codec(settings.getint("HTTPCACHE_ZSTD_LEVEL", 3))
+        self._conn: Optional[sqlite3.Connection] = None
+        self._uncommitted = 0
+
+    def open_spider(self, spider):
+        path = os.path.join(self._cache_dir, f"{spider.name}.sqlite")
+        self._conn = _connect(path)
+        if self._expiration_secs > 0:
+            started = time.monotonic()
+            expired = self._conn.execute(
+                "DELETE FROM responses WHERE stored_at < ?", (time.time() - self._expiration_secs,)
+            ).rowcount
+            self._conn.commit()
+            logger.info(
+                f"http cache {path}: {expired} expired responses evicted "
+                f"in {time.monotonic() - started:.2f}s"
+            )
+
+    def close_spider(self, spider):
+        self._conn.commit()
+        self._conn.close()
+
+    def retrieve_response(self, spider, request):
+        row = self._conn.execute(
+            "SELECT url, status, headers, body, codec, stored_at FROM responses WHERE key = ?",
+            (cache_key(request),),
+        ).fetchone()
+        if row is None:
+            return None
+        url, status, headers, body, codec, stored_at = row
+        if 0 < self._expiration_secs < time.time() - stored_at:
+            return None
+        headers = Headers(headers_raw_to_dict(self._codec.decompress(headers, codec)))
+        body = self._codec.decompress(body, codec)
+        request.meta["cache_timestamp"] = stored_at
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                cache_key(request),
+                response.url,
+                response.status,
+                self._codec.compress(headers_dict_to_raw(response.headers)),
+                self._codec.compress(response.body),
+                self._codec.codec,
+                time.time(),
+            ),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self._COMMIT_EVERY:
+            self._conn.commit()
+            self._uncommitted = 0
+
+
+class PageTypeCachePolicy(DummyPolicy):
+    """HTTPCACHE_POLICY giving each page type its own time to live
+
+    The TTL of a request comes from ``request.meta["cache_ttl"]``, else the first
+    ``HTTPCACHE_URL_TTLS`` regex found in its url, else ``HTTPCACHE_CALLBACK_TTLS`` by
+    callback name, else ``HTTPCACHE_DEFAULT_TTL_SECS``. A TTL is in seconds or
+    TTL_DAILY. ``request.meta["cache_policy"]`` set to CACHE_REFRESH or CACHE_PREFER
+    overrides the TTL. The age comes from ``meta["cache_timestamp"]`` set by
+    SqliteCacheStorage; storages without it serve their entries as fresh, so
+    HTTPCACHE_EXPIRATION_SECS is the retention of the longest TTL.
+
+    A stale entry is served instead of a download failing with a 5xx, unless the
+    request must be refreshed. Redirects and what AdaptiveThrottleMiddleware takes
+    for a block (``ADAPTIVE_THROTTLE_BLOCK_URL_MARKERS``) are never stored, else the
+    captcha page would be served for the TTL of the page it stands for.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self._default_ttl = settings.getint("HTTPCACHE_DEFAULT_TTL_SECS", 30 * 60)
+        self._callback_ttls = settings.getdict("HTTPCACHE_CALLBACK_TTLS")
+        self._url_ttls = [
+            (re.compile(pattern), ttl)
+            for pattern, ttl in settings.getdict("HTTPCACHE_URL_TTLS").items()
+        ]
+        self._block_markers = settings.getlist(
+            "ADAPTIVE_THROTTLE_BLOCK_URL_MARKERS", ["captcha", "login", "verify"]
+        )
+
+    def should_cache_response(self, response, request) -> bool:
+        if 300 <= response.status < 400:
+            return False
+        if blocked_reason(request, response, self._block_markers):
+            return False
+        return super().should_cache_response(response, request)
+
+    def ttl(self, request) -> Union[int, str]:
+        if "cache_ttl" in request.meta:
+            return request.meta["cache_ttl"]
+        for pattern, ttl in self._url_ttls:
+            if pattern.search(request.url):
+                return ttl
+        callback_name = getattr(request.callback, "__name__", "parse")
+        return self._callback_ttls.get(callback_name, self._default_ttl)
+
+    def is_cached_response_fresh(self, cachedresponse, request) -> bool:
+        cache_policy = request.meta.get("cache_policy")
+        if cache_policy == CACHE_REFRESH:
+            return False
+        stored_at = request.meta.get("cache_timestamp")
+        if cache_policy == CACHE_PREFER or stored_at is None:
+            return True
+        ttl = self.ttl(request)
+        if ttl == TTL_DAILY:
+            today = datetime.now(_CRAWL_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+            return stored_at >= today.timestamp()
+        return time.time() - stored_at < int(ttl)
+
+    def is_cached_response_valid(self, cachedresponse, response, request) -> bool:
+        # the stale entry beats a server error, while the retries of a fresh
+        # download still happen for pages that must be refreshed
+        return response.status >= 500 and request.meta.get("cache_policy") != CACHE_REFRESH
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        " key BLOB PRIMARY KEY,"
+        " url TEXT NOT NULL,"
+        " status INTEGER NOT NULL,"
+        " headers BLOB NOT NULL,"
+        " body BLOB NOT NULL,"
+        " codec INTEGER NOT NULL,"
+        " stored_at REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS responses_stored_at ON responses (stored_at)")
+    return conn
+
+
+def iter_cached_responses(path: str) -> Iterator[Tuple[str, int, Headers, bytes]]:
+    """(url, status, headers, body) of every response in a SqliteCacheStorage file"""
+    codec = _Codec(zstd_level=3)
+    conn = _connect(path)
+    try:
+        for url, status, headers, body, row_codec in conn.execute(
+            "SELECT url, status, headers, body, codec FROM responses"
+        ):
+            headers = Headers(headers_raw_to_dict(codec.decompress(headers, row_codec)))
+            yield url, status, headers, codec.decompress(body, row_codec)
+    finally:
+        conn.close()
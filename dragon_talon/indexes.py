@@ -0,0 +1,94 @@
+"""Mongo indexes derived from the item declarations
+
+Every item class gets a unique index on its ``natural_key``, which the upserts filter
+on and the insert mode relies on to drop duplicates, so it is created before the
+first write; on a collection whose existing documents repeat a natural key the build
+fails, that collection goes without it and MongoPipeline upserts into it. The
+``indexes`` it declares are secondary indexes for the read side,
+built in the background, along with 2dsphere indexes on its ``geo_indexes``. In the
+monthly bucket layout (see dragon_talon.buckets) the same declarations apply to the
+bucket collections, with ``date_`` mapped to ``month``.
+"""
+
+from typing import Iterable, List, Sequence, Tuple
+
+import pymongo
+from loguru import logger
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+
+from . import buckets
+
+
+_DUPLICATE_KEY = 11000
+
+
+def _keys(fields: Sequence[str]) -> List[Tuple[str, int]]:
+    return [(field, ASCENDING) for field in fields]
+
+
+def _bucket_fields(fields: Sequence[str]) -> Tuple[str, ...]:
+    return tuple("month" if field == "date_" else field for field in fields)
+
+
+def unique_index(item_cls, bucketed: bool = False) -> IndexModel:
+    fields = buckets.bucket_key(item_cls) if bucketed else item_cls.natural_key
+    return IndexModel(_keys(fields), unique=True)
+
+
+def secondary_indexes(item_cls, bucketed: bool = False) -> List[IndexModel]:
+    if not bucketed:
+        return [IndexModel(_keys(fields), background=True) for fields in item_cls.indexes] + [
+            IndexModel([(field, GEOSPHERE)], background=True) for field in item_cls.geo_indexes
+        ]
+    # a bucket only holds the key, the static fields and the month outside of its days
+    stored = set(buckets.bucket_key(item_cls)) | set(item_cls.bucket_static_fields)
+    unique_fields = buckets.bucket_key(item_cls)
+    models = []
+    for fields in item_cls.indexes:
+        fields = _bucket_fields(fields)
+        if set(fields) <= stored and fields != unique_fields[: len(fields)]:
+            models.append(IndexModel(_keys(fields), background=True))
+    return models
+
+
+def collection_name(item_cls, bucketed: bool = False) -> str:
+    return buckets.bucket_collection_name(item_cls) if bucketed else item_cls.item_name
+
+
+def create_unique_indexes(
+    database, item_classes: Iterable[type], bucketed=lambda cls: False
+) -> List[str]:
+    """Create the unique indexes, returns the collections holding duplicates instead"""
+    with_duplicates = []
+    for item_cls in item_classes:
+        collection = database.get_collection(collection_name(item_cls, bucketed(item_cls)))
+        try:
+            collection.create_indexes([unique_index(item_cls, bucketed(item_cls))])
+        except pymongo.errors.OperationFailure as exc:
+            if exc.code != _DUPLICATE_KEY:
+                raise
+            # written before the index was declared, the upserts still filter on the key
+            logger.error(
+                f"col {collection.name}: documents repeat the natural key, no unique index"
+                f" until they are deduplicated: {exc}"
+            )
+            with_duplicates.append(collection.name)
+    return with_duplicates
+
+
+def create_secondary_indexes(
+    database, item_classes: Iterable[type], bucketed=lambda cls: False
+) -> List[str]:
+    """Create the declared secondary indexes, run off the reactor thread
+
+    Returns the index names; indexes that already exist are left as they are.
+    """
+    created = []
+    for item_cls in item_classes:
+        models = secondary_indexes(item_cls, bucketed(item_cls))
+        if not models:
+            continue
+        colname = collection_name(item_cls, bucketed(item_cls))
+        created.extend(database.get_collection(colname).create_indexes(models))
+    logger.info(f"secondary indexes ready: {', '.join(created)}")
+    return created
@@ -1,11 +1,46 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from datetime import datetime
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 
+def _slotted(cls):
+    """Rebuild a dataclass with __slots__, as dataclass(slots=True) does on python>=3.10"""
+    field_names = tuple(field.name for field in fields(cls))
+    cls_dict = {
+        name: value
+        for name, value in cls.__dict__.items()
+        # defaults live in the generated __init__, the class attributes would clash with slots
+        if name not in field_names and name not in ("__dict__", "__weakref__")
+    }
+    cls_dict["__slots__"] = field_names
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+class _Document:
+    """Base of the items stored in Mongo
+
+    Subclasses declare ``item_name`` (the collection), ``natural_key`` (fields of its
+    unique index) and optionally ``indexes``, the field tuples of secondary ascending
+    indexes, and ``geo_indexes``, fields of 2dsphere indexes, see dragon_talon.indexes.
+    """
+
+    __slots__ = ()
+    indexes: Tuple[Tuple[str, ...], ...] = ()
+    geo_indexes: Tuple[str, ...] = ()
+
+    def to_document(self) -> dict:
+        """Shallow field dict for the Mongo driver, no deep copy unlike dataclasses.asdict"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+@_slotted
 @dataclass
-class XiaoquInfo:
+class XiaoquInfo(_Document):
     item_name = "xiaoqu_info"
+    natural_key = ("xiaoqu_id",)
+    indexes = (("district", "area"),)
+    # the GeoJSON point MongoPipeline derives from the coordinates, see dragon_talon.geo
+    geo_indexes = ("location",)
     xiaoqu_id: str
     name: str
     district: str
@@ -18,12 +53,21 @@ class XiaoquInfo:
     prop_manager: str
     management_fee: str
     tags: List[str]
+    # [longitude, latitude] of the page, in that order despite the names
     north_latitude: Optional[float] = None
     east_latitude: Optional[float] = None
+    crawled_at: Optional[datetime] = None
 
+
+@_slotted
 @dataclass
-class XiaoquDailyStats:
+class XiaoquDailyStats(_Document):
     item_name = "xiaoqu_daily_stats"
+    natural_key = ("date_", "xiaoqu_id")
+    indexes = (("xiaoqu_id", "date_"),)
+    # MONGO_STORAGE_LAYOUT = "bucket", see dragon_talon.buckets
+    bucket_key = ("xiaoqu_id",)
+    bucket_static_fields = ("name",)
 
     date_: datetime
     xiaoqu_id: str
@@ -34,9 +78,12 @@ class XiaoquDailyStats:
     ask_avg_price: int
 
 
+@_slotted
 @dataclass
-class Transaction:
+class Transaction(_Document):
     item_name = "transaction"
+    natural_key = ("date_", "house_id")
+    indexes = (("xiaoqu_id", "date_"),)
 
     house_id: int
     date_: datetime
@@ -54,9 +101,25 @@ class Transaction:
     xiaoqu_name: str
 
 
+@_slotted
 @dataclass
-class ForSale:
+class ForSale(_Document):
     item_name = "for_sale"
+    natural_key = ("date_", "house_id")
+    indexes = (("xiaoqu_id", "date_"), ("house_id", "date_"))
+    bucket_key = ("house_id",)
+    bucket_static_fields = (
+        "description",
+        "room_type",
+        "total_area",
+        "towards",
+        "decoration",
+        "floor_location",
+        "building_type",
+        "five_years_status",
+        "xiaoqu_id",
+        "xiaoqu_name",
+    )
 
     house_id: int
     date_: datetime
@@ -74,3 +137,42 @@ class ForSale:
     num_of_followers: int
     xiaoqu_id: str
     xiaoqu_name: str
+
+
+@_slotted
+@dataclass
+class ListingHeartbeat(_Document):
+    """A ForSale listing unchanged since the previous crawl, see ChangeDetectionPipeline"""
+
+    item_name = "for_sale_heartbeat"
+    natural_key = ("date_", "house_id")
+    indexes = (("xiaoqu_id", "date_"),)
+
+    house_id: int
+    date_: datetime
+    xiaoqu_id: str
+    num_of_followers: int
+    ask_duration_days: int
+
+
+@_slotted
+@dataclass
+class ListingEvent(_Document):
+    """A ForSale listing that appeared, changed, changed price or was delisted"""
+
+    item_name = "listing_event"
+    natural_key = ("date_", "house_id", "kind")
+    indexes = (("xiaoqu_id", "date_"), ("kind", "date_"))
+
+    NEW = "new"
+    CHANGED = "changed"
+    PRICE_DROP = "price_drop"
+    PRICE_RISE = "price_rise"
+    DELISTED = "delisted"
+
+    house_id: int
+    date_: datetime
+    kind: str
+    xiaoqu_id: str
+    ask_total_w: Optional[int]
+    prev_ask_total_w: Optional[int]
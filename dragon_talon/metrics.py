@@ -0,0 +1,288 @@
+import bisect
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.web import resource, server
+
+# upper bounds in seconds, from a fast xpath to a slow Mongo batch
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile, the max past the last bucket"""
+        rank = q * self.count
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(upper_bound, self.max)
+        return self.max
+
+
+def get_metrics(crawler) -> Optional["CrawlMetrics"]:
+    """The crawler's CrawlMetrics extension, None when metrics are disabled"""
+    for extension in crawler.extensions.middlewares:
+        if isinstance(extension, CrawlMetrics):
+            return extension
+    return None
+
+
+def _metric_name(name: str) -> str:
+    return "dragon_talon_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: _Labels, **extra) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class CrawlMetrics:
+    """Extension recording where the crawl spends its time
+
+    Components report into it (see get_metrics): ParseTimingMiddleware times the
+    callbacks, MongoPipeline its queue depth, flushes and batch writes. Items per type
+    and the download latency per subdomain come from signals. Everything, plus the
+    numeric crawl stats (e.g. ``lianjia/dropped/*``), is served in the Prometheus text
+    format on ``http://METRICS_HOST:METRICS_PORT/metrics`` and summarized in the log
+    when the spider closes.
+    """
+
+    def __init__(self, crawler, host: str, port: int):
+        self._crawler = crawler
+        self._host = host
+        self._port_number = port
+        self._listening_port = None
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[_Labels, Histogram]] = defaultdict(dict)
+        self._counters: Dict[str, Dict[_Labels, float]] = defaultdict(dict)
+        self._gauges: Dict[str, Dict[_Labels, float]] = defaultdict(dict)
+        self._started = time.monotonic()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool("METRICS_ENABLED"):
+            raise NotConfigured
+        metrics = cls(
+            crawler, settings.get("METRICS_HOST", "127.0.0.1"), settings.getint("METRICS_PORT")
+        )
+        crawler.signals.connect(metrics._spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(metrics._spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(metrics._item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(metrics._response_received, signal=signals.response_received)
+        return metrics
+
+    @property
+    def port(self) -> Optional[int]:
+        if self._listening_port is None:
+            return None
+        return self._listening_port.getHost().port
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counters = self._counters[name]
+            counters[key] = counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[name][tuple(sorted(labels.items()))] = value
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self._histograms.get(name, {}).get(tuple(sorted(labels.items())))
+
+    def _spider_opened(self, spider):
+        from twisted.internet import reactor
+
+        self._started = time.monotonic()
+        self._listening_port = reactor.listenTCP(
+            self._port_number, server.Site(_MetricsResource(self)), interface=self._host
+        )
+        logger.info(f"metrics served on http://{self._host}:{self.port}/metrics")
+
+    def _spider_closed(self, spider, reason):
+        for line in self.summary():
+            logger.info(line)
+        if self._listening_port is not None:
+            return self._listening_port.stopListening()
+
+    def _item_scraped(self, item, response, spider):
+        self.inc("items_total", type=getattr(item, "item_name", type(item).__name__))
+
+    def _response_received(self, response, request, spider):
+        latency = request.meta.get("download_latency")
+        # cached responses were not downloaded
+        if latency is not None and "cached" not in response.flags:
+            host = urlparse_cached(request).hostname
+            self.observe("download_latency_seconds", latency, host=host)
+
+    def render(self) -> str:
+        """The metrics and numeric crawl stats in the Prometheus text format"""
+        lines: List[str] = []
+        with self._lock:
+            for name, counters in sorted(self._counters.items()):
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric} counter")
+                for labels, value in sorted(counters.items()):
+                    lines.append(f"{metric}{_format_labels(labels)} {value}")
+            for name, gauges in sorted(self._gauges.items()):
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric} gauge")
+                for labels, value in sorted(gauges.items()):
+                    lines.append(f"{metric}{_format_labels(labels)} {value}")
+            for name, histograms in sorted(self._histograms.items()):
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for upper_bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(
+                            f"{metric}_bucket{_format_labels(labels, le=upper_bound)} {cumulative}"
+                        )
+                    lines.append(
+                        f"{metric}_bucket{_format_labels(labels, le='+Inf')} {histogram.count}"
+                    )
+                    lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        lines.append("# TYPE dragon_talon_crawl_stat gauge")
+        for key, value in sorted(self._crawler.stats.get_stats().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"dragon_talon_crawl_stat{_format_labels((('key', key),))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Log lines of the closing summary, also recorded in the crawl stats"""
+        stats = self._crawler.stats
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        lines = [f"metrics summary after {elapsed:.0f}s"]
+        for labels, count in sorted(self._counters.get("items_total", {}).items()):
+            item_type = dict(labels)["type"]
+            lines.append(f"  items {item_type}: {count:.0f} ({count / elapsed:.1f}/s)")
+            stats.set_value(f"metrics/items_per_sec/{item_type}", round(count / elapsed, 2))
+        for name, label in (
+            ("parse_seconds", "callback"),
+            ("pipeline_flush_seconds", "collection"),
+            ("mongo_write_seconds", "collection"),
+            ("download_latency_seconds", "host"),
+        ):
+            for labels, histogram in sorted(self._histograms.get(name, {}).items()):
+                value = dict(labels)[label]
+                mean_ms = histogram.sum / histogram.count * 1000
+                lines.append(
+                    f"  {name} {value}: n={histogram.count} mean={mean_ms:.1f}ms "
+                    f"p95<={histogram.quantile(0.95) * 1000:.1f}ms max={histogram.max * 1000:.1f}ms"
+                )
+                stats.set_value(f"metrics/{name}/{value}/mean_ms", round(mean_ms, 2))
+        for key, value in sorted(stats.get_stats().items()):
+            if key.startswith("lianjia/dropped/"):
+                lines.append(f"  dropped {key[len('lianjia/dropped/'):]}: {value}")
+        return lines
+
+
+class _MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics: CrawlMetrics):
+        super().__init__()
+        self._metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return self._metrics.render().encode()
+
+
+class ParseTimingMiddleware:
+    """Spider middleware timing each callback into the parse_seconds histogram
+
+    Only the time spent inside the callback's generator is counted, not the
+    processing of its output by the engine and the other middlewares, so it
+    should sit closest to the spider. For an async generator callback this is wall
+    time, its awaits included. A coroutine callback has run before its output gets
+    here: one parsing in the process pool (``LIANJIA_PARSE_WORKERS``) reports its
+    wall time, the wait for a free worker included, in ``response.meta["parse_seconds"]``.
+    """
+
+    def __init__(self, metrics: CrawlMetrics):
+        self._metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics = get_metrics(crawler)
+        if metrics is None:
+            raise NotConfigured
+        return cls(metrics)
+
+    def process_spider_output(self, response, result, spider):
+        iterator = iter(result)
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    output = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield output
+        finally:
+            self._observe(response, elapsed)
+
+    async def process_spider_output_async(self, response, result, spider):  # scrapy >= 2.7
+        iterator = result.__aiter__()
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    output = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield output
+        finally:
+            self._observe(response, elapsed)
+
+    def _observe(self, response, elapsed: float):
+        callback_name = getattr(response.request.callback, "__name__", "parse")
+        elapsed = response.meta.get("parse_seconds", elapsed)
+        self._metrics.observe("parse_seconds", elapsed, callback=callback_name)
@@ -0,0 +1,485 @@
+import itertools
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+from scrapy import FormRequest, Request
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import defer, task
+
+from . import signals
+
+_BLOCKED_STATUS = {403, 429}
+_REDIRECT_STATUS = {301, 302, 303, 307}
+
+
+def blocked_reason(request, response, block_markers: List[str]) -> str:
+    """Why the response looks like an anti-bot answer, empty if it does not"""
+    if response.status in _BLOCKED_STATUS:
+        return f"status {response.status}"
+    if response.status in _REDIRECT_STATUS:
+        location = response.headers.get("Location", b"").decode("latin1").lower()
+        if any(marker in location for marker in block_markers):
+            return f"redirect to {location}"
+        return ""
+    if any(marker in response.url.lower() for marker in block_markers):
+        return f"landed on {response.url}"
+    expect_marker = request.meta.get("throttle_expect_marker")
+    if response.status == 200 and expect_marker and expect_marker.encode() not in response.body:
+        return f"{expect_marker} missing"
+    return ""
+
+
+class AdaptiveThrottleMiddleware:
+    """Adjusts delay and concurrency of each downloader slot (one per subdomain)
+
+    Backs off sharply when a slot looks blocked: captcha/login/verify redirects,
+    403/429, or a page missing the marker its request expects
+    (``request.meta["throttle_expect_marker"]``). Otherwise ramps up: the delay
+    follows the observed latency down to the minimum delay and concurrency grows
+    by one every ``ADAPTIVE_THROTTLE_RAMP_INTERVAL`` successful responses.
+    """
+
+    _DELAY_RAMP_FACTOR = 0.9
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("ADAPTIVE_THROTTLE_ENABLED"):
+            raise NotConfigured
+        self._crawler = crawler
+        self._start_delay = settings.getfloat("DOWNLOAD_DELAY")
+        self._start_concurrency = settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN")
+        self._min_delay = settings.getfloat("ADAPTIVE_THROTTLE_MIN_DELAY", 1.0)
+        self._max_delay = settings.getfloat("ADAPTIVE_THROTTLE_MAX_DELAY", 120.0)
+        self._max_concurrency = settings.getint("ADAPTIVE_THROTTLE_MAX_CONCURRENCY", 4)
+        self._backoff_factor = settings.getfloat("ADAPTIVE_THROTTLE_BACKOFF_FACTOR", 4.0)
+        self._ramp_interval = settings.getint("ADAPTIVE_THROTTLE_RAMP_INTERVAL", 20)
+        self._max_retries = settings.getint("ADAPTIVE_THROTTLE_MAX_RETRIES", 3)
+        self._block_markers = settings.getlist(
+            "ADAPTIVE_THROTTLE_BLOCK_URL_MARKERS", ["captcha", "login", "verify"]
+        )
+        # slot key -> successful responses since the last ramp up or block
+        self._slot2streak: Dict[str, int] = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_response(self, request, response, spider):
+        slot_key = request.meta.get("download_slot")
+        slot = self._crawler.engine.downloader.slots.get(slot_key)
+        if slot is None or "cached" in response.flags:
+            return response
+        if slot_key not in self._slot2streak:
+            self._slot2streak[slot_key] = 0
+            slot.delay = self._start_delay
+            slot.concurrency = self._start_concurrency
+
+        block_reason = blocked_reason(request, response, self._block_markers)
+        if block_reason:
+            return self._on_blocked(slot_key, slot, request, response, block_reason)
+        if response.status == 200:
+            self._on_success(slot_key, slot, request.meta.get("download_latency", 0.0))
+        return response
+
+    def _on_blocked(self, slot_key: str, slot, request, response, reason: str):
+        stats = self._crawler.stats
+        stats.inc_value("adaptive_throttle/blocked")
+        stats.inc_value(f"adaptive_throttle/blocked/{slot_key}")
+        self._slot2streak[slot_key] = 0
+        slot.concurrency = 1
+        slot.delay = min(self._max_delay, max(slot.delay, self._min_delay) * self._backoff_factor)
+        logger.warning(
+            f"{slot_key} looks blocked ({reason}), delay -> {slot.delay:.1f}s, concurrency -> 1"
+        )
+        retry_times = request.meta.get("throttle_retry_times", 0) + 1
+        if retry_times > self._max_retries:
+            stats.inc_value("adaptive_throttle/gave_up")
+            return response
+        retry_request = request.copy()
+        retry_request.meta["throttle_retry_times"] = retry_times
+        # from the network, whatever the cache holds for the page
+        retry_request.meta["dont_cache"] = True
+        retry_request.dont_filter = True
+        return retry_request
+
+    def _on_success(self, slot_key: str, slot, latency: float):
+        # like autothrottle: move towards the delay that keeps `concurrency` requests
+        # in flight at the observed latency, but never faster than a 10% step
+        target_delay = latency / slot.concurrency
+        new_delay = max(slot.delay * self._DELAY_RAMP_FACTOR, (slot.delay + target_delay) / 2)
+        slot.delay = min(self._max_delay, max(self._min_delay, new_delay))
+        self._slot2streak[slot_key] += 1
+        if (
+            self._slot2streak[slot_key] >= self._ramp_interval
+            and slot.concurrency < self._max_concurrency
+        ):
+            self._slot2streak[slot_key] = 0
+            slot.concurrency += 1
+            logger.info(f"{slot_key} ramps up, concurrency -> {slot.concurrency}")
+        self._crawler.stats.max_value(
+            f"adaptive_throttle/max_concurrency/{slot_key}", slot.concurrency
+        )
+
+
+class _Session:
+    """One proxy with its own cookie jar and User-Agent"""
+
+    def __init__(self, name: str, proxy: Optional[str], user_agent: str, cookiejar: int):
+        self.name = name
+        self.proxy = proxy
+        self.user_agent = user_agent
+        self.cookiejar = cookiejar
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # exponentially weighted moving average of the download latency, seconds
+        self.latency = 0.0
+        self.inflight = 0
+        self.strikes = 0
+        self.quarantined_until = 0.0
+
+    def score(self) -> float:
+        # smoothed success rate, discounted by latency
+        success_rate = (self.successes + 1) / (self.successes + self.failures + 2)
+        return success_rate / (1.0 + self.latency)
+
+
+class ProxySessionPoolMiddleware:
+    """Spreads requests over a pool of proxies, each with its own cookies and User-Agent
+
+    Every session gets its own downloader slot per host, so ``DOWNLOAD_DELAY`` and
+    ``CONCURRENT_REQUESTS_PER_DOMAIN`` hold per proxy while the total concurrency
+    grows with ``PROXY_POOL``. A request goes to the available session with the best
+    score (success rate over latency) per request in flight. A session answering
+    with a captcha/login redirect or 403/429 is quarantined, for twice as long at
+    each strike, and comes back with a fresh cookie jar.
+    """
+
+    _LATENCY_WEIGHT = 0.3
+    DIRECT = "direct"
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        proxies = settings.getlist("PROXY_POOL")
+        if not proxies:
+            raise NotConfigured
+        user_agents = settings.getlist("PROXY_POOL_USER_AGENTS") or [settings.get("USER_AGENT")]
+        self._stats = crawler.stats
+        self._quarantine_secs = settings.getfloat("PROXY_POOL_QUARANTINE_SECS", 600)
+        self._max_quarantine_secs = settings.getfloat("PROXY_POOL_MAX_QUARANTINE_SECS", 6 * 3600)
+        self._max_failures = settings.getint("PROXY_POOL_MAX_FAILURES", 3)
+        self._block_markers = settings.getlist(
+            "ADAPTIVE_THROTTLE_BLOCK_URL_MARKERS", ["captcha", "login", "verify"]
+        )
+        self._cookiejar_ids = itertools.count()
+        self._sessions: Dict[str, _Session] = {}
+        for index, proxy in enumerate(proxies):
+            name = f"session{index}"
+            self._sessions[name] = _Session(
+                name,
+                None if proxy == self.DIRECT else proxy,
+                user_agents[index % len(user_agents)],
+                next(self._cookiejar_ids),
+            )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        now = time.monotonic()
+        session = self._sessions.get(request.meta.get("proxy_session"))
+        # retries of a blocked request move to another session
+        if session is None or session.quarantined_until > now:
+            session = self._pick(now)
+            request.meta["proxy_session"] = session.name
+        request.meta["proxy"] = session.proxy
+        request.meta["cookiejar"] = session.cookiejar
+        request.meta["download_slot"] = f"{urlparse_cached(request).hostname}@{session.name}"
+        request.headers["User-Agent"] = session.user_agent
+        session.inflight += 1
+        self._stats.inc_value(f"proxy_pool/requests/{session.name}")
+
+    def process_response(self, request, response, spider):
+        session = self._release(request)
+        if session is None or "cached" in response.flags:
+            return response
+        reason = blocked_reason(request, response, self._block_markers)
+        if reason:
+            session.failures += 1
+            self._quarantine(session, reason)
+        elif response.status < 500:
+            session.successes += 1
+            session.consecutive_failures = 0
+            session.strikes = 0
+            latency = request.meta.get("download_latency", 0.0)
+            session.latency += self._LATENCY_WEIGHT * (latency - session.latency)
+        else:
+            self._on_failure(session, f"status {response.status}")
+        return response
+
+    def process_exception(self, request, exception, spider):
+        session = self._release(request)
+        if session is not None:
+            self._on_failure(session, repr(exception))
+
+    def _pick(self, now: float) -> _Session:
+        available = [s for s in self._sessions.values() if s.quarantined_until <= now]
+        if not available:
+            self._stats.inc_value("proxy_pool/exhausted")
+            session = min(self._sessions.values(), key=lambda s: s.quarantined_until)
+            logger.warning(f"every proxy session is quarantined, falling back to {session.name}")
+            return session
+        return max(available, key=lambda s: s.score() / (1 + s.inflight))
+
+    def _release(self, request) -> Optional[_Session]:
+        session = self._sessions.get(request.meta.get("proxy_session"))
+        if session is not None and session.inflight > 0:
+            session.inflight -= 1
+        return session
+
+    def _on_failure(self, session: _Session, reason: str):
+        session.failures += 1
+        session.consecutive_failures += 1
+        if session.consecutive_failures >= self._max_failures:
+            self._quarantine(session, f"{session.consecutive_failures} failures, last {reason}")
+
+    def _quarantine(self, session: _Session, reason: str):
+        now = time.monotonic()
+        if session.quarantined_until > now:
+            # requests queued on the session before it was quarantined, same strike
+            return
+        session.consecutive_failures = 0
+        session.strikes += 1
+        secs = min(
+            self._max_quarantine_secs, self._quarantine_secs * 2 ** (session.strikes - 1)
+        )
+        session.quarantined_until = now + secs
+        # whatever the site attached to these cookies goes with them
+        session.cookiejar = next(self._cookiejar_ids)
+        self._stats.inc_value("proxy_pool/quarantined")
+        self._stats.inc_value(f"proxy_pool/quarantined/{session.name}")
+        logger.warning(f"proxy {session.name} quarantined for {secs:.0f}s ({reason})")
+
+
+class _Account:
+    """One lianjia login with its own cookie jar"""
+
+    LOGGED_OUT = "logged_out"
+    LOGGING_IN = "logging_in"
+    LOGGED_IN = "logged_in"
+    FAILED = "failed"
+
+    def __init__(self, username: str, password: str):
+        self.username = username
+        self.password = password
+        self.cookiejar = f"account:{username}"
+        self.state = self.LOGGED_OUT
+        self.next_request_at = 0.0
+        # requests waiting for the login in progress
+        self.waiters: List[defer.Deferred] = []
+
+
+def load_accounts(path: str) -> List[_Account]:
+    """``username:password`` per line, blank lines and # comments are skipped"""
+    accounts = []
+    with open(path, "rt") as fs:
+        for line in fs:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                username, password = line.split(":", 1)
+                accounts.append(_Account(username, password))
+    return accounts
+
+
+class AccountPoolMiddleware:
+    """Sends requests with ``meta["login_required"]`` through a pool of logged-in accounts
+
+    Each account has its own cookie jar, logs in on first use with a form POST to
+    ``LIANJIA_LOGIN_URL`` and sends at most one request every
+    ``LIANJIA_ACCOUNT_DELAY`` seconds; a request goes to the account free the
+    soonest. A login succeeded when its answer sets the ``LIANJIA_LOGIN_COOKIE``
+    cookie, or without that setting, when it is a 2xx or a redirect away from the
+    login page. A redirect to a login page means the session expired: the account
+    logs in again and the request is retried, at most ``LIANJIA_ACCOUNT_MAX_RELOGINS``
+    times. Accounts whose login is refused are dropped from the pool.
+
+    The request waiting for a login stays in memory, the login request only carries
+    a token to it, and is kept out of a shared queue (``meta["distributed_local"]``,
+    see DistributedScheduler) since no other process could resume it. So are the
+    requests resumed after a login and the retries after an expired session: the
+    worker already leased them, they are acked once parsed.
+
+    It sits after ProxySessionPoolMiddleware in the request chain, so the account's
+    cookie jar wins, and before it and the adaptive throttle in the response chain,
+    so expired sessions are not taken for a block.
+    """
+
+    _LOGIN_MARKER = "login"
+
+    def __init__(self, crawler, accounts: List[_Account]):
+        settings = crawler.settings
+        self._stats = crawler.stats
+        self._accounts = {account.username: account for account in accounts}
+        self._login_url = settings.get("LIANJIA_LOGIN_URL")
+        self._delay = settings.getfloat("LIANJIA_ACCOUNT_DELAY", 10)
+        self._max_relogins = settings.getint("LIANJIA_ACCOUNT_MAX_RELOGINS", 2)
+        self._login_cookie = settings.get("LIANJIA_LOGIN_COOKIE")
+        # login token -> the request that triggered the login
+        self._token2request: Dict[str, Request] = {}
+        self._login_ids = itertools.count()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get("LIANJIA_ACCOUNTS_FILE")
+        if not path:
+            raise NotConfigured
+        accounts = load_accounts(path)
+        if not accounts:
+            raise NotConfigured(f"no account in {path}")
+        return cls(crawler, accounts)
+
+    def process_request(self, request, spider):
+        if not request.meta.get("login_required"):
+            return None
+        account = self._accounts.get(request.meta.get("account"))
+        if account is None or account.state == _Account.FAILED:
+            account = self._pick()
+            request.meta["account"] = account.username
+        # the proxy session's cookie jar is not logged in
+        request.meta["cookiejar"] = account.cookiejar
+        if "account_login_for" in request.meta:
+            return None
+        if account.state == _Account.LOGGED_OUT:
+            account.state = _Account.LOGGING_IN
+            return self._login_request(account, request)
+        if account.state == _Account.LOGGING_IN:
+            waiter = defer.Deferred()
+            waiter.addCallback(lambda _: self.process_request(request, spider))
+            account.waiters.append(waiter)
+            return waiter
+        return self._throttle(account)
+
+    def process_response(self, request, response, spider):
+        account = self._accounts.get(request.meta.get("account"))
+        if account is None:
+            return response
+        token = request.meta.get("account_login_for")
+        if token is not None:
+            return self._on_login(account, response, self._token2request.pop(token, None))
+        if not self._is_logged_out(response):
+            self._stats.inc_value(f"account_pool/requests/{account.username}")
+            return response
+        if account.state == _Account.LOGGED_IN:
+            logger.info(f"account {account.username}: session expired, logging in again")
+            account.state = _Account.LOGGED_OUT
+        relogins = request.meta.get("account_relogins", 0) + 1
+        if relogins > self._max_relogins:
+            self._stats.inc_value("account_pool/gave_up")
+            raise IgnoreRequest(f"{request.url}: still logged out after {relogins - 1} logins")
+        retry_request = request.replace(dont_filter=True)
+        retry_request.meta["account_relogins"] = relogins
+        # DistributedScheduler has it leased, the shared queue would drop it as a duplicate
+        retry_request.meta["distributed_local"] = True
+        return retry_request
+
+    def _pick(self) -> _Account:
+        available = [a for a in self._accounts.values() if a.state != _Account.FAILED]
+        if not available:
+            raise IgnoreRequest("every lianjia account failed to log in")
+        return min(available, key=self._next_slot)
+
+    def _next_slot(self, account: _Account) -> float:
+        # the request logging in and those waiting for it take the account's next slots
+        pending = len(account.waiters) + (account.state == _Account.LOGGING_IN)
+        return account.next_request_at + self._delay * pending
+
+    def _throttle(self, account: _Account) -> Optional[defer.Deferred]:
+        now = time.monotonic()
+        wait = account.next_request_at - now
+        account.next_request_at = max(now, account.next_request_at) + self._delay
+        if wait <= 0:
+            return None
+        from twisted.internet import reactor
+
+        return task.deferLater(reactor, wait, lambda: None)
+
+    def _login_request(self, account: _Account, request) -> FormRequest:
+        self._stats.inc_value("account_pool/logins")
+        token = f"{account.username}-{next(self._login_ids)}"
+        self._token2request[token] = request
+        return FormRequest(
+            self._login_url,
+            formdata={"username": account.username, "password": account.password},
+            meta={
+                "login_required": True,
+                "account": account.username,
+                "account_login_for": token,
+                "cookiejar": account.cookiejar,
+                "dont_cache": True,
+                "distributed_local": True,
+            },
+            priority=request.priority + 1,
+            dont_filter=True,
+        )
+
+    def _on_login(self, account: _Account, response, original: Optional[Request]):
+        if self._login_succeeded(response):
+            account.state = _Account.LOGGED_IN
+            logger.info(f"account {account.username}: logged in")
+        else:
+            account.state = _Account.FAILED
+            self._stats.inc_value("account_pool/login_failed")
+            logger.error(f"account {account.username}: login refused, status {response.status}")
+        waiters, account.waiters = account.waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+        if original is None:
+            raise IgnoreRequest(f"{response.url}: no request waits for this login")
+        # back through the pool, the scheduler has already seen it, and leased it when
+        # it is a DistributedScheduler
+        resumed = original.replace(dont_filter=True)
+        resumed.meta["distributed_local"] = True
+        return resumed
+
+    def _login_succeeded(self, response) -> bool:
+        if self._login_cookie:
+            # CookiesMiddleware has stored it in the account's jar already
+            prefix = f"{self._login_cookie}=".encode()
+            cookies = response.headers.getlist("Set-Cookie")
+            return any(cookie.strip().startswith(prefix) for cookie in cookies)
+        if response.status in _REDIRECT_STATUS:
+            return not self._is_logged_out(response)
+        return 200 <= response.status < 300
+
+    def _is_logged_out(self, response) -> bool:
+        if response.status not in _REDIRECT_STATUS:
+            return False
+        location = response.headers.get("Location", b"").decode("latin1").lower()
+        return self._LOGIN_MARKER in location
+
+
+class PageParsedMiddleware:
+    """Spider middleware sending ``signals.page_parsed`` once a callback is done
+
+    The signal follows the last output of the callback, it is not sent when the
+    callback raises. SeenUrlDupeFilter records the page on it.
+    """
+
+    def __init__(self, crawler):
+        self._crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        yield from result
+        self._crawler.signals.send_catch_log(signals.page_parsed, response=response, spider=spider)
+
+    async def process_spider_output_async(self, response, result, spider):  # scrapy >= 2.7
+        async for output in result:
+            yield output
+        self._crawler.signals.send_catch_log(signals.page_parsed, response=response, spider=spider)
@@ -0,0 +1,208 @@
+"""Read-side queries of the web backend, see dragon_talon.web
+
+Every query reads through one of the declared indexes and projects the fields it
+returns only. The paged ones sort on a unique key and return ``limit + 1`` documents;
+the key of the last document served is the cursor of the next page (``after``), so
+a page is an index range scan however deep the client pages, unlike skip/offset.
+
+MongoPipeline records every finished crawl in ``crawl_log``, the cache of the web
+backend is keyed by the latest one.
+"""
+
+import heapq
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+from pymongo import ASCENDING, DESCENDING
+
+from . import buckets, geo, items, rollups
+
+CRAWL_LOG = "crawl_log"
+
+_LISTING_FIELDS = (
+    "house_id",
+    "date_",
+    "description",
+    "room_type",
+    "total_area",
+    "towards",
+    "decoration",
+    "floor_location",
+    "building_type",
+    "five_years_status",
+    "ask_total_w",
+    "ask_avg_price",
+    "ask_duration_days",
+    "num_of_followers",
+)
+_XIAOQU_PROJECTION = {"_id": 0, "crawled_at": 0, "north_latitude": 0, "east_latitude": 0}
+# finalized days carry mean and median, the histogram is only read for the others
+_SERIES_PROJECTION = {"_id": 0, "date_": 1, "count": 1, "sum": 1, "mean": 1, "median": 1}
+
+
+class Page(NamedTuple):
+    # at most limit + 1 documents, the extra one tells there is a next page
+    docs: Iterator[dict]
+    limit: int
+    # sort key of a document, the ``after`` of the page following it
+    key: Callable[[dict], object]
+
+
+def record_crawl(database, spider_name: str, finished_at: datetime):
+    collection = database.get_collection(CRAWL_LOG)
+    collection.insert_one({"spider": spider_name, "finished_at": finished_at})
+
+
+def last_crawl(database) -> Optional[datetime]:
+    """When the latest crawl finished, None before the first one"""
+    doc = database.get_collection(CRAWL_LOG).find_one(
+        {}, projection={"_id": 0, "finished_at": 1}, sort=[("finished_at", DESCENDING)]
+    )
+    return None if doc is None else doc["finished_at"]
+
+
+def xiaoqu_detail(database, xiaoqu_id: str, bucketed: bool = False) -> Optional[dict]:
+    """The xiaoqu_info document with its latest ask price, None for an unknown xiaoqu"""
+    collection = database.get_collection(items.XiaoquInfo.item_name)
+    doc = collection.find_one({"xiaoqu_id": xiaoqu_id}, projection=_XIAOQU_PROJECTION)
+    if doc is None:
+        return None
+    price = geo.latest_prices(database, [xiaoqu_id], bucketed).get(xiaoqu_id)
+    doc["price"] = None if price is None else price._asdict()
+    return doc
+
+
+def price_series(
+    database,
+    level: str,
+    key: str,
+    limit: int,
+    since: Optional[datetime] = None,
+    after: Optional[datetime] = None,
+    bucket_width: int = 500,
+) -> Page:
+    """Daily ask price rollups of a xiaoqu, area or district, by date"""
+    date_range = {}
+    if since is not None:
+        date_range["$gte"] = since
+    if after is not None:
+        date_range["$gt"] = after
+    query = {"level": level, "key": key}
+    if date_range:
+        query["date_"] = date_range
+    collection = database.get_collection(rollups.COLLECTION)
+    cursor = collection.find(
+        query, projection=_SERIES_PROJECTION, sort=[("date_", ASCENDING)], limit=limit + 1
+    )
+    return Page(_series_days(collection, cursor, level, key, bucket_width), limit, _date_key)
+
+
+def _series_days(collection, cursor, level: str, key: str, bucket_width: int) -> Iterator[dict]:
+    for doc in cursor:
+        if doc.get("median") is None:
+            # the day of a running crawl, not finalized yet
+            hist_doc = collection.find_one(
+                {"level": level, "key": key, "date_": doc["date_"]}, projection={"hist": 1}
+            )
+            doc["mean"] = doc["sum"] / doc["count"]
+            doc["median"] = rollups.median(hist_doc["hist"], doc["count"], bucket_width)
+        yield {field: doc[field] for field in ("date_", "count", "mean", "median")}
+
+
+def active_listings(
+    database, xiaoqu_id: str, limit: int, after: Optional[int] = None, bucketed: bool = False
+) -> Page:
+    """The for_sale listings of a xiaoqu on its latest crawl date, by house_id
+
+    Unchanged listings (see ChangeDetectionPipeline) come from their latest for_sale
+    document, with the fields of their heartbeat. The bucket layout does not read the
+    heartbeats: it returns the listings with a for_sale entry on that date only.
+    """
+    house_range = {} if after is None else {"house_id": {"$gt": after}}
+    if bucketed:
+        collection = database.get_collection(buckets.bucket_collection_name(items.ForSale))
+        latest = collection.find_one(
+            {"xiaoqu_id": xiaoqu_id},
+            projection={"_id": 0, "last_date": 1},
+            sort=[("month", DESCENDING), ("last_date", DESCENDING)],
+        )
+        if latest is None:
+            return Page(iter(()), limit, _house_key)
+        last_date = latest["last_date"]
+        month, day = buckets.bucket_day(last_date)
+        projection = {field: 1 for field in items.ForSale.bucket_static_fields}
+        projection.update({"_id": 0, "house_id": 1, f"days.{day}": 1})
+        cursor = collection.find(
+            {"xiaoqu_id": xiaoqu_id, "month": month, "last_date": last_date, **house_range},
+            projection=projection,
+            sort=[("house_id", ASCENDING)],
+            limit=limit + 1,
+        )
+        return Page(_bucket_listings(cursor, last_date, day), limit, _house_key)
+    collection = database.get_collection(items.ForSale.item_name)
+    # with change detection, the listings unchanged since the previous crawl only have a
+    # heartbeat on the latest crawl date
+    heartbeats = database.get_collection(items.ListingHeartbeat.item_name)
+    latest_dates = [
+        latest["date_"]
+        for latest in (
+            col.find_one(
+                {"xiaoqu_id": xiaoqu_id},
+                projection={"_id": 0, "date_": 1},
+                sort=[("date_", DESCENDING)],
+            )
+            for col in (collection, heartbeats)
+        )
+        if latest is not None
+    ]
+    if not latest_dates:
+        return Page(iter(()), limit, _house_key)
+    query = {"xiaoqu_id": xiaoqu_id, "date_": max(latest_dates), **house_range}
+    projection = {field: 1 for field in _LISTING_FIELDS}
+    projection["_id"] = 0
+    changed = collection.find(
+        query, projection=projection, sort=[("house_id", ASCENDING)], limit=limit + 1
+    )
+    unchanged = heartbeats.find(
+        query,
+        projection={"_id": 0, "xiaoqu_id": 0},
+        sort=[("house_id", ASCENDING)],
+        limit=limit + 1,
+    )
+    docs = heapq.merge(changed, _heartbeat_listings(collection, unchanged), key=_house_key)
+    return Page(docs, limit, _house_key)
+
+
+def _heartbeat_listings(collection, heartbeats: Iterable[dict]) -> Iterator[dict]:
+    """The latest for_sale document of each heartbeat's listing, with the heartbeat's fields"""
+    heartbeats = list(heartbeats)
+    if not heartbeats:
+        return
+    latest_docs = collection.aggregate(
+        [
+            {"$match": {"house_id": {"$in": [heartbeat["house_id"] for heartbeat in heartbeats]}}},
+            {"$sort": {"house_id": ASCENDING, "date_": DESCENDING}},
+            {"$group": {"_id": "$house_id", "doc": {"$first": "$$ROOT"}}},
+        ]
+    )
+    house_id2doc = {latest["_id"]: latest["doc"] for latest in latest_docs}
+    for heartbeat in heartbeats:
+        doc = house_id2doc.get(heartbeat["house_id"])
+        if doc is not None:
+            doc = dict(doc, **heartbeat)
+            yield {field: doc[field] for field in _LISTING_FIELDS}
+
+
+def _bucket_listings(cursor: Iterable[dict], last_date: datetime, day: str) -> Iterator[dict]:
+    for bucket in cursor:
+        daily = bucket.pop("days")[day]
+        doc = dict(bucket, date_=last_date, **daily)
+        yield {field: doc[field] for field in _LISTING_FIELDS}
+
+
+def _date_key(doc: dict) -> datetime:
+    return doc["date_"]
+
+
+def _house_key(doc: dict) -> int:
+    return doc["house_id"]
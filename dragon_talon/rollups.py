@@ -0,0 +1,132 @@
+"""Daily ask price rollups per xiaoqu, area (bizcircle) and district
+
+MongoPipeline folds each batch of new for_sale documents into one document per
+level, key and day::
+
+    {"level": "district", "key": "浦东", "date_": ..., "count": 812, "sum": 52417300,
+     "hist": {"64000": 12, "64500": 9, ...}, "mean": 64553.3, "median": 64250.0}
+
+count, sum and the ``ask_avg_price`` histogram (buckets of MONGO_ROLLUP_PRICE_BUCKET)
+are $inc'ed, so concurrent workers and partial batches add up without reading the
+documents back. mean and median are derived from them when the spider closes; the
+median is interpolated within its histogram bucket. Area keys are prefixed with
+their district, as bizcircle names are not unique.
+"""
+
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+COLLECTION = "price_rollup_daily"
+XIAOQU = "xiaoqu"
+AREA = "area"
+DISTRICT = "district"
+LEVELS = (XIAOQU, AREA, DISTRICT)
+
+_GroupKey = Tuple[str, str, datetime]
+
+
+def index_models() -> List[IndexModel]:
+    return [
+        IndexModel(
+            [("level", ASCENDING), ("key", ASCENDING), ("date_", ASCENDING)], unique=True
+        )
+    ]
+
+
+def area_key(district: str, area: str) -> str:
+    return f"{district}/{area}"
+
+
+def median(hist: Mapping[str, int], count: int, bucket_width: int) -> Optional[float]:
+    if count <= 0:
+        return None
+    half = count / 2
+    cumulative = 0
+    for lower, num in sorted(((int(lower), num) for lower, num in hist.items())):
+        if num > 0 and cumulative + num >= half:
+            return lower + bucket_width * (half - cumulative) / num
+        cumulative += num
+    return None
+
+
+class PriceRollups:
+    """Rollup updates of the for_sale documents a batch inserted"""
+
+    def __init__(self, bucket_width: int = 500):
+        self._bucket_width = bucket_width
+        # xiaoqu id -> (district, area), from xiaoqu_info
+        self._xiaoqu2location: Dict[str, Tuple[str, str]] = {}
+        # groups updated since the last finalize
+        self._touched: Set[_GroupKey] = set()
+
+    def load_locations(self, xiaoqu_info_col):
+        cursor = xiaoqu_info_col.find({}, projection={"xiaoqu_id": 1, "district": 1, "area": 1})
+        for doc in cursor:
+            self.remember_location(doc["xiaoqu_id"], doc.get("district"), doc.get("area"))
+
+    def remember_location(self, xiaoqu_id: str, district: Optional[str], area: Optional[str]):
+        if district:
+            self._xiaoqu2location[xiaoqu_id] = (district, area)
+
+    def _groups(self, doc: Mapping) -> Iterator[Tuple[str, str]]:
+        yield XIAOQU, doc["xiaoqu_id"]
+        location = self._xiaoqu2location.get(doc["xiaoqu_id"])
+        if location is not None:
+            district, area = location
+            yield DISTRICT, district
+            if area:
+                yield AREA, area_key(district, area)
+
+    def updates(self, docs: Iterable[Mapping]) -> List[UpdateOne]:
+        """$inc updates of the groups of the for_sale documents, one per group"""
+        group2inc: Dict[_GroupKey, Dict[str, int]] = {}
+        for doc in docs:
+            price = doc["ask_avg_price"]
+            hist_field = f"hist.{price // self._bucket_width * self._bucket_width}"
+            for level, key in self._groups(doc):
+                inc = group2inc.setdefault((level, key, doc["date_"]), {"count": 0, "sum": 0})
+                inc["count"] += 1
+                inc["sum"] += price
+                inc[hist_field] = inc.get(hist_field, 0) + 1
+        self._touched.update(group2inc)
+        return [
+            UpdateOne({"level": level, "key": key, "date_": date_}, {"$inc": inc}, upsert=True)
+            for (level, key, date_), inc in group2inc.items()
+        ]
+
+    def finalize(self, collection) -> int:
+        """Set mean and median of the groups updated since the last call"""
+        touched, self._touched = self._touched, set()
+        requests = []
+        for level, key, date_ in touched:
+            query = {"level": level, "key": key, "date_": date_}
+            doc = collection.find_one(query, projection={"count": 1, "sum": 1, "hist": 1})
+            if doc is None:
+                continue
+            stats = {
+                "mean": doc["sum"] / doc["count"],
+                "median": median(doc["hist"], doc["count"], self._bucket_width),
+            }
+            requests.append(UpdateOne(query, {"$set": stats}))
+        if requests:
+            collection.bulk_write(requests, ordered=False)
+        return len(requests)
+
+
+def price_trend(
+    collection, level: str, key: str, since: Optional[datetime] = None, bucket_width: int = 500
+) -> Iterator[dict]:
+    """(date_, count, mean, median) per day of one xiaoqu, area or district"""
+    query = {"level": level, "key": key}
+    if since is not None:
+        query["date_"] = {"$gte": since}
+    for doc in collection.find(query, sort=[("date_", ASCENDING)]):
+        yield {
+            "date_": doc["date_"],
+            "count": doc["count"],
+            "mean": doc["sum"] / doc["count"],
+            # not finalized yet when the crawl of the day still runs
+            "median": median(doc["hist"], doc["count"], bucket_width),
+        }
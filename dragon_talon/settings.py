@@ -6,6 +6,33 @@ NEWSPIDER_MODULE = "dragon_talon.spiders"
 LOG_LEVEL = "INFO"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 
+# Incremental crawl (-a incremental=1): xiaoqu detail pages crawled within this
+# many days are not fetched again
+XIAOQU_REFRESH_DAYS = 30
+
+# Parse the list and detail pages in a pool of this many worker processes instead of on
+# the reactor thread, 0 parses inline. Needs the asyncio reactor (TWISTED_REACTOR).
+LIANJIA_PARSE_WORKERS = 0
+
+# "api" fetches the xiaoqu and for-sale lists from the app's JSON endpoints, with
+# LIANJIA_API_PAGE_SIZE entries a request, instead of the desktop HTML pages. A list
+# whose endpoint fails or answers without data falls back to its HTML pages.
+LIANJIA_FETCH_MODE = "html"
+LIANJIA_API_URL = "https://app.api.lianjia.com"
+LIANJIA_API_PAGE_SIZE = 100
+
+# Persistent seen-url index: a parsed url is not scheduled again before its TTL expires,
+# needs PageParsedMiddleware in SPIDER_MIDDLEWARES
+DUPEFILTER_CLASS = "dragon_talon.dupefilter.SeenUrlDupeFilter"
+SEEN_URL_INDEX_PATH = "frontier/seen_urls.sqlite"
+SEEN_URL_TTLS = [
+    # xiaoqu detail pages
+    (r"lianjia\.com/xiaoqu/\d+/", XIAOQU_REFRESH_DAYS * 24 * 3600),
+    # district, ershoufang and chengjiao list pages are fetched daily
+    (r"lianjia\.com/(xiaoqu|ershoufang|chengjiao)/", 20 * 3600),
+]
+SEEN_URL_DEFAULT_TTL = 12 * 3600
+
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 # USER_AGENT = 'tutorial (+http://www.yourdomain.com)'
 
@@ -13,15 +40,17 @@ TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 1
+# Upper bound across all cities, each {city}.lianjia.com is limited separately below
+CONCURRENT_REQUESTS = 16
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
 DOWNLOAD_DELAY = 5
 # The download delay setting will honor only one of:
-ONCURRENT_REQUESTS_PER_DOMAIN = 1
-CONCURRENT_REQUESTS_PER_IP = 1
+CONCURRENT_REQUESTS_PER_DOMAIN = 1
+# Per-IP slots would merge the city subdomains served by the same IP into one slot
+CONCURRENT_REQUESTS_PER_IP = 0
 RANDOMIZE_DOWNLOAD_DELAY = True
 
 # Disable cookies (enabled by default)
@@ -38,23 +67,143 @@ RANDOMIZE_DOWNLOAD_DELAY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    'tutorial.middlewares.TutorialSpiderMiddleware': 543,
-# }
+SPIDER_MIDDLEWARES = {
+    # sees the output after the other spider middlewares filtered it
+    "dragon_talon.frontier.FrontierMiddleware": 50,
+    # tells the seen-url index and DistributedScheduler which pages went through their
+    # callback
+    "dragon_talon.middelwares.PageParsedMiddleware": 100,
+    # closest to the spider, times the callbacks only (needs METRICS_ENABLED)
+    "dragon_talon.metrics.ParseTimingMiddleware": 950,
+}
+
+# Resumable crawl: requests are recorded in this sqlite file and a restarted crawl
+# resumes the unfinished requests of its job, by default the newest job of the spider
+# with requests left, or a new one named after the spider and start time
+FRONTIER_PATH = "frontier/frontier.sqlite"
+# FRONTIER_JOB = "lianjia-20210118"
+FRONTIER_CHECKPOINT_SECS = 60
+
+# Distributed crawl: run several workers with
+#   SCHEDULER = "dragon_talon.distributed.DistributedScheduler"
+# and FRONTIER_PATH unset. Workers of the same job (FRONTIER_JOB, default: spider name
+# and date) share one request queue and dedup set, see docker/docker-compose.distributed.yml.
+# DUPEFILTER_CLASS is still consulted, with a seen-url index per worker
+DISTRIBUTED_QUEUE_BACKEND = "dragon_talon.distributed.MongoRequestQueue"
+# for dragon_talon.distributed.SqliteRequestQueue, workers on one host
+DISTRIBUTED_SQLITE_PATH = "frontier/crawl_queue.sqlite"
+# a worker renews its leases every third of this, requests of a dead worker are
+# leased again once it runs out
+DISTRIBUTED_LEASE_SECS = 300
+DISTRIBUTED_LEASE_BATCH = 16
+DISTRIBUTED_MAX_ATTEMPTS = 3
+DISTRIBUTED_POLL_SECS = 5
+# DISTRIBUTED_WORKER_ID = "worker-1"  # default: hostname and pid
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    'tutorial.middlewares.TutorialDownloaderMiddleware': 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    # after RedirectMiddleware (600) in the response chain, so it sees captcha redirects
+    "dragon_talon.middelwares.AdaptiveThrottleMiddleware": 650,
+    # before the throttle in the response chain: it quarantines the session of a blocked
+    # response, the throttle's retry then goes out through another one
+    "dragon_talon.middelwares.ProxySessionPoolMiddleware": 660,
+    # before both in the response chain: a redirect to the login page of a logged-in
+    # request means an expired session, not a block
+    "dragon_talon.middelwares.AccountPoolMiddleware": 670,
+}
+
+# Proxy/session pool, off while PROXY_POOL is empty. Each entry ("direct" for no proxy)
+# gets its own cookie jar, User-Agent and downloader slot per host, so DOWNLOAD_DELAY and
+# CONCURRENT_REQUESTS_PER_DOMAIN (and the adaptive throttle) apply per proxy.
+PROXY_POOL = []
+PROXY_POOL_USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/87.0.4280.141 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+    "Version/14.0.2 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:84.0) Gecko/20100101 Firefox/84.0",
+]
+# doubled at each consecutive strike, up to the max
+PROXY_POOL_QUARANTINE_SECS = 600
+PROXY_POOL_MAX_QUARANTINE_SECS = 6 * 3600
+# consecutive download errors/5xx quarantining a session
+PROXY_POOL_MAX_FAILURES = 3
+
+# Adaptive per-subdomain throttling, starts from DOWNLOAD_DELAY and
+# CONCURRENT_REQUESTS_PER_DOMAIN, backs off on anti-bot signals and ramps up otherwise
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_THROTTLE_MIN_DELAY = 1.0
+ADAPTIVE_THROTTLE_MAX_DELAY = 120.0
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = 4
+ADAPTIVE_THROTTLE_BACKOFF_FACTOR = 4.0
+ADAPTIVE_THROTTLE_RAMP_INTERVAL = 20
+ADAPTIVE_THROTTLE_MAX_RETRIES = 3
+ADAPTIVE_THROTTLE_BLOCK_URL_MARKERS = ["captcha", "login", "verify"]
+
+# Logged-in account pool for the chengjiao (deal history) pages, off while
+# LIANJIA_ACCOUNTS_FILE is unset. The file holds one "username:password" per line; each
+# account keeps its own cookie jar and sends one request every LIANJIA_ACCOUNT_DELAY
+# seconds. Crawl the deals with -a chengjiao=1.
+LIANJIA_ACCOUNTS_FILE = None
+LIANJIA_LOGIN_URL = "https://clogin.lianjia.com/login/"
+LIANJIA_ACCOUNT_DELAY = 10.0
+# a login succeeded when its answer sets this session cookie; unset: when it answers
+# 2xx or redirects elsewhere than a login page
+LIANJIA_LOGIN_COOKIE = "lianjia_token"
+# logins again after an expired session before the request gives up
+LIANJIA_ACCOUNT_MAX_RELOGINS = 2
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+# dragon_talon.pipelines.AsyncMongoPipeline can replace MongoPipeline to write through
+# motor on the asyncio reactor instead of the threadpool (pip install dragon_talon[motor])
 ITEM_PIPELINES = {
+    "dragon_talon.pipelines.ChangeDetectionPipeline": 250,
     "dragon_talon.pipelines.MongoPipeline": 300,
+    "dragon_talon.pipelines.ParquetPipeline": 400,
 }
+# A collection is flushed once it buffers MONGO_BATCH_SIZE documents or its oldest
+# buffered document is MONGO_FLUSH_INTERVAL_MS old, whichever comes first.
+MONGO_BATCH_SIZE = 500
+MONGO_FLUSH_INTERVAL_MS = 1000
+# Items are held back (process_item returns a pending Deferred) above this many
+# buffered plus in-flight documents
+MONGO_MAX_PENDING_ITEMS = 5000
+# "upsert": replace documents by the item's natural_key, re-crawls overwrite stale values
+# "insert": insert_many and drop duplicates of the unique indexes
+MONGO_WRITE_MODE = "upsert"
+# Encode documents to BSON as items arrive: buffered batches take less memory and the
+# writer thread only ships bytes, at the cost of encoding on the reactor thread
+MONGO_ENCODE_BSON = False
+# "document": one document per day and xiaoqu/house (natural_key)
+# "bucket": xiaoqu_daily_stats and for_sale go to {item_name}_monthly, one document per
+# xiaoqu/house and month, listing attributes once and the daily fields per day
+MONGO_STORAGE_LAYOUT = "document"
+# Daily count/mean/median of the for_sale ask_avg_price per xiaoqu, area and district in
+# price_rollup_daily, $inc'ed as new listings are written (document layout only, not
+# with change detection, whose unchanged listings carry no prices); the median is
+# interpolated in histogram buckets of MONGO_ROLLUP_PRICE_BUCKET yuan/m2. Off by default,
+# an extra write per batch; the /prices endpoint of dragon_talon.web reads them
+MONGO_PRICE_ROLLUPS = False
+MONGO_ROLLUP_PRICE_BUCKET = 500
+# AsyncMongoPipeline only: concurrent insert_many/bulk_write calls across all collections
+MONGO_MAX_INFLIGHT_WRITES = 4
+# With CHANGE_DETECTION_INDEX_PATH set, ForSale listings unchanged since the last crawl
+# are stored as for_sale_heartbeat documents, new/changed/delisted ones add a
+# listing_event document, upserted by the change detection pipeline itself in batches of
+# MONGO_BATCH_SIZE (delisted: only by a finished crawl, for the xiaoqus whose list pages
+# were all parsed)
+# CHANGE_DETECTION_INDEX_PATH = "frontier/listing_index.sqlite"
+# Items are also streamed to date-partitioned parquet files when PARQUET_EXPORT_DIR
+# is set (needs pyarrow, pip install dragon_talon[parquet])
+# PARQUET_EXPORT_DIR = "parquet"
+PARQUET_BATCH_SIZE = 10000
+PARQUET_MAX_FILE_MB = 128
+PARQUET_COMPRESSION = "zstd"
 
 # Enable and configure the AutoThrottle extension (disabled by default)
+# Superseded by AdaptiveThrottleMiddleware, do not enable both
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 AUTOTHROTTLE_ENABLED = False
 # # The initial download delay
@@ -70,16 +219,59 @@ AUTOTHROTTLE_ENABLED = False
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 HTTPCACHE_ENABLED = True
-HTTPCACHE_EXPIRATION_SECS = 30 * 60
+# retention of cached responses, the freshness of each page type is up to the policy
+HTTPCACHE_EXPIRATION_SECS = 30 * 24 * 3600
 HTTPCACHE_DIR = "httpcache"
 HTTPCACHE_IGNORE_HTTP_CODES = []
-HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+# one sqlite file per spider with zstd compressed responses, expired ones are evicted in
+# bulk when the spider opens (zstd needs pip install dragon_talon[httpcache], else zlib)
+HTTPCACHE_STORAGE = "dragon_talon.httpcache.SqliteCacheStorage"
+HTTPCACHE_ZSTD_LEVEL = 3
+# per page type TTLs in seconds, or "daily" for pages fresh until the end of the crawl
+# day; requests may set meta cache_ttl, or cache_policy "refresh" / "prefer". Redirects
+# and blocked pages (see ADAPTIVE_THROTTLE_BLOCK_URL_MARKERS) are never stored
+HTTPCACHE_POLICY = "dragon_talon.httpcache.PageTypeCachePolicy"
+HTTPCACHE_DEFAULT_TTL_SECS = 30 * 60
+HTTPCACHE_CALLBACK_TTLS = {
+    "_parse_home": 7 * 24 * 3600,
+    "_parse_disctrict_first_page": "daily",
+    "_parse_district_page": "daily",
+    "_parse_ershoufang": "daily",
+    "_parse_chengjiao": "daily",
+    "_parse_api_communities": "daily",
+    "_parse_api_ershoufang": "daily",
+    "_parse_xiaoqu": 30 * 24 * 3600,
+}
+# url regex -> TTL, checked before the callbacks
+HTTPCACHE_URL_TTLS = {}
 
 # Spidermon is a framework to build monitors for Scrapy spiders.
 # SPIDERMON_ENABLED = True
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#     'spidermon.contrib.scrapy.extensions.Spidermon': 500,
-# }
+EXTENSIONS = {
+    # 'spidermon.contrib.scrapy.extensions.Spidermon': 500,
+    "dragon_talon.metrics.CrawlMetrics": 500,
+}
+
+# Parse, pipeline, Mongo write and download latency histograms plus items per type,
+# served for Prometheus on http://METRICS_HOST:METRICS_PORT/metrics (0: any free port)
+# and summarized in the log when the spider closes
+METRICS_ENABLED = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9410
+
+# Read-side query service, python -m dragon_talon.web (see dragon_talon.web)
+WEB_HOST = "127.0.0.1"
+WEB_PORT = 8410
+# default and largest page of the paged endpoints, streamed WEB_STREAM_BATCH documents
+# at a time
+WEB_PAGE_SIZE = 100
+WEB_MAX_PAGE_SIZE = 1000
+WEB_STREAM_BATCH = 200
+# LRU cache of responses, keyed by request and latest crawl, dropped when a newer crawl
+# is recorded by MongoPipeline (checked at most every WEB_CRAWL_POLL_SECONDS)
+WEB_CACHE_SIZE = 1024
+WEB_CACHE_TTL = 300
+WEB_CRAWL_POLL_SECONDS = 5
@@ -0,0 +1,11 @@
+# Sent (with send_catch_log_deferred) before the frontier marks parsed requests as done,
+# handlers return a Deferred that fires once every item received so far is persisted
+checkpoint = object()
+
+# Sent by PageParsedMiddleware (response, spider) once a callback has run through its
+# output without raising
+page_parsed = object()
+
+# Sent by the lianjia spider (xiaoqu_id, spider) once every list page of the listings
+# on sale of a xiaoqu was parsed in this process, ChangeDetectionPipeline delists on it
+listings_complete = object()
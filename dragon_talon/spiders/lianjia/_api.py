@@ -0,0 +1,140 @@
+"""Listing data from the JSON list endpoints of the lianjia app
+
+The app pages the xiaoqu (community) and for-sale lists by offset, up to 100 entries a
+request, in a few hundred bytes per entry instead of the 1.5KB+ of the desktop pages::
+
+    GET {LIANJIA_API_URL}/house/community/search?city_id=310000&condition=pudong/su1y4bp5ep10000
+        &offset=0&limit=100
+    GET {LIANJIA_API_URL}/house/ershoufang/search?city_id=310000&condition=c5011000010000
+        &offset=0&limit=100
+
+    {"errno": 0, "error": "", "data": {"total_count": 412, "list": [{...}, ...]}}
+
+``condition`` is the filter part of the desktop url. The entries map onto the same
+items as the HTML parsers, see tests/fixtures/lianjia/api_*.json.
+"""
+
+import json
+from collections import Counter
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+from urllib.parse import urlencode
+
+from ... import items
+from ._parsers import XiaoquListEntry, _count_dropped
+
+CITY_IDS = {
+    "bj": 110000,
+    "sh": 310000,
+    "sz": 440300,
+}
+COMMUNITY_PATH = "/house/community/search"
+ERSHOUFANG_PATH = "/house/ershoufang/search"
+
+# listing tags -> ForSale.five_years_status, in the precedence of the HTML parsers
+_YEARS_TAGS = (("满两年", 2), ("满五年", 5))
+
+
+class ApiError(ValueError):
+    """The endpoint answered without a list, the HTML pages are used instead"""
+
+
+class ApiPage(NamedTuple):
+    total_count: int
+    entries: list
+
+
+def list_url(api_url: str, path: str, city: str, condition: str, offset: int, limit: int) -> str:
+    query = {"city_id": CITY_IDS[city], "condition": condition, "offset": offset, "limit": limit}
+    return f"{api_url}{path}?{urlencode(query)}"
+
+
+def parse_page(body: bytes) -> ApiPage:
+    try:
+        payload = json.loads(body)
+    except ValueError as exc:
+        raise ApiError(f"not json: {exc}") from None
+    if not isinstance(payload, dict) or payload.get("errno") != 0:
+        raise ApiError(f"errno {payload.get('errno') if isinstance(payload, dict) else None}")
+    data = payload.get("data") or {}
+    entries = data.get("list")
+    if not isinstance(entries, list):
+        raise ApiError("no list in data")
+    return ApiPage(int(data.get("total_count", len(entries))), entries)
+
+
+def parse_communities(
+    page: ApiPage, site_url: str, date_: datetime, dropped: Optional[Counter] = None
+) -> List[XiaoquListEntry]:
+    entries = []
+    for community in page.entries:
+        try:
+            xiaoqu_id = str(community["community_id"])
+            name = community["community_name"]
+        except KeyError:
+            continue
+        built_year = community.get("building_finish_year")
+        try:
+            daily_stats: Optional[items.XiaoquDailyStats] = items.XiaoquDailyStats(
+                date_=date_,
+                xiaoqu_id=xiaoqu_id,
+                name=name,
+                for_rent=int(community["rent_num"]),
+                on_sale_count=int(community["sell_num"]),
+                deal_in_90days=int(community["deal_num_90"]),
+                ask_avg_price=int(community["avg_unit_price"]),
+            )
+        except (KeyError, TypeError, ValueError):
+            daily_stats = None
+        entries.append(
+            XiaoquListEntry(
+                xiaoqu_id=xiaoqu_id,
+                name=name,
+                district=community.get("district_name"),
+                area=community.get("bizcircle_name"),
+                built_year=int(built_year) if built_year else None,
+                tags=list(community.get("tags") or ()),
+                detail_url=f"{site_url}/xiaoqu/{xiaoqu_id}/",
+                ershoufang_url=f"{site_url}/ershoufang/c{xiaoqu_id}/",
+                daily_stats=daily_stats,
+            )
+        )
+    _count_dropped(dropped, "xiaoqu", len(page.entries), len(entries))
+    return entries
+
+
+def parse_ershoufang(
+    page: ApiPage,
+    date_: datetime,
+    xiaoqu_id: str,
+    xiaoqu_name: str,
+    dropped: Optional[Counter] = None,
+) -> List[items.ForSale]:
+    for_sales = []
+    for house in page.entries:
+        tags = house.get("tags") or ()
+        five_years_status = next((status for tag, status in _YEARS_TAGS if tag in tags), 0)
+        try:
+            for_sale = items.ForSale(
+                house_id=int(house["house_code"]),
+                date_=date_,
+                description=house["title"],
+                room_type=house["frame"],
+                total_area=float(house["area"]),
+                towards=house["orientation"],
+                decoration=house["decoration"],
+                floor_location=house["floor_state"],
+                building_type=house["building_type"],
+                five_years_status=five_years_status,
+                ask_total_w=int(float(house["total_price"])),
+                ask_avg_price=int(house["unit_price"]),
+                ask_duration_days=int(house.get("list_days") or 0),
+                num_of_followers=int(house.get("follow_count") or 0),
+                xiaoqu_id=xiaoqu_id,
+                xiaoqu_name=xiaoqu_name,
+            )
+        except (KeyError, TypeError, ValueError):
+            continue
+        for_sales.append(for_sale)
+    _count_dropped(dropped, "ershoufang", len(page.entries), len(for_sales))
+    return for_sales
@@ -1,12 +1,24 @@
-import json
+import asyncio
+import multiprocessing
 import re
-import urllib
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Callable, Dict, Optional, Set, Tuple
+from urllib.parse import urlparse
 
 import scrapy
+from loguru import logger
+from scrapy import signals as scrapy_signals
+from scrapy.utils.reactor import is_asyncio_reactor_installed
 
-from ... import items
+from ... import db, items, signals
+from ...dupefilter import SeenUrlIndex, compact_fingerprint
+from ...httpcache import CACHE_REFRESH
+from . import _api, _workers
+from ._parsers import CompiledParser, crawl_date
+from ._workers import ParsedPage
 
 
 class LianjiaSpider(scrapy.Spider):
@@ -18,6 +30,7 @@ class LianjiaSpider(scrapy.Spider):
         "sh",  # shanghai
         "sz",  # shenzhen
     }
+    _DISTRICT_PATTERN = re.compile(r"\/xiaoqu\/(\w+)\/su1.+")
     _DISTRICT_BLACKLIST = {
         "chongming",
         "shanghaizhoubian",
@@ -25,348 +38,432 @@ class LianjiaSpider(scrapy.Spider):
         "fengxian",
         "qingpu",
     }
+    # a district page without listings is an anti-bot page, see AdaptiveThrottleMiddleware
+    _DISTRICT_PAGE_META = {"throttle_expect_marker": "xiaoquListItem"}
+    # deal history is only shown to logged-in users, see AccountPoolMiddleware
+    _CHENGJIAO_PAGE_META = {"login_required": True}
 
-    def __init__(self, city: str = "sh", *args, **kwargs):
+    def __init__(
+        self,
+        city: str = "sh",
+        cities: Optional[str] = None,
+        incremental: str = "0",
+        refresh_days: Optional[str] = None,
+        chengjiao: str = "0",
+        *args,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
-        assert city in self._CITY_SET, f"city should be in [self._CITY_SET]"
-        self._base_url = f"https://{city}.lianjia.com"
-        self._start_url = f"https://{city}.lianjia.com/xiaoqu/{self._SEARCH_CONDITION}"
+        # -a cities=bj,sh,sz crawls several cities in one process, each subdomain
+        # gets its own downloader slot so politeness limits apply per city
+        city_list = cities.split(",") if cities else [city]
+        for city_ in city_list:
+            assert city_ in self._CITY_SET, f"city should be in {self._CITY_SET}"
+        self._start_urls = [
+            f"https://{city_}.lianjia.com/xiaoqu/{self._SEARCH_CONDITION}" for city_ in city_list
+        ]
+        self._incremental = incremental.lower() in ("1", "true", "yes")
+        self._refresh_days = int(refresh_days) if refresh_days is not None else None
+        # xiaoqu whose detail page was crawled within the refresh age
+        self._fresh_xiaoqu_ids: Set[str] = set()
+        self._chengjiao = chengjiao.lower() in ("1", "true", "yes")
+        # xiaoqu id -> date of its newest stored transaction
+        self._newest_deal_dates: Dict[str, datetime] = {}
+        self._seen_url_index: Optional[SeenUrlIndex] = None
+        # LIANJIA_FETCH_MODE = "api": list pages come from the app's JSON endpoints
+        self._api_url: Optional[str] = None
+        self._api_page_size = 100
+        # LIANJIA_PARSE_WORKERS > 0: pages are parsed in a process pool, off the reactor
+        self._parse_workers = 0
+        self._parse_pool: Optional[ProcessPoolExecutor] = None
+        # (xiaoqu id, "html" or "api") -> its number of list pages and the pages parsed,
+        # see _listing_page_parsed
+        self._key2total_pages: Dict[Tuple[str, str], int] = {}
+        self._key2parsed_pages: Dict[Tuple[str, str], Set[int]] = {}
+        self._listed_xiaoqu_ids: Set[str] = set()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        seen_url_index_path = crawler.settings.get("SEEN_URL_INDEX_PATH")
+        if seen_url_index_path:
+            spider._seen_url_index = SeenUrlIndex(seen_url_index_path)
+        if crawler.settings.get("LIANJIA_FETCH_MODE", "html") == "api":
+            spider._api_url = crawler.settings.get("LIANJIA_API_URL")
+            spider._api_page_size = crawler.settings.getint("LIANJIA_API_PAGE_SIZE", 100)
+        spider._parse_workers = crawler.settings.getint("LIANJIA_PARSE_WORKERS", 0)
+        if spider._parse_workers > 0 and not is_asyncio_reactor_installed():
+            logger.warning("LIANJIA_PARSE_WORKERS needs the asyncio reactor, parsing inline")
+            spider._parse_workers = 0
+        if spider._chengjiao and not crawler.settings.get("LIANJIA_ACCOUNTS_FILE"):
+            logger.warning("chengjiao pages need a login, LIANJIA_ACCOUNTS_FILE is not set")
+        crawler.signals.connect(spider._spider_opened, signal=scrapy_signals.spider_opened)
+        return spider
+
+    def _spider_opened(self, spider):
+        # also for a crawl resumed by FrontierMiddleware, whose start requests are not read
+        if self._incremental:
+            self._load_fresh_xiaoqu_ids()
+        if self._chengjiao:
+            self._load_newest_deal_dates()
+
+    def closed(self, reason):
+        if self._seen_url_index is not None:
+            self._seen_url_index.close()
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
 
     def start_requests(self):
-        yield scrapy.Request(url=self._start_url, callback=self._parse_home)
+        for start_url in self._start_urls:
+            yield scrapy.Request(url=start_url, callback=self._parse_home, dont_filter=True)
+
+    def _load_fresh_xiaoqu_ids(self):
+        refresh_days = self._refresh_days
+        if refresh_days is None:
+            refresh_days = self.settings.getint("XIAOQU_REFRESH_DAYS", 30)
+        refresh_after = datetime.now(timezone.utc) - timedelta(days=refresh_days)
+        mongo_cli = db.get_mongo_client()
+        try:
+            xiaoqu_info_col = mongo_cli.get_database(db.DB_NAME).get_collection(
+                items.XiaoquInfo.item_name
+            )
+            cursor = xiaoqu_info_col.find(
+                {"crawled_at": {"$gte": refresh_after}}, projection={"xiaoqu_id": 1, "_id": 0}
+            )
+            self._fresh_xiaoqu_ids = {doc["xiaoqu_id"] for doc in cursor}
+        finally:
+            mongo_cli.close()
+        logger.info(
+            f"incremental mode: {len(self._fresh_xiaoqu_ids)} xiaoqu crawled "
+            f"within {refresh_days} days will be skipped"
+        )
+
+    def _load_newest_deal_dates(self):
+        mongo_cli = db.get_mongo_client()
+        try:
+            transaction_col = mongo_cli.get_database(db.DB_NAME).get_collection(
+                items.Transaction.item_name
+            )
+            # walks the (xiaoqu_id, date_) index
+            cursor = transaction_col.aggregate(
+                [
+                    {"$sort": {"xiaoqu_id": 1, "date_": -1}},
+                    {"$group": {"_id": "$xiaoqu_id", "newest": {"$first": "$date_"}}},
+                ]
+            )
+            self._newest_deal_dates = {doc["_id"]: doc["newest"] for doc in cursor}
+        finally:
+            mongo_cli.close()
+        logger.info(
+            f"chengjiao: {len(self._newest_deal_dates)} xiaoqu with stored transactions "
+            "will only be crawled up to their newest deal"
+        )
 
     def _parse_home(self, response: scrapy.http.HtmlResponse):
-        districts = response.xpath("//div[@data-role='ershoufang']/div[1]/a")
-        pattern = re.compile(r"\/xiaoqu\/(\w+)\/su1.+")
-        districts2fo = []
-        for dist in districts:
-            follow_path = dist.xpath("@href").get()
-            m = pattern.match(follow_path)
-            if m:
-                district_str = m.group(1)
-                if district_str not in self._DISTRICT_BLACKLIST:
-                    districts2fo.append(dist)
-            else:
-                continue
-        yield from response.follow_all(districts2fo, callback=self._parse_disctrict_first_page)
+        district_paths = []
+        for follow_path in CompiledParser.parse_home(response.selector):
+            m = self._DISTRICT_PATTERN.match(follow_path)
+            if m and m.group(1) not in self._DISTRICT_BLACKLIST:
+                district_paths.append(follow_path)
+        for district_path in district_paths:
+            district_url = response.urljoin(district_path)
+            api_request = self._api_request(district_url, offset=0)
+            yield api_request or self._district_request(district_url)
+
+    def _district_request(self, district_url: str) -> scrapy.Request:
+        return scrapy.Request(
+            district_url, callback=self._parse_disctrict_first_page, meta=self._DISTRICT_PAGE_META
+        )
 
     def _parse_disctrict_first_page(self, response: scrapy.http.HtmlResponse):
-        yield from self._parse_district_page(response)
-        page_box_node = response.xpath("//div[@class='page-box house-lst-page-box']")
-        page_path_fmt_str = page_box_node.xpath("@page-url").get()
-        page_data = page_box_node.xpath("@page-data").get()
-        page_data = json.loads(page_data)
-        total_page = page_data["totalPage"]
-        for page in range(2, total_page + 1):
-            page_path = page_path_fmt_str.format(page=page)
-            page_url = urllib.parse.urljoin(self._base_url, page_path)
-            yield scrapy.Request(url=page_url, callback=self._parse_district_page)
+        return self._parse(
+            response, _workers.DISTRICT, (crawl_date(),), self._follow_district_page, True
+        )
 
     def _parse_district_page(self, response: scrapy.http.HtmlResponse):
-        xiaoqu_nodes = response.xpath("//li[@class='clear xiaoquListItem']")
-        for xiaoqu_node in xiaoqu_nodes:
-            xiaoqu_id: Optional[str] = xiaoqu_node.xpath("@data-id").get()
-            if xiaoqu_id is None:
-                continue
-            try:
-                info_node = xiaoqu_node.xpath("div[@class='info']")[0]
-                pos_info = info_node.xpath("div[@class='positionInfo']")[0]
-            except IndexError:
-                continue
-            name = info_node.xpath("div[@class='title']/a/text()").get()
-            district = pos_info.xpath("a[@class='district']/text()").get()
-            area = pos_info.xpath("a[@class='bizcircle']/text()").get()
-            pos_info_txt = pos_info.get()
-            built_matched = re.search(r"(\d+)年建成", pos_info_txt)
-            built_year = built_matched.group(1) if built_matched else None
-            tags = info_node.xpath("div[@class='tagList']/span/text()").getall()
-            cb_kwargs = {
-                "xiaoqu_id": xiaoqu_id,
-                "name": name,
-                "district": district,
-                "area": area,
-                "built_year": int(built_year),
-                "tags": tags,
-            }
-            xiaoqu_daily_stats = self.__parse_xiaoqu_daily_stats(info_node, xiaoqu_id, name)
-            if xiaoqu_daily_stats:
-                yield xiaoqu_daily_stats
-            yield response.follow(
-                xiaoqu_node.xpath("a/@href").get(), callback=self._parse_xiaoqu, cb_kwargs=cb_kwargs
-            )
+        return self._parse(
+            response, _workers.DISTRICT, (crawl_date(),), self._follow_district_page, False
+        )
 
-    def __parse_xiaoqu_daily_stats(
-        self, xiaoqu_node, xiaoqu_id: str, xiaoqu_name: str
-    ) -> Optional[items.XiaoquDailyStats]:
-        houseinfo_nodes = xiaoqu_node.xpath("div[@class='houseInfo']/a")
-        for_rent = 0
-        deal_in_90days = 0
-        for houseinfo_node in houseinfo_nodes:
-            title = houseinfo_node.xpath("@title").get()
-            if title.endswith("网签"):
-                matched = re.match(r"90天成交(\d+)", houseinfo_node.xpath("text()").get())
-                deal_in_90days = matched.group(1) if matched else None
-            elif title.endswith("租房"):
-                matched = re.match(r"(\d+)套正在出租", houseinfo_node.xpath("text()").get())
-                for_rent = matched.group(1) if matched else None
-        ask_avg_price = xiaoqu_node.xpath(
-            "//div[@class='xiaoquListItemPrice']/div[@class='totalPrice']/span/text()"
-        ).get()
-        on_sale_count = xiaoqu_node.xpath("//a[@class='totalSellCount']/span/text()").get()
-        try:
-            return items.XiaoquDailyStats(
-                date_=datetime.utcnow().replace(
-                    hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone(timedelta(hours=8))
-                ),
-                xiaoqu_id=xiaoqu_id,
-                name=xiaoqu_name,
-                for_rent=int(for_rent),
-                on_sale_count=int(on_sale_count),
-                deal_in_90days=int(deal_in_90days),
-                ask_avg_price=int(ask_avg_price),
-            )
-        except (TypeError, ValueError):
-            return None
+    def _parse(
+        self,
+        response: scrapy.http.HtmlResponse,
+        kind: str,
+        args: Tuple,
+        follow: Callable,
+        *follow_args,
+    ):
+        """Parse the page into a ParsedPage, inline or in the process pool, and follow it"""
+        if self._parse_workers > 0:
+            return self._parse_in_pool(response, kind, args, follow, follow_args)
+        return self._parse_inline(response, kind, args, follow, follow_args)
 
-    __XIAOQU_LABEL_TO_FIELD_NAME = {
-        "建筑类型": "building_type",
-        "物业费用": "management_fee",
-        "物业公司": "prop_manager",
-        "开发商": "prop_developer",
-        "楼栋总数": "num_of_buildings",
-        "房屋总数": "num_of_units",
-    }
+    def _parse_inline(self, response, kind: str, args: Tuple, follow: Callable, follow_args):
+        # a generator, so that ParseTimingMiddleware counts the parsing
+        parsed = _workers.parse_selector(kind, response.selector, args)
+        yield from follow(response, parsed, *follow_args)
 
-    def __fill_label_content(self, xiaoqu_label: str, xiaoqu_content: str, item_kwargs: dict):
-        field_name = self.__XIAOQU_LABEL_TO_FIELD_NAME.get(xiaoqu_label)
-        if field_name is None:
+    async def _parse_in_pool(self, response, kind: str, args: Tuple, follow: Callable, follow_args):
+        if self._parse_pool is None:
+            # workers do not inherit the reactor, its threads and their locks
+            self._parse_pool = ProcessPoolExecutor(
+                self._parse_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        started = time.perf_counter()
+        future = self._parse_pool.submit(
+            _workers.parse_body,
+            kind,
+            response.url,
+            response.body,
+            response.encoding,
+            args,
+        )
+        parsed = _workers.restore(kind, await asyncio.wrap_future(future))
+        outputs = list(follow(response, parsed, *follow_args))
+        # ParseTimingMiddleware only gets the finished list
+        response.meta["parse_seconds"] = time.perf_counter() - started
+        return outputs
+
+    def _follow_district_page(self, response, parsed: ParsedPage, first_page: bool):
+        site_url = _site_url(response.url)
+        yield from self._follow_district_entries(response, site_url, parsed.result, parsed.dropped)
+        self._count_dropped(parsed.dropped)
+        page_box = parsed.page_box
+        if not first_page or page_box is None:
             return
-        if field_name == "num_of_buildings" or field_name == "num_of_units":
-            num_matched = re.match(r"(\d+).*", xiaoqu_content)
-            if num_matched:
-                item_kwargs[field_name] = int(num_matched.group(1))
+        for page in range(2, page_box.total_page + 1):
+            page_url = response.urljoin(page_box.page_url.format(page=page))
+            yield scrapy.Request(
+                url=page_url, callback=self._parse_district_page, meta=self._DISTRICT_PAGE_META
+            )
+
+    def _follow_district_entries(
+        self, response: scrapy.http.Response, site_url: str, entries: list, dropped: Counter
+    ):
+        for entry in entries:
+            xiaoqu_daily_stats = entry.daily_stats
+            if xiaoqu_daily_stats:
+                yield xiaoqu_daily_stats
             else:
-                item_kwargs[field_name] = -1
-        else:
-            item_kwargs[field_name] = xiaoqu_content
+                dropped["xiaoqu_daily_stats"] += 1
+            detail_request = None
+            if entry.detail_url is not None:
+                cb_kwargs = {
+                    "xiaoqu_id": entry.xiaoqu_id,
+                    "name": entry.name,
+                    "district": entry.district,
+                    "area": entry.area,
+                    "built_year": entry.built_year,
+                    "tags": entry.tags,
+                }
+                # the incremental mode re-crawls a detail page because it is out of date,
+                # a cached copy of it would be as well
+                meta = {"cache_policy": CACHE_REFRESH} if self._incremental else None
+                detail_request = response.follow(
+                    entry.detail_url, callback=self._parse_xiaoqu, cb_kwargs=cb_kwargs, meta=meta
+                )
+            if entry.xiaoqu_id in self._fresh_xiaoqu_ids or self._is_seen(detail_request):
+                # skip the unchanged detail page, but still collect its listings
+                self.crawler.stats.inc_value("lianjia/xiaoqu_detail_skipped")
+                xiaoqu_info = {"xiaoqu_id": entry.xiaoqu_id, "xiaoqu_name": entry.name}
+                if self._chengjiao:
+                    yield self._chengjiao_request(
+                        response, f"{site_url}/chengjiao/c{entry.xiaoqu_id}/", xiaoqu_info
+                    )
+                if xiaoqu_daily_stats and xiaoqu_daily_stats.on_sale_count > 0:
+                    yield self._ershoufang_request(
+                        response,
+                        entry.ershoufang_url or f"{site_url}/ershoufang/c{entry.xiaoqu_id}/",
+                        xiaoqu_info,
+                    )
+            elif detail_request is not None:
+                yield detail_request
+
+    def _count_dropped(self, dropped: Counter):
+        """Listings the parser skipped, exposed by CrawlMetrics"""
+        for kind, count in dropped.items():
+            self.crawler.stats.inc_value(f"lianjia/dropped/{kind}", count)
+
+    def _is_seen(self, request: Optional[scrapy.Request]) -> bool:
+        """Whether the seen url index would filter the request, see SeenUrlDupeFilter"""
+        if request is None or self._seen_url_index is None:
+            return False
+        return self._seen_url_index.is_fresh(compact_fingerprint(request), time.time())
 
     def _parse_xiaoqu(self, response: scrapy.http.HtmlResponse, **kwargs):
-        xiaoqu_info_items = response.xpath("//div[@class='xiaoquInfoItem']")
-        for info_item in xiaoqu_info_items:
-            info_label = info_item.xpath("span[@class='xiaoquInfoLabel']/text()").get()
-            if info_label == "附近门店":
-                xiaoqu_latitude = info_item.xpath(
-                    "span[@class='xiaoquInfoContent']/span/@xiaoqu"
-                ).get()
-                try:
-                    north_latitude, east_latitude = json.loads(xiaoqu_latitude)
-                except TypeError:
-                    continue
-                else:
-                    kwargs["north_latitude"] = north_latitude
-                    kwargs["east_latitude"] = east_latitude
-            else:
-                info_content = info_item.xpath("span[@class='xiaoquInfoContent']/text()").get()
-                self.__fill_label_content(info_label, info_content, kwargs)
+        return self._parse(response, _workers.XIAOQU, (), self._follow_xiaoqu, kwargs)
+
+    def _follow_xiaoqu(self, response, parsed: ParsedPage, kwargs: dict):
+        xiaoqu_detail = parsed.result
+        kwargs.update(xiaoqu_detail.fields)
+        kwargs["crawled_at"] = datetime.now(timezone.utc)
         yield items.XiaoquInfo(**kwargs)
         xiaoqu_info = {"xiaoqu_id": kwargs["xiaoqu_id"], "xiaoqu_name": kwargs["name"]}
-        # TODO: need login
-        # chengjiao_url = response.xpath("//div[@id='frameDeal']/a/@href").get()
-        # if chengjiao_url:
-        #     yield response.follow(chengjiao_url, self._parse_chengjiao, cb_kwargs=xiaoqu_info)
-        ershoufang_url = response.xpath("//div[@class='goodSellHeader clear']/a/@href").get()
-        if ershoufang_url:
-            yield response.follow(ershoufang_url, self._parse_ershoufang, cb_kwargs=xiaoqu_info)
+        if self._chengjiao and xiaoqu_detail.chengjiao_url:
+            yield self._chengjiao_request(response, xiaoqu_detail.chengjiao_url, xiaoqu_info)
+        if xiaoqu_detail.ershoufang_url:
+            yield self._ershoufang_request(response, xiaoqu_detail.ershoufang_url, xiaoqu_info)
+
+    def _ershoufang_request(self, response: scrapy.http.Response, url: str, xiaoqu_info: dict):
+        url = response.urljoin(url)
+        api_request = self._api_request(url, offset=0, **xiaoqu_info)
+        return api_request or scrapy.Request(url, self._parse_ershoufang, cb_kwargs=xiaoqu_info)
+
+    def _chengjiao_request(self, response: scrapy.http.HtmlResponse, url: str, xiaoqu_info: dict):
+        return response.follow(
+            url, self._parse_chengjiao, cb_kwargs=xiaoqu_info, meta=self._CHENGJIAO_PAGE_META
+        )
 
     def _parse_chengjiao(self, response: scrapy.http.HtmlResponse, **kwargs):
-        all_li_nodes = response.xpath("//ul[@class='listContent']/li")
-        for li_node in all_li_nodes:
-            trans_url = li_node.xpath("a/@href").get()
-            house_id_matched = re.search(r"/(\d+).html", trans_url)
-            if not house_id_matched:
-                continue
-            try:
-                house_id = int(house_id_matched.group(1))
-            except ValueError:
-                continue
-            trans_node = li_node.xpath("div[@class='info']")
-            title = trans_node.xpath("div[@class='title']/a/text()").get()
-            splitted_title = title.split()
-            if len(splitted_title) < 3 or splitted_title[1] == "车位":
-                continue
-            room_type = splitted_title[1]
-            total_area_matched = re.match(r"(\d+\.{0,1}\d*)平米", splitted_title[2])
-            if not total_area_matched:
-                continue
-            total_area = float(total_area_matched.group(1))
-            address_node = trans_node.xpath("div[@class='address']")
-            houseinfo_text = address_node.xpath("div[@class='houseInfo']/text()").get()
-            towards, decoration = houseinfo_text.split("|")
-            towards = towards.strip()
-            decoration = decoration.strip()
-
-            trans_date_str = address_node.xpath("div[@class='dealDate']/text()").get()
-            trans_date = datetime.strptime(trans_date_str, "%Y.%m.%d")
-            trans_date = trans_date.replace(tzinfo=timezone(timedelta(hours=8)))
-
-            delt_total_w = address_node.xpath(
-                "div[@class='totalPrice']/span[@class='number']/text()"
-            ).get()
-            try:
-                delt_total_w = int(delt_total_w)
-            except ValueError:
-                continue
-            flood_node = trans_node.xpath("div[@class='flood']")
-            positioninfo_text = flood_node.xpath("div[@class='positionInfo']/text()").get()
-            floor_location, building_type = positioninfo_text.split()
-            delt_avg_price = flood_node.xpath(
-                "div[@class='unitPrice']/span[@class='number']/text()"
-            ).get()
-            try:
-                delt_avg_price = int(delt_avg_price)
-            except ValueError:
-                continue
-            deal_cycle_node = trans_node.xpath(
-                "div[@class='dealCycleeInfo']/span[@class='dealCycleTxt']"
+        args = (kwargs["xiaoqu_id"], kwargs["xiaoqu_name"])
+        return self._parse(response, _workers.CHENGJIAO, args, self._follow_chengjiao, kwargs)
+
+    def _follow_chengjiao(self, response, parsed: ParsedPage, xiaoqu_info: dict):
+        transactions = parsed.result
+        self._count_dropped(parsed.dropped)
+        page_box = parsed.page_box
+        newest = self._newest_deal_dates.get(xiaoqu_info["xiaoqu_id"])
+        if newest is None:
+            yield from transactions
+            yield from self._follow_allpages(
+                response, page_box, self._parse_chengjiao, xiaoqu_info, self._CHENGJIAO_PAGE_META
+            )
+            return
+        # deals are listed newest first: page on until the stored ones are reached,
+        # deals of the newest stored day may have been published after the last crawl
+        yield from (transaction for transaction in transactions if transaction.date_ >= newest)
+        if page_box is None or page_box.cur_page >= page_box.total_page:
+            return
+        if transactions and all(transaction.date_ > newest for transaction in transactions):
+            yield response.follow(
+                page_box.page_url.format(page=page_box.cur_page + 1),
+                self._parse_chengjiao,
+                cb_kwargs=xiaoqu_info,
+                meta=self._CHENGJIAO_PAGE_META,
+            )
+        else:
+            self.crawler.stats.inc_value(
+                "lianjia/chengjiao_pages_skipped", page_box.total_page - page_box.cur_page
             )
-            deal_cycle_txts = deal_cycle_node.xpath("span/text()").getall()
-            if len(deal_cycle_txts) < 2:
-                continue
-            ask_price_matched = re.match(r"挂牌(\d+)万", deal_cycle_txts[0])
-            ask_duration_matched = re.match(r"成交周期(\d+)天", deal_cycle_txts[1])
-            if not ask_price_matched or not ask_duration_matched:
-                continue
-            try:
-                ask_total_w = int(ask_price_matched.group(1))
-                ask_duration_days = int(ask_duration_matched.group(1))
-            except ValueError:
-                continue
-            yield items.Transaction(
-                house_id=house_id,
-                date_=trans_date,
-                towards=towards,
-                decoration=decoration,
-                room_type=room_type,
-                total_area=total_area,
-                floor_location=floor_location,
-                building_type=building_type,
-                delt_avg_price=delt_avg_price,
-                delt_total_w=delt_total_w,
-                ask_total_w=ask_total_w,
-                ask_duration_days=ask_duration_days,
-                xiaoqu_id=kwargs["xiaoqu_id"],
-                xiaoqu_name=kwargs["xiaoqu_name"],
+
+    def _parse_ershoufang(self, response: scrapy.http.HtmlResponse, **kwargs):
+        args = (crawl_date(), kwargs["xiaoqu_id"], kwargs["xiaoqu_name"])
+        return self._parse(response, _workers.ERSHOUFANG, args, self._follow_ershoufang, kwargs)
+
+    def _follow_ershoufang(self, response, parsed: ParsedPage, xiaoqu_info: dict):
+        yield from parsed.result
+        self._count_dropped(parsed.dropped)
+        page_box = parsed.page_box
+        # a list without page box is empty or an anti-bot page, it does not count
+        if page_box is not None:
+            self._listing_page_parsed(
+                xiaoqu_info["xiaoqu_id"], "html", page_box.cur_page, page_box.total_page
             )
-        yield from self._follow_allpages_in_chengjiao(response, xiaoqu_info=kwargs)
-
-    def _follow_allpages_in_chengjiao(self, response: scrapy.http.HtmlResponse, xiaoqu_info: dict):
-        page_box_node = response.xpath("//div[@class='page-box house-lst-page-box']")
-        page_data = page_box_node.xpath("@page-data").get()
-        page_data = json.loads(page_data)
-        total_page_count = page_data["totalPage"]
-        curr_page = page_data["curPage"]
-        if curr_page != 1:
+        yield from self._follow_allpages(response, page_box, self._parse_ershoufang, xiaoqu_info)
+
+    def _listing_page_parsed(self, xiaoqu_id: str, mode: str, page: int, total_page: int):
+        """Sends signals.listings_complete once every list page of the xiaoqu is parsed"""
+        key = (xiaoqu_id, mode)
+        self._key2total_pages[key] = total_page
+        parsed_pages = self._key2parsed_pages.setdefault(key, set())
+        parsed_pages.add(page)
+        if xiaoqu_id in self._listed_xiaoqu_ids or not parsed_pages.issuperset(
+            range(1, total_page + 1)
+        ):
+            return
+        self._listed_xiaoqu_ids.add(xiaoqu_id)
+        self.crawler.signals.send_catch_log(
+            signals.listings_complete, xiaoqu_id=xiaoqu_id, spider=self
+        )
+
+    def _follow_allpages(
+        self, response, page_box, callback: Callable, xiaoqu_info: dict, meta: Optional[dict] = None
+    ):
+        if page_box is None or page_box.cur_page != 1:
             return
-        path_url_format = page_box_node.xpath("@page-url").get()
-        path_urls = [path_url_format.format(page=i) for i in range(2, total_page_count + 1)]
+        path_urls = [page_box.page_url.format(page=i) for i in range(2, page_box.total_page + 1)]
         yield from response.follow_all(
-            path_urls, callback=self._parse_chengjiao, cb_kwargs=xiaoqu_info
+            path_urls, callback=callback, cb_kwargs=xiaoqu_info, meta=meta
         )
 
-    def _parse_ershoufang(self, response: scrapy.http.HtmlResponse, **kwargs):
-        sale_nodes = response.xpath("//div[@class='leftContent']/ul/li")
-        date_ = datetime.utcnow().replace(
-            hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone(timedelta(hours=8))
+    def _api_request(self, html_url: str, offset: int, **xiaoqu_info) -> Optional[scrapy.Request]:
+        """JSON list request standing for the desktop list page, None in the HTML mode
+
+        The desktop url and the offset travel in cb_kwargs, so that a failing endpoint
+        falls back to the HTML pages (see _html_fallback) even from a request queue.
+        """
+        city = urlparse(html_url).hostname.split(".")[0]
+        if self._api_url is None or city not in _api.CITY_IDS:
+            return None
+        path = urlparse(html_url).path
+        if xiaoqu_info:
+            endpoint, callback = _api.ERSHOUFANG_PATH, self._parse_api_ershoufang
+            condition = f"c{xiaoqu_info['xiaoqu_id']}"
+        else:
+            endpoint, callback = _api.COMMUNITY_PATH, self._parse_api_communities
+            condition = path.replace("/xiaoqu/", "", 1).strip("/")
+        return scrapy.Request(
+            _api.list_url(self._api_url, endpoint, city, condition, offset, self._api_page_size),
+            callback=callback,
+            errback=self._api_failed,
+            cb_kwargs={"html_url": html_url, "offset": offset, **xiaoqu_info},
         )
-        for sale_node in sale_nodes:
-            info_node = sale_node.xpath("div[@class='info clear']")
-            title_node = info_node.xpath("div[@class='title']")
-            detail_url = title_node.xpath("a/@href").get()
-            house_id_matched = re.search(r"/(\d+).html", detail_url)
-            if not house_id_matched:
-                continue
-            try:
-                house_id = int(house_id_matched.group(1))
-            except ValueError:
-                continue
-            description = title_node.xpath("a/text()").get()
-
-            houseinfo_txt = info_node.xpath(
-                "div[@class='address']/div[@class='houseInfo']/text()"
-            ).get()
-            splitted_houseinfo = houseinfo_txt.split("|")
-            (
-                room_type,
-                area_txt,
-                towards,
-                decoration,
-                floor_location,
-                *_,
-                building_type,
-            ) = [entry.strip() for entry in splitted_houseinfo]
-            total_area_matched = re.match(r"(\d+\.{0,1}\d*)平米", area_txt)
-            if not total_area_matched:
-                continue
-            total_area = float(total_area_matched.group(1))
-            tag_node = info_node.xpath("div[@class='tag']")
-            gt_2_years = tag_node.xpath("span[@class='five']").get()
-            gt_5_years = tag_node.xpath("span[@class='taxfree']").get()
-            if gt_2_years:
-                five_years_status = 2
-            elif gt_5_years:
-                five_years_status = 5
-            else:
-                five_years_status = 0
-            priceinfo_node = info_node.xpath("div[@class='priceInfo']")
-            total_price = int(
-                float(
-                    priceinfo_node.xpath("div[@class='totalPrice totalPrice2']/span/text()").get()
-                )
-            )
-            avg_price = int(priceinfo_node.xpath("div[@class='unitPrice']/@data-price").get())
-            followinfo_txt = info_node.xpath("div[@class='followInfo']/text()").get()
-            followers_txt, ask_duration_txt = followinfo_txt.split("/")
-            followers_matched = re.match(r"(\d+)人关注", followers_txt.strip())
-            if followers_matched:
-                num_of_followers = int(followers_matched.group(1))
-            else:
-                num_of_followers = 0
-            ask_duration_matched = re.match(r"(\d+)天以前发布", ask_duration_txt.strip())
-            if ask_duration_matched:
-                ask_duration_days = int(ask_duration_matched.group(1))
-            else:
-                ask_duration_days = 0
-
-            yield items.ForSale(
-                house_id=house_id,
-                date_=date_,
-                description=description,
-                room_type=room_type,
-                total_area=total_area,
-                towards=towards,
-                decoration=decoration,
-                floor_location=floor_location,
-                building_type=building_type,
-                five_years_status=five_years_status,
-                ask_total_w=total_price,
-                ask_avg_price=avg_price,
-                num_of_followers=num_of_followers,
-                ask_duration_days=ask_duration_days,
-                xiaoqu_id=kwargs["xiaoqu_id"],
-                xiaoqu_name=kwargs["xiaoqu_name"],
-            )
-        yield from self._follow_allpages_in_ershoufang(response, xiaoqu_info=kwargs)
-
-    def _follow_allpages_in_ershoufang(self, response: scrapy.http.HtmlResponse, xiaoqu_info: dict):
-        page_box_node = response.xpath("//div[@class='page-box house-lst-page-box']")
-        page_data = page_box_node.xpath("@page-data").get()
-        page_data = json.loads(page_data)
-        total_page_count = page_data["totalPage"]
-        curr_page = page_data["curPage"]
-        if curr_page != 1:
+
+    def _parse_api_communities(self, response: scrapy.http.Response, html_url: str, offset: int):
+        try:
+            page = _api.parse_page(response.body)
+        except _api.ApiError as exc:
+            yield self._html_fallback(response.request, exc)
             return
-        path_url_format = page_box_node.xpath("@page-url").get()
-        path_urls = [path_url_format.format(page=i) for i in range(2, total_page_count + 1)]
-        yield from response.follow_all(
-            path_urls, callback=self._parse_ershoufang, cb_kwargs=xiaoqu_info
+        dropped = Counter()
+        site_url = _site_url(html_url)
+        entries = _api.parse_communities(page, site_url, crawl_date(), dropped)
+        yield from self._follow_district_entries(response, site_url, entries, dropped)
+        self._count_dropped(dropped)
+        if offset == 0:
+            yield from self._follow_api_pages(page, html_url)
+
+    def _parse_api_ershoufang(
+        self, response: scrapy.http.Response, html_url: str, offset: int, **xiaoqu_info
+    ):
+        try:
+            page = _api.parse_page(response.body)
+        except _api.ApiError as exc:
+            yield self._html_fallback(response.request, exc)
+            return
+        dropped = Counter()
+        yield from _api.parse_ershoufang(
+            page, crawl_date(), xiaoqu_info["xiaoqu_id"], xiaoqu_info["xiaoqu_name"], dropped
         )
+        self._count_dropped(dropped)
+        self._listing_page_parsed(
+            xiaoqu_info["xiaoqu_id"],
+            "api",
+            offset // self._api_page_size + 1,
+            max(1, -(-page.total_count // self._api_page_size)),
+        )
+        if offset == 0:
+            yield from self._follow_api_pages(page, html_url, **xiaoqu_info)
+
+    def _follow_api_pages(self, page: _api.ApiPage, html_url: str, **xiaoqu_info):
+        for offset in range(self._api_page_size, page.total_count, self._api_page_size):
+            yield self._api_request(html_url, offset, **xiaoqu_info)
+
+    def _api_failed(self, failure):
+        yield self._html_fallback(failure.request, failure.value)
+
+    def _html_fallback(self, api_request: scrapy.Request, reason) -> scrapy.Request:
+        """First desktop page of the list, which follows all of its pages"""
+        self.crawler.stats.inc_value("lianjia/api_fallback")
+        kwargs = dict(api_request.cb_kwargs)
+        html_url = kwargs.pop("html_url")
+        kwargs.pop("offset")
+        logger.warning(f"{api_request.url}: {reason}, falling back to {html_url}")
+        if kwargs:
+            return scrapy.Request(html_url, self._parse_ershoufang, cb_kwargs=kwargs)
+        return self._district_request(html_url)
+
+
+def _site_url(url: str) -> str:
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
@@ -0,0 +1,443 @@
+import json
+import re
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import parsel
+from lxml import etree
+
+from ... import items
+
+
+class PageBox(NamedTuple):
+    page_url: str
+    total_page: int
+    cur_page: int
+
+
+class XiaoquListEntry(NamedTuple):
+    xiaoqu_id: str
+    name: Optional[str]
+    district: Optional[str]
+    area: Optional[str]
+    built_year: Optional[int]
+    tags: List[str]
+    detail_url: Optional[str]
+    ershoufang_url: Optional[str]
+    daily_stats: Optional[items.XiaoquDailyStats]
+
+
+class XiaoquDetail(NamedTuple):
+    fields: dict
+    ershoufang_url: Optional[str]
+    chengjiao_url: Optional[str]
+
+
+def _count_dropped(dropped: Optional[Counter], kind: str, num_nodes: int, num_parsed: int):
+    """Count the listing nodes a list parser skipped, into the caller's Counter"""
+    if dropped is not None and num_nodes > num_parsed:
+        dropped[kind] += num_nodes - num_parsed
+
+
+def crawl_date() -> datetime:
+    return datetime.utcnow().replace(
+        hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone(timedelta(hours=8))
+    )
+
+
+_XIAOQU_LABEL_TO_FIELD_NAME = {
+    "建筑类型": "building_type",
+    "物业费用": "management_fee",
+    "物业公司": "prop_manager",
+    "开发商": "prop_developer",
+    "楼栋总数": "num_of_buildings",
+    "房屋总数": "num_of_units",
+}
+
+
+def _first(results: list) -> Optional[str]:
+    return str(results[0]) if results else None
+
+
+def _children_by_class(node) -> Dict[str, etree._Element]:
+    children = {}
+    for child in node:
+        class_ = child.get("class")
+        if class_ is not None:
+            children.setdefault(class_, child)
+    return children
+
+
+class CompiledParser:
+    """Parsers of the lianjia pages, with XPath and regexes compiled once
+
+    Works on the lxml tree under the selector and visits each listing node once,
+    instead of building a SelectorList per relative xpath() call.
+    """
+
+    _HOME_DISTRICT_HREFS = etree.XPath("//div[@data-role='ershoufang']/div[1]/a/@href")
+    _PAGE_BOX = etree.XPath("//div[@class='page-box house-lst-page-box']")
+
+    _XIAOQU_NODES = etree.XPath("//li[@class='clear xiaoquListItem']")
+    _A_TEXT = etree.XPath("a/text()")
+    _A_HREF = etree.XPath("a/@href")
+    _DISTRICT_TEXT = etree.XPath("a[@class='district']/text()")
+    _BIZCIRCLE_TEXT = etree.XPath("a[@class='bizcircle']/text()")
+    _SPAN_TEXTS = etree.XPath("span/text()")
+    _HOUSEINFO_A = etree.XPath("a")
+    _XIAOQU_PRICE = etree.XPath(
+        ".//div[@class='xiaoquListItemPrice']/div[@class='totalPrice']/span/text()"
+    )
+    _SELL_COUNT = etree.XPath(".//a[@class='totalSellCount']/span/text()")
+    _SELL_HREF = etree.XPath(".//a[@class='totalSellCount']/@href")
+    _BUILT_YEAR_RE = re.compile(r"(\d+)年建成")
+    _DEAL_IN_90DAYS_RE = re.compile(r"90天成交(\d+)")
+    _FOR_RENT_RE = re.compile(r"(\d+)套正在出租")
+
+    _XIAOQU_INFO_ITEMS = etree.XPath("//div[@class='xiaoquInfoItem']")
+    _INFO_LABEL = etree.XPath("span[@class='xiaoquInfoLabel']/text()")
+    _INFO_CONTENT = etree.XPath("span[@class='xiaoquInfoContent']/text()")
+    _INFO_COORDINATES = etree.XPath("span[@class='xiaoquInfoContent']/span/@xiaoqu")
+    _ERSHOUFANG_HREF = etree.XPath("//div[@class='goodSellHeader clear']/a/@href")
+    _CHENGJIAO_HREF = etree.XPath("//div[@id='frameDeal']/a/@href")
+    _LEADING_NUM_RE = re.compile(r"(\d+).*")
+
+    _SALE_NODES = etree.XPath("//div[@class='leftContent']/ul/li")
+    _TEXTS = etree.XPath("text()")
+    _HOUSEINFO_TEXT = etree.XPath("div[@class='houseInfo']/text()")
+    _TOTAL_PRICE_TEXT = etree.XPath("div[@class='totalPrice totalPrice2']/span/text()")
+    _UNIT_PRICE = etree.XPath("div[@class='unitPrice']/@data-price")
+    _HOUSE_ID_RE = re.compile(r"/(\d+).html")
+    _AREA_RE = re.compile(r"(\d+\.{0,1}\d*)平米")
+    _FOLLOWERS_RE = re.compile(r"(\d+)人关注")
+    _ASK_DURATION_RE = re.compile(r"(\d+)天以前发布")
+
+    _CHENGJIAO_NODES = etree.XPath("//ul[@class='listContent']/li")
+    _DEAL_DATE_TEXT = etree.XPath("div[@class='dealDate']/text()")
+    _NUMBER_TEXT = etree.XPath("span[@class='number']/text()")
+    _DEAL_CYCLE_TEXTS = etree.XPath("span[@class='dealCycleTxt']/span/text()")
+    _ASK_PRICE_RE = re.compile(r"挂牌(\d+)万")
+    _DEAL_CYCLE_RE = re.compile(r"成交周期(\d+)天")
+
+    @classmethod
+    def parse_home(cls, selector: parsel.Selector) -> List[str]:
+        return [str(href) for href in cls._HOME_DISTRICT_HREFS(selector.root)]
+
+    @classmethod
+    def parse_page_box(cls, selector: parsel.Selector) -> Optional[PageBox]:
+        page_box_nodes = cls._PAGE_BOX(selector.root)
+        if not page_box_nodes:
+            return None
+        page_url = page_box_nodes[0].get("page-url")
+        page_data = page_box_nodes[0].get("page-data")
+        if page_url is None or page_data is None:
+            return None
+        page_data = json.loads(page_data)
+        return PageBox(page_url, page_data["totalPage"], page_data.get("curPage", 1))
+
+    @classmethod
+    def parse_district_page(
+        cls, selector: parsel.Selector, date_: datetime, dropped: Optional[Counter] = None
+    ) -> List[XiaoquListEntry]:
+        entries = []
+        xiaoqu_nodes = cls._XIAOQU_NODES(selector.root)
+        for xiaoqu_node in xiaoqu_nodes:
+            xiaoqu_id = xiaoqu_node.get("data-id")
+            if xiaoqu_id is None:
+                continue
+            children = _children_by_class(xiaoqu_node)
+            info_node = children.get("info")
+            if info_node is None:
+                continue
+            # price and on-sale count live beside the info block
+            right_node = children.get("xiaoquListItemRight", xiaoqu_node)
+            info_children = _children_by_class(info_node)
+            pos_info = info_children.get("positionInfo")
+            if pos_info is None:
+                continue
+            title_node = info_children.get("title")
+            name = _first(cls._A_TEXT(title_node)) if title_node is not None else None
+            built_matched = cls._BUILT_YEAR_RE.search("".join(pos_info.itertext()))
+            tag_list = info_children.get("tagList")
+            tags = [str(tag) for tag in cls._SPAN_TEXTS(tag_list)] if tag_list is not None else []
+            entries.append(
+                XiaoquListEntry(
+                    xiaoqu_id=xiaoqu_id,
+                    name=name,
+                    district=_first(cls._DISTRICT_TEXT(pos_info)),
+                    area=_first(cls._BIZCIRCLE_TEXT(pos_info)),
+                    built_year=int(built_matched.group(1)) if built_matched else None,
+                    tags=tags,
+                    detail_url=_first(cls._A_HREF(xiaoqu_node)),
+                    ershoufang_url=_first(cls._SELL_HREF(right_node)),
+                    daily_stats=cls._parse_xiaoqu_daily_stats(
+                        right_node, info_children.get("houseInfo"), xiaoqu_id, name, date_
+                    ),
+                )
+            )
+        _count_dropped(dropped, "xiaoqu", len(xiaoqu_nodes), len(entries))
+        return entries
+
+    @classmethod
+    def _parse_xiaoqu_daily_stats(
+        cls, right_node, houseinfo_node, xiaoqu_id: str, xiaoqu_name: str, date_: datetime
+    ) -> Optional[items.XiaoquDailyStats]:
+        for_rent = 0
+        deal_in_90days = 0
+        houseinfo_a_nodes = cls._HOUSEINFO_A(houseinfo_node) if houseinfo_node is not None else []
+        for a_node in houseinfo_a_nodes:
+            title = a_node.get("title") or ""
+            if title.endswith("网签"):
+                matched = cls._DEAL_IN_90DAYS_RE.match(_first(cls._TEXTS(a_node)) or "")
+                deal_in_90days = matched.group(1) if matched else None
+            elif title.endswith("租房"):
+                matched = cls._FOR_RENT_RE.match(_first(cls._TEXTS(a_node)) or "")
+                for_rent = matched.group(1) if matched else None
+        ask_avg_price = _first(cls._XIAOQU_PRICE(right_node))
+        on_sale_count = _first(cls._SELL_COUNT(right_node))
+        try:
+            return items.XiaoquDailyStats(
+                date_=date_,
+                xiaoqu_id=xiaoqu_id,
+                name=xiaoqu_name,
+                for_rent=int(for_rent),
+                on_sale_count=int(on_sale_count),
+                deal_in_90days=int(deal_in_90days),
+                ask_avg_price=int(ask_avg_price),
+            )
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def parse_xiaoqu(cls, selector: parsel.Selector) -> XiaoquDetail:
+        fields: Dict = {}
+        for info_item in cls._XIAOQU_INFO_ITEMS(selector.root):
+            info_label = _first(cls._INFO_LABEL(info_item))
+            if info_label == "附近门店":
+                coordinates = _first(cls._INFO_COORDINATES(info_item))
+                if coordinates is None:
+                    continue
+                fields["north_latitude"], fields["east_latitude"] = json.loads(coordinates)
+                continue
+            field_name = _XIAOQU_LABEL_TO_FIELD_NAME.get(info_label)
+            if field_name is None:
+                continue
+            info_content = _first(cls._INFO_CONTENT(info_item))
+            if field_name == "num_of_buildings" or field_name == "num_of_units":
+                num_matched = cls._LEADING_NUM_RE.match(info_content or "")
+                fields[field_name] = int(num_matched.group(1)) if num_matched else -1
+            else:
+                fields[field_name] = info_content
+        return XiaoquDetail(
+            fields=fields,
+            ershoufang_url=_first(cls._ERSHOUFANG_HREF(selector.root)),
+            chengjiao_url=_first(cls._CHENGJIAO_HREF(selector.root)),
+        )
+
+    @classmethod
+    def parse_chengjiao(
+        cls,
+        selector: parsel.Selector,
+        xiaoqu_id: str,
+        xiaoqu_name: str,
+        dropped: Optional[Counter] = None,
+    ) -> List[items.Transaction]:
+        li_nodes = cls._CHENGJIAO_NODES(selector.root)
+        transactions = []
+        for li_node in li_nodes:
+            transaction = cls._parse_transaction(li_node, xiaoqu_id, xiaoqu_name)
+            if transaction is not None:
+                transactions.append(transaction)
+        _count_dropped(dropped, "chengjiao", len(li_nodes), len(transactions))
+        return transactions
+
+    @classmethod
+    def _parse_transaction(
+        cls, li_node, xiaoqu_id: str, xiaoqu_name: str
+    ) -> Optional[items.Transaction]:
+        house_id_matched = cls._HOUSE_ID_RE.search(_first(cls._A_HREF(li_node)) or "")
+        trans_node = _children_by_class(li_node).get("info")
+        if not house_id_matched or trans_node is None:
+            return None
+        trans_children = _children_by_class(trans_node)
+        title_node = trans_children.get("title")
+        if title_node is None:
+            return None
+        splitted_title = (_first(cls._A_TEXT(title_node)) or "").split()
+        if len(splitted_title) < 3 or splitted_title[1] == "车位":
+            return None
+        total_area_matched = cls._AREA_RE.match(splitted_title[2])
+        deal = cls._parse_deal(trans_children)
+        if not total_area_matched or deal is None:
+            return None
+        return items.Transaction(
+            house_id=int(house_id_matched.group(1)),
+            room_type=splitted_title[1],
+            total_area=float(total_area_matched.group(1)),
+            xiaoqu_id=xiaoqu_id,
+            xiaoqu_name=xiaoqu_name,
+            **deal,
+        )
+
+    @classmethod
+    def _parse_deal(cls, trans_children: Dict[str, etree._Element]) -> Optional[dict]:
+        """The deal fields of a transaction, None if any is missing"""
+        address_node = trans_children.get("address")
+        flood_node = trans_children.get("flood")
+        if address_node is None or flood_node is None:
+            return None
+        trans_date_str = _first(cls._DEAL_DATE_TEXT(address_node))
+        total_price_node = _children_by_class(address_node).get("totalPrice")
+        flood_children = _children_by_class(flood_node)
+        positioninfo_node = flood_children.get("positionInfo")
+        unit_price_node = flood_children.get("unitPrice")
+        deal_cycle = cls._parse_deal_cycle(trans_children.get("dealCycleeInfo"))
+        if (
+            trans_date_str is None
+            or total_price_node is None
+            or positioninfo_node is None
+            or unit_price_node is None
+            or deal_cycle is None
+        ):
+            return None
+        try:
+            towards, decoration = (_first(cls._HOUSEINFO_TEXT(address_node)) or "").split("|")
+            floor_location, building_type = (_first(cls._TEXTS(positioninfo_node)) or "").split()
+            delt_total_w = int(_first(cls._NUMBER_TEXT(total_price_node)))
+            delt_avg_price = int(_first(cls._NUMBER_TEXT(unit_price_node)))
+        except (TypeError, ValueError):
+            return None
+        trans_date = datetime.strptime(trans_date_str, "%Y.%m.%d")
+        ask_total_w, ask_duration_days = deal_cycle
+        return dict(
+            date_=trans_date.replace(tzinfo=timezone(timedelta(hours=8))),
+            towards=towards.strip(),
+            decoration=decoration.strip(),
+            floor_location=floor_location,
+            building_type=building_type,
+            delt_avg_price=delt_avg_price,
+            delt_total_w=delt_total_w,
+            ask_total_w=ask_total_w,
+            ask_duration_days=ask_duration_days,
+        )
+
+    @classmethod
+    def _parse_deal_cycle(cls, deal_cycle_node) -> Optional[Tuple[int, int]]:
+        """Asking price and days on the market of a transaction"""
+        if deal_cycle_node is None:
+            return None
+        deal_cycle_txts = cls._DEAL_CYCLE_TEXTS(deal_cycle_node)
+        if len(deal_cycle_txts) < 2:
+            return None
+        ask_price_matched = cls._ASK_PRICE_RE.match(deal_cycle_txts[0])
+        ask_duration_matched = cls._DEAL_CYCLE_RE.match(deal_cycle_txts[1])
+        if not ask_price_matched or not ask_duration_matched:
+            return None
+        return int(ask_price_matched.group(1)), int(ask_duration_matched.group(1))
+
+    @classmethod
+    def parse_ershoufang(
+        cls,
+        selector: parsel.Selector,
+        date_: datetime,
+        xiaoqu_id: str,
+        xiaoqu_name: str,
+        dropped: Optional[Counter] = None,
+    ) -> List[items.ForSale]:
+        sale_nodes = cls._SALE_NODES(selector.root)
+        for_sales = []
+        for sale_node in sale_nodes:
+            for_sale = cls._parse_for_sale(sale_node, date_, xiaoqu_id, xiaoqu_name)
+            if for_sale is not None:
+                for_sales.append(for_sale)
+        _count_dropped(dropped, "ershoufang", len(sale_nodes), len(for_sales))
+        return for_sales
+
+    @classmethod
+    def _parse_for_sale(
+        cls, sale_node, date_: datetime, xiaoqu_id: str, xiaoqu_name: str
+    ) -> Optional[items.ForSale]:
+        info_node = _children_by_class(sale_node).get("info clear")
+        if info_node is None:
+            return None
+        info_children = _children_by_class(info_node)
+        title_node = info_children.get("title")
+        address_node = info_children.get("address")
+        if title_node is None or address_node is None:
+            return None
+        house_id_matched = cls._HOUSE_ID_RE.search(_first(cls._A_HREF(title_node)) or "")
+        splitted_houseinfo = (_first(cls._HOUSEINFO_TEXT(address_node)) or "").split("|")
+        if not house_id_matched or len(splitted_houseinfo) < 6:
+            return None
+        (
+            room_type,
+            area_txt,
+            towards,
+            decoration,
+            floor_location,
+            *_,
+            building_type,
+        ) = [entry.strip() for entry in splitted_houseinfo]
+        total_area_matched = cls._AREA_RE.match(area_txt)
+        prices = cls._parse_ask_prices(info_children.get("priceInfo"))
+        follow_info = cls._parse_follow_info(info_children.get("followInfo"))
+        if not total_area_matched or prices is None or follow_info is None:
+            return None
+        return items.ForSale(
+            house_id=int(house_id_matched.group(1)),
+            date_=date_,
+            description=_first(cls._A_TEXT(title_node)),
+            room_type=room_type,
+            total_area=float(total_area_matched.group(1)),
+            towards=towards,
+            decoration=decoration,
+            floor_location=floor_location,
+            building_type=building_type,
+            five_years_status=cls._five_years_status(info_children.get("tag")),
+            ask_total_w=prices[0],
+            ask_avg_price=prices[1],
+            num_of_followers=follow_info[0],
+            ask_duration_days=follow_info[1],
+            xiaoqu_id=xiaoqu_id,
+            xiaoqu_name=xiaoqu_name,
+        )
+
+    @staticmethod
+    def _five_years_status(tag_node) -> int:
+        """2 for over two years of ownership, 5 for over five, 0 when not tagged"""
+        if tag_node is None:
+            return 0
+        tag_classes = {span.get("class") for span in tag_node}
+        if "five" in tag_classes:
+            return 2
+        if "taxfree" in tag_classes:
+            return 5
+        return 0
+
+    @classmethod
+    def _parse_ask_prices(cls, priceinfo_node) -> Optional[Tuple[int, int]]:
+        """Asking total price in 10k and price per square meter"""
+        if priceinfo_node is None:
+            return None
+        try:
+            total_price = int(float(_first(cls._TOTAL_PRICE_TEXT(priceinfo_node))))
+            avg_price = int(_first(cls._UNIT_PRICE(priceinfo_node)))
+        except (TypeError, ValueError):
+            return None
+        return total_price, avg_price
+
+    @classmethod
+    def _parse_follow_info(cls, followinfo_node) -> Optional[Tuple[int, int]]:
+        """Followers and days since the listing was published, 0 when not shown"""
+        if followinfo_node is None:
+            return None
+        followinfo_parts = (_first(cls._TEXTS(followinfo_node)) or "").split("/")
+        if len(followinfo_parts) != 2:
+            return None
+        followers_matched = cls._FOLLOWERS_RE.match(followinfo_parts[0].strip())
+        ask_duration_matched = cls._ASK_DURATION_RE.match(followinfo_parts[1].strip())
+        return (
+            int(followers_matched.group(1)) if followers_matched else 0,
+            int(ask_duration_matched.group(1)) if ask_duration_matched else 0,
+        )
@@ -0,0 +1,79 @@
+"""Parsing of the lianjia pages, on the reactor thread or in worker processes
+
+LianjiaSpider parses a page into a ParsedPage and follows it from there. With
+LIANJIA_PARSE_WORKERS > 0 the response body goes to a process pool instead, whose
+workers build the tree and run the same parser; items come back as plain field
+tuples, cheaper to pickle than the dataclasses, and are rebuilt by ``restore``.
+"""
+
+from collections import Counter
+from typing import Any, NamedTuple, Optional, Tuple
+
+from scrapy.http import HtmlResponse
+
+from ... import items
+from ._parsers import CompiledParser, PageBox
+
+DISTRICT = "district"
+XIAOQU = "xiaoqu"
+ERSHOUFANG = "ershoufang"
+CHENGJIAO = "chengjiao"
+
+_ITEM_CLASSES = {ERSHOUFANG: items.ForSale, CHENGJIAO: items.Transaction}
+
+
+class ParsedPage(NamedTuple):
+    # list entries, items or XiaoquDetail depending on the page
+    result: Any
+    page_box: Optional[PageBox]
+    dropped: Counter
+
+
+def parse_selector(kind: str, selector, args: Tuple) -> ParsedPage:
+    dropped: Counter = Counter()
+    if kind == XIAOQU:
+        return ParsedPage(CompiledParser.parse_xiaoqu(selector), None, dropped)
+    if kind == DISTRICT:
+        result = CompiledParser.parse_district_page(selector, *args, dropped)
+    elif kind == ERSHOUFANG:
+        result = CompiledParser.parse_ershoufang(selector, *args, dropped)
+    elif kind == CHENGJIAO:
+        result = CompiledParser.parse_chengjiao(selector, *args, dropped)
+    else:
+        raise ValueError(f"unknown page kind {kind}")
+    return ParsedPage(result, CompiledParser.parse_page_box(selector), dropped)
+
+
+def parse_body(kind: str, url: str, body: bytes, encoding: str, args: Tuple):
+    """Worker process entry point, a ParsedPage as plain tuples"""
+    selector = HtmlResponse(url, body=body, encoding=encoding).selector
+    parsed = parse_selector(kind, selector, args)
+    result = parsed.result
+    if kind == DISTRICT:
+        result = [entry._replace(daily_stats=_values(entry.daily_stats)) for entry in result]
+    elif kind in _ITEM_CLASSES:
+        result = [_values(item) for item in result]
+    return ParsedPage(result, parsed.page_box, dict(parsed.dropped))
+
+
+def restore(kind: str, parsed: ParsedPage) -> ParsedPage:
+    """The ParsedPage of parse_body with its items rebuilt"""
+    result = parsed.result
+    if kind == DISTRICT:
+        result = [
+            entry._replace(daily_stats=_rebuild(items.XiaoquDailyStats, entry.daily_stats))
+            for entry in result
+        ]
+    elif kind in _ITEM_CLASSES:
+        result = [_rebuild(_ITEM_CLASSES[kind], values) for values in result]
+    return ParsedPage(result, parsed.page_box, Counter(parsed.dropped))
+
+
+def _values(item) -> Optional[Tuple]:
+    if item is None:
+        return None
+    return tuple(getattr(item, name) for name in item.__slots__)
+
+
+def _rebuild(item_cls, values: Optional[Tuple]):
+    return None if values is None else item_cls(*values)
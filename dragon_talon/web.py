@@ -0,0 +1,341 @@
+"""HTTP query service over the crawled collections
+
+Serves JSON on ``http://WEB_HOST:WEB_PORT``::
+
+    GET /xiaoqu/<xiaoqu_id>                     xiaoqu_info and its latest ask price
+    GET /xiaoqu/<xiaoqu_id>/listings            for_sale listings of its latest crawl date
+    GET /prices/<xiaoqu|area|district>?key=..   daily ask price rollups (area keys are
+                                                "<district>/<area>"), since=YYYY-MM-DD
+
+Listings unchanged since the previous crawl (change detection) are served from their
+heartbeats in the document layout only. The price rollups are only maintained with
+MONGO_PRICE_ROLLUPS on, in the document layout without change detection; /prices answers
+empty pages otherwise, in the bucket layout in particular.
+
+The paged endpoints take ``limit`` (WEB_PAGE_SIZE, at most WEB_MAX_PAGE_SIZE) and the
+``cursor`` of the previous page, and answer ``{"items": [...], "next": <cursor>|null}``.
+Pages are streamed as the Mongo cursor is read on the thread pool, WEB_STREAM_BATCH
+documents at a time, see dragon_talon.queries for the queries behind them.
+
+Responses are kept in an LRU cache of WEB_CACHE_SIZE entries for WEB_CACHE_TTL
+seconds, keyed by the request and the latest crawl. MongoPipeline records each crawl
+it finishes in close_spider; the service checks for a new one at most every
+WEB_CRAWL_POLL_SECONDS and drops the cache when it finds one.
+
+Run with ``python -m dragon_talon.web``.
+"""
+
+import base64
+import json
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Hashable, Optional
+
+from loguru import logger
+from twisted.internet import defer, threads
+from twisted.web import resource, server
+
+from . import db, queries, rollups
+
+_CRAWL_TZ = timezone(timedelta(hours=8))
+
+
+class ResultCache:
+    """LRU cache of response bodies, an entry expires ttl seconds after it was put"""
+
+    def __init__(self, max_entries: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self._clock():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, body: bytes):
+        if self._max_entries <= 0:
+            return
+        self._entries[key] = (self._clock() + self._ttl, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class _HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_default(value):
+    # Mongo hands back UTC, dates are shown in the crawl's timezone
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(_CRAWL_TZ).isoformat()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, default=_json_default).encode()
+
+
+def encode_cursor(value) -> str:
+    raw = _dumps(value.isoformat() if isinstance(value, datetime) else value)
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise _HttpError(400, "invalid cursor") from None
+
+
+class QueryService(resource.Resource):
+    """The endpoints of the module docstring, queries run on the reactor thread pool"""
+
+    isLeaf = True
+
+    def __init__(
+        self,
+        database,
+        cache: ResultCache,
+        bucketed: bool = False,
+        page_size: int = 100,
+        max_page_size: int = 1000,
+        stream_batch: int = 200,
+        crawl_poll_seconds: float = 5,
+        rollup_price_bucket: int = 500,
+    ):
+        super().__init__()
+        self._database = database
+        self._cache = cache
+        self._bucketed = bucketed
+        self._page_size = page_size
+        self._max_page_size = max_page_size
+        self._stream_batch = stream_batch
+        self._crawl_poll_seconds = crawl_poll_seconds
+        self._rollup_price_bucket = rollup_price_bucket
+        self._crawl: Optional[datetime] = None
+        self._crawl_polled_at: Optional[float] = None
+
+    @classmethod
+    def from_settings(cls, database, settings) -> "QueryService":
+        cache = ResultCache(
+            settings.getint("WEB_CACHE_SIZE", 1024), settings.getfloat("WEB_CACHE_TTL", 300)
+        )
+        return cls(
+            database,
+            cache,
+            bucketed=settings.get("MONGO_STORAGE_LAYOUT") == "bucket",
+            page_size=settings.getint("WEB_PAGE_SIZE", 100),
+            max_page_size=settings.getint("WEB_MAX_PAGE_SIZE", 1000),
+            stream_batch=settings.getint("WEB_STREAM_BATCH", 200),
+            crawl_poll_seconds=settings.getfloat("WEB_CRAWL_POLL_SECONDS", 5),
+            rollup_price_bucket=settings.getint("MONGO_ROLLUP_PRICE_BUCKET", 500),
+        )
+
+    def render_GET(self, request):
+        # the client went away, stop reading and writing
+        disconnected: list = []
+        request.notifyFinish().addErrback(disconnected.append)
+        dfd = self._serve(request, disconnected)
+        dfd.addErrback(self._failed, request, disconnected)
+        return server.NOT_DONE_YET
+
+    @defer.inlineCallbacks
+    def _serve(self, request, disconnected: list):
+        segments = tuple(segment.decode() for segment in request.postpath if segment)
+        args = {
+            name.decode(): values[-1].decode() for name, values in (request.args or {}).items()
+        }
+        crawl = yield self._latest_crawl()
+        key = (crawl, segments, tuple(sorted(args.items())))
+        body = self._cache.get(key)
+        request.setHeader(b"Content-Type", b"application/json; charset=utf-8")
+        if body is not None:
+            request.setHeader(b"X-Cache", b"hit")
+            request.write(body)
+            request.finish()
+            return
+        request.setHeader(b"X-Cache", b"miss")
+        if len(segments) == 2 and segments[0] == "xiaoqu":
+            doc = yield threads.deferToThread(
+                queries.xiaoqu_detail, self._database, segments[1], self._bucketed
+            )
+            if doc is None:
+                raise _HttpError(404, f"unknown xiaoqu {segments[1]}")
+            body = _dumps(doc)
+            request.write(body)
+            request.finish()
+            self._cache.put(key, body)
+            return
+        page = yield threads.deferToThread(self._page_query, segments, args)
+        yield self._stream(request, page, key, disconnected)
+
+    def _page_query(self, segments: tuple, args: dict) -> queries.Page:
+        limit = self._limit(args)
+        cursor = args.get("cursor")
+        after = None if cursor is None else _decode_cursor(cursor)
+        if len(segments) == 3 and segments[0] == "xiaoqu" and segments[2] == "listings":
+            if after is not None and not isinstance(after, int):
+                raise _HttpError(400, "invalid cursor")
+            return queries.active_listings(
+                self._database, segments[1], limit, after=after, bucketed=self._bucketed
+            )
+        if len(segments) == 2 and segments[0] == "prices":
+            if segments[1] not in rollups.LEVELS:
+                raise _HttpError(404, f"unknown level {segments[1]}, one of {rollups.LEVELS}")
+            if not args.get("key"):
+                raise _HttpError(400, "missing key")
+            return queries.price_series(
+                self._database,
+                segments[1],
+                args["key"],
+                limit,
+                since=_parse_date(args["since"]) if "since" in args else None,
+                after=None if after is None else _parse_datetime(after),
+                bucket_width=self._rollup_price_bucket,
+            )
+        raise _HttpError(404, f"no such endpoint /{'/'.join(segments)}")
+
+    def _limit(self, args: dict) -> int:
+        try:
+            limit = int(args.get("limit", self._page_size))
+        except ValueError:
+            raise _HttpError(400, "limit is not a number") from None
+        if not 0 < limit <= self._max_page_size:
+            raise _HttpError(400, f"limit should be within 1..{self._max_page_size}")
+        return limit
+
+    @defer.inlineCallbacks
+    def _stream(self, request, page: queries.Page, key: tuple, disconnected: list):
+        # the page is kept for the cache while it is written out; the headers go with
+        # the first documents, a failing query still gets its error status
+        chunks = [b'{"items":[']
+        served = 0
+        last = None
+        has_next = False
+        try:
+            while not has_next and not disconnected:
+                batch = yield threads.deferToThread(_next_batch, page.docs, self._stream_batch)
+                if served + len(batch) > page.limit:
+                    has_next = True
+                    batch = batch[: page.limit - served]
+                if not batch:
+                    break
+                chunk = b",".join(_dumps(doc) for doc in batch)
+                if served:
+                    chunks.append(b"," + chunk)
+                    request.write(chunks[-1])
+                else:
+                    chunks.append(chunk)
+                    request.write(b"".join(chunks))
+                served += len(batch)
+                last = batch[-1]
+        except Exception:
+            if served and not disconnected:
+                # the body is already on its way, cut it short
+                request.finish()
+            raise
+        finally:
+            close = getattr(page.docs, "close", None)
+            if close is not None:
+                close()
+        if disconnected:
+            return
+        next_cursor = encode_cursor(page.key(last)) if has_next else None
+        chunks.append(b'],"next":' + _dumps(next_cursor) + b"}")
+        request.write(chunks[-1] if served else b"".join(chunks))
+        request.finish()
+        self._cache.put(key, b"".join(chunks))
+
+    def _latest_crawl(self) -> defer.Deferred:
+        now = time.monotonic()
+        if (
+            self._crawl_polled_at is not None
+            and now - self._crawl_polled_at < self._crawl_poll_seconds
+        ):
+            return defer.succeed(self._crawl)
+        self._crawl_polled_at = now
+        dfd = threads.deferToThread(queries.last_crawl, self._database)
+        dfd.addCallback(self._on_crawl)
+        return dfd
+
+    def _on_crawl(self, crawl: Optional[datetime]) -> Optional[datetime]:
+        if crawl != self._crawl:
+            if self._crawl is not None:
+                logger.info(f"crawl finished at {crawl}, {len(self._cache)} cached results dropped")
+            self._cache.clear()
+            self._crawl = crawl
+        return crawl
+
+    def _failed(self, failure, request, disconnected: list):
+        if failure.check(_HttpError):
+            status, message = failure.value.status, str(failure.value)
+        else:
+            logger.error(f"{request.uri!r} failed {failure.value!r}")
+            status, message = 500, "internal error"
+        if disconnected or request.finished:
+            return
+        request.setResponseCode(status)
+        request.write(_dumps({"error": message}))
+        request.finish()
+
+
+def _next_batch(docs, size: int) -> list:
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def _parse_date(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=_CRAWL_TZ)
+    except ValueError:
+        raise _HttpError(400, f"invalid date {value}, expected YYYY-MM-DD") from None
+
+
+def _parse_datetime(value) -> datetime:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise _HttpError(400, "invalid cursor") from None
+
+
+def main():
+    from scrapy.utils.project import get_project_settings
+    from twisted.internet import reactor
+
+    settings = get_project_settings()
+    database = db.get_mongo_client().get_database(db.DB_NAME)
+    site = server.Site(QueryService.from_settings(database, settings))
+    host = settings.get("WEB_HOST", "127.0.0.1")
+    port = reactor.listenTCP(settings.getint("WEB_PORT", 8410), site, interface=host)
+    logger.info(f"query service on http://{host}:{port.getHost().port}")
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
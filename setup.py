@@ -35,8 +35,21 @@ dev_requirements = [
 
 test_requirements = [
     "pytest>=4.0.0,<7.0.0",
+    "mongomock>=3.22.0",
+]
+parquet_requirements = [
+    "pyarrow>=2.0.0",
+]
+httpcache_requirements = [
+    "zstandard>=0.15.0",
+]
+motor_requirements = [
+    "motor>=2.3.0,<3.0.0",
 ]
 extras_requirements = {
+    "parquet": parquet_requirements,
+    "motor": motor_requirements,
+    "httpcache": httpcache_requirements,
     "dev": dev_requirements,
     "testing": test_requirements,
     "all": dev_requirements + test_requirements,
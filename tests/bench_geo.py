@@ -0,0 +1,71 @@
+"""Benchmark of the in-process nearest-xiaoqu snapshot against a linear scan.
+
+Builds a XiaoquSnapshot over random locations spread like the xiaoqu of a city and
+times radius and k-nearest lookups for a batch of points, as a metro station or POI
+list would send.
+
+Usage: python -m tests.bench_geo [--xiaoqu 30000] [--points 2000] [--radius 2000]
+"""
+
+import argparse
+import random
+import time
+
+from dragon_talon import geo
+
+
+def _linear_within(docs, longitude: float, latitude: float, radius_m: float) -> int:
+    x, y, z = geo._unit_vector(longitude, latitude)
+    limit_sq = geo._chord(radius_m) ** 2
+    count = 0
+    for px, py, pz in docs:
+        if (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2 <= limit_sq:
+            count += 1
+    return count
+
+
+def main(args):
+    rng = random.Random(0)
+    docs = [
+        {
+            "xiaoqu_id": str(i),
+            "name": str(i),
+            "location": geo.location(rng.gauss(121.47, 0.15), rng.gauss(31.23, 0.12)),
+        }
+        for i in range(args.xiaoqu)
+    ]
+    points = [(rng.gauss(121.47, 0.15), rng.gauss(31.23, 0.12)) for _ in range(args.points)]
+    started = time.perf_counter()
+    snapshot = geo.XiaoquSnapshot(docs)
+    print(f"{args.xiaoqu} xiaoqu, snapshot built in {time.perf_counter() - started:.2f}s")
+
+    started = time.perf_counter()
+    results = snapshot.within_radius_batch(points, args.radius)
+    elapsed = time.perf_counter() - started
+    found = sum(map(len, results))
+    print(
+        f"within {args.radius:.0f}m: {elapsed / len(points) * 1e6:.0f}us/point, "
+        f"{found / len(points):.1f} xiaoqu/point"
+    )
+    started = time.perf_counter()
+    for longitude, latitude in points:
+        snapshot.nearest(longitude, latitude, args.k)
+    elapsed = time.perf_counter() - started
+    print(f"nearest {args.k}: {elapsed / len(points) * 1e6:.0f}us/point")
+
+    vectors = [geo._unit_vector(*doc["location"]["coordinates"]) for doc in docs]
+    sample = points[: max(1, len(points) // 20)]
+    started = time.perf_counter()
+    linear_found = [_linear_within(vectors, *point, args.radius) for point in sample]
+    elapsed = time.perf_counter() - started
+    assert linear_found == [len(result) for result in results[: len(sample)]]
+    print(f"linear scan: {elapsed / len(sample) * 1e6:.0f}us/point")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--xiaoqu", type=int, default=30000)
+    parser.add_argument("--points", type=int, default=2000)
+    parser.add_argument("--radius", type=float, default=2000)
+    parser.add_argument("-k", type=int, default=10)
+    main(parser.parse_args())
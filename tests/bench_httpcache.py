@@ -0,0 +1,105 @@
+"""Disk usage, lookup latency and expiry of the http cache storages on recorded pages.
+
+Stores the fixture pages under many distinct urls in scrapy's FilesystemCacheStorage
+and in SqliteCacheStorage, then times random lookups and the eviction of every
+entry once expired.
+
+Usage: python -m tests.bench_httpcache [--copies 500] [--lookups 2000]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from unittest import mock
+
+from scrapy.extensions import httpcache as scrapy_httpcache
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.http import Request
+from scrapy.settings import Settings
+
+from dragon_talon import httpcache
+
+from .replay import create_spider, load_fixture_pages
+
+STORAGES = {
+    "filesystem": FilesystemCacheStorage,
+    "sqlite": httpcache.SqliteCacheStorage,
+}
+
+
+def _disk_usage(path: str):
+    num_files, num_bytes = 0, 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            num_files += 1
+            num_bytes += os.path.getsize(os.path.join(dirpath, filename))
+    return num_files, num_bytes
+
+
+def _open(storage_cls, cache_dir: str, spider, expiration_secs: int = 0):
+    storage = storage_cls(
+        Settings({"HTTPCACHE_DIR": cache_dir, "HTTPCACHE_EXPIRATION_SECS": expiration_secs})
+    )
+    storage.open_spider(spider)
+    return storage
+
+
+def bench_storage(name: str, storage_cls, responses: list, num_lookups: int):
+    spider = create_spider()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        storage = _open(storage_cls, cache_dir, spider)
+        started = time.perf_counter()
+        for request, response in responses:
+            storage.store_response(spider, request, response)
+        storage.close_spider(spider)
+        store_secs = time.perf_counter() - started
+        num_files, num_bytes = _disk_usage(cache_dir)
+
+        storage = _open(storage_cls, cache_dir, spider)
+        lookups = random.Random(0).choices(responses, k=num_lookups)
+        started = time.perf_counter()
+        for request, _ in lookups:
+            assert storage.retrieve_response(spider, request) is not None
+        lookup_ms = (time.perf_counter() - started) / num_lookups * 1000
+        storage.close_spider(spider)
+
+        # everything expired: the filesystem storage only skips stale entries on lookup
+        # and never deletes them, the sqlite one deletes them when the spider opens
+        later = time.time() + 3600
+        started = time.perf_counter()
+        with mock.patch.object(scrapy_httpcache, "time", return_value=later), mock.patch.object(
+            httpcache.time, "time", return_value=later
+        ):
+            storage = _open(storage_cls, cache_dir, spider, expiration_secs=60)
+            for request, _ in lookups:
+                assert storage.retrieve_response(spider, request) is None
+        storage.close_spider(spider)
+        expiry_secs = time.perf_counter() - started
+        num_files_left, _ = _disk_usage(cache_dir)
+    print(
+        f"  {name:<12}{len(responses) / store_secs:>9.0f} stores/s"
+        f"{lookup_ms:>9.3f} ms/lookup{num_bytes / 1024 / 1024:>9.2f} MB"
+        f"{num_files:>8} files{expiry_secs:>8.2f}s expiry, {num_files_left} files left"
+    )
+
+
+def main(args):
+    pages = load_fixture_pages()
+    responses = []
+    for copy in range(args.copies):
+        for page in pages:
+            response = page.response.replace(url=f"{page.response.url}?copy={copy}")
+            responses.append((Request(response.url), response))
+    raw_mb = sum(len(response.body) for _, response in responses) / 1024 / 1024
+    print(f"{len(responses)} responses, {raw_mb:.2f} MB of bodies")
+    for name, storage_cls in STORAGES.items():
+        bench_storage(name, storage_cls, responses, args.lookups)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--copies", type=int, default=500)
+    parser.add_argument("--lookups", type=int, default=2000)
+    main(parser.parse_args())
@@ -0,0 +1,65 @@
+"""Memory and throughput of the item -> Mongo document conversions buffered by MongoPipeline.
+
+Compares dataclasses.asdict (deep copy, the previous conversion), the slotted items'
+shallow to_document() and to_document() encoded to a RawBSONDocument (MONGO_ENCODE_BSON).
+
+Usage: python -m tests.bench_items [--copies 200]
+"""
+
+import argparse
+import time
+import tracemalloc
+from dataclasses import asdict, is_dataclass
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from .replay import create_spider, load_fixture_pages, replay
+
+CONVERSIONS = {
+    "asdict": asdict,
+    "to_document": lambda item: item.to_document(),
+    "to_document+bson": lambda item: RawBSONDocument(bson.encode(item.to_document())),
+}
+
+
+def _traced_mb(build) -> float:
+    tracemalloc.start()
+    try:
+        kept = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return current / 1024 / 1024
+
+
+def bench_conversion(name: str, convert, scraped_items: list):
+    started = time.perf_counter()
+    for item in scraped_items:
+        convert(item)
+    elapsed = time.perf_counter() - started
+    buffered_mb = _traced_mb(lambda: [convert(item) for item in scraped_items])
+    print(
+        f"  {name:<20}{len(scraped_items) / elapsed:>12.0f} items/s"
+        f"{buffered_mb:>10.2f} MB buffered"
+    )
+
+
+def main(args):
+    results = replay(create_spider(), load_fixture_pages())
+    scraped_items = [
+        output for result in results for output in result.outputs if is_dataclass(output)
+    ] * args.copies
+    print(f"{len(scraped_items)} items")
+    item_mb = _traced_mb(lambda: [type(item)(*asdict(item).values()) for item in scraped_items])
+    has_dict = hasattr(scraped_items[0], "__dict__")
+    print(f"  items themselves: {item_mb:.2f} MB, __dict__ per instance: {has_dict}")
+    for name, convert in CONVERSIONS.items():
+        bench_conversion(name, convert, scraped_items)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--copies", type=int, default=200)
+    main(parser.parse_args())
@@ -0,0 +1,90 @@
+"""End-to-end offline benchmark: recorded pages -> spider callbacks -> MongoPipeline.
+
+Mongo is replaced by an in-memory mongomock client, so the numbers cover parsing,
+item construction and the pipeline batching, not the network or the server.
+
+Usage: python -m tests.bench_lianjia_crawl [--cache-dir httpcache] [--rounds 20]
+"""
+
+import argparse
+import resource
+import sys
+import time
+from collections import defaultdict
+from dataclasses import is_dataclass
+from unittest import mock
+
+import mongomock
+from twisted.internet import defer, reactor
+
+from dragon_talon import db
+from dragon_talon.pipelines import MongoPipeline
+
+from .replay import create_spider, load_fixture_pages, load_httpcache_pages, replay
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def bench_callbacks(spider, pages, rounds: int) -> list:
+    callback2seconds = defaultdict(float)
+    callback2pages = defaultdict(int)
+    scraped_items = []
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for result in replay(spider, pages):
+            callback2seconds[result.page.callback] += result.seconds
+            callback2pages[result.page.callback] += 1
+            scraped_items.extend(output for output in result.outputs if is_dataclass(output))
+    elapsed = time.perf_counter() - started
+    num_pages = len(pages) * rounds
+    print(f"callbacks: {num_pages} pages, {len(scraped_items)} items in {elapsed:.3f}s")
+    print(f"  {num_pages / elapsed:.1f} pages/s, {len(scraped_items) / elapsed:.1f} items/s")
+    for callback, seconds in sorted(callback2seconds.items(), key=lambda kv: -kv[1]):
+        per_page_ms = seconds / callback2pages[callback] * 1000
+        print(f"  {callback:<30}{callback2pages[callback]:>7} pages{per_page_ms:>10.3f} ms/page")
+    return scraped_items
+
+
+@defer.inlineCallbacks
+def bench_pipeline(spider, scraped_items):
+    mongo_cli = mongomock.MongoClient()
+    with mock.patch.object(db, "get_mongo_client", return_value=mongo_cli):
+        pipeline = MongoPipeline.from_crawler(spider.crawler)
+    started = time.perf_counter()
+    for item in scraped_items:
+        yield defer.maybeDeferred(pipeline.process_item, item, spider)
+    yield pipeline.close_spider(spider)
+    elapsed = time.perf_counter() - started
+    print(f"pipeline: {len(scraped_items)} items in {elapsed:.3f}s")
+    print(f"  {len(scraped_items) / elapsed:.1f} items/s")
+    for key, value in sorted(spider.crawler.stats.get_stats().items()):
+        if key.startswith("mongo/"):
+            print(f"  {key}: {value}")
+
+
+@defer.inlineCallbacks
+def main(args):
+    spider = create_spider()
+    if args.cache_dir:
+        pages = list(load_httpcache_pages(args.cache_dir))
+    else:
+        pages = load_fixture_pages()
+    print(f"corpus: {len(pages)} pages")
+    try:
+        scraped_items = bench_callbacks(spider, pages, args.rounds)
+        yield bench_pipeline(spider, scraped_items)
+        print(f"peak rss: {_peak_rss_mb():.1f} MB")
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cache-dir", help="replay the HTTPCACHE_DIR of a crawl")
+    parser.add_argument("--rounds", type=int, default=20)
+    reactor.callWhenRunning(main, parser.parse_args())
+    reactor.run()
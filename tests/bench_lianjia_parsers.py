@@ -0,0 +1,71 @@
+"""Micro-benchmark of the lianjia parsers on recorded page and JSON list fixtures.
+
+Usage: python -m tests.bench_lianjia_parsers [rounds]
+"""
+
+import json
+import sys
+import timeit
+
+import parsel
+
+from dragon_talon.spiders.lianjia import _api
+from dragon_talon.spiders.lianjia._parsers import CompiledParser
+
+from .selector_parser import SelectorParser
+from .test_lianjia_parsers import DATE_, FIXTURE_DIR, PARSE_CASES, load_selector
+
+# list page, HTML parser and its arguments -> recorded JSON of the same listings and its parser
+_LISTING_ARGS = (DATE_, "5011000010000", "联洋花园")
+API_CASES = [
+    ("district", "parse_district_page", (DATE_,), "api_community", _api.parse_communities),
+    ("ershoufang", "parse_ershoufang", _LISTING_ARGS, "api_ershoufang", _api.parse_ershoufang),
+]
+API_ARGS = {
+    _api.parse_communities: ("https://sh.lianjia.com", DATE_),
+    _api.parse_ershoufang: _LISTING_ARGS,
+}
+
+
+def main(rounds: int = 200):
+    print(f"{'page':<12}{'selector ms':>14}{'compiled ms':>14}{'speedup':>10}")
+    for page, method, args in PARSE_CASES:
+        # the lxml tree is built once per response by scrapy, it is not part of the parse cost
+        selector = load_selector(page)
+        timings = []
+        for parser in (SelectorParser, CompiledParser):
+            parse = getattr(parser, method)
+            timings.append(min(timeit.repeat(lambda: parse(selector, *args), number=rounds, repeat=3)))
+        selector_ms, compiled_ms = (timing / rounds * 1000 for timing in timings)
+        print(f"{page:<12}{selector_ms:>14.3f}{compiled_ms:>14.3f}{selector_ms / compiled_ms:>9.1f}x")
+    print()
+    bench_api(rounds)
+
+
+def bench_api(rounds: int):
+    """HTML page vs JSON list per listing, with the tree building and the json decoding"""
+    print(f"{'page':<12}{'html B':>10}{'json B':>10}{'html us':>10}{'json us':>10}{'speedup':>10}")
+    for page, method, html_args, fixture, parse_api in API_CASES:
+        html = (FIXTURE_DIR / f"{page}.html").read_text(encoding="utf-8")
+        # as served, without the indentation of the fixture file
+        recorded = json.loads((FIXTURE_DIR / f"{fixture}.json").read_bytes())
+        body = json.dumps(recorded, ensure_ascii=False).encode()
+        num_listings = len(recorded["data"]["list"])
+        parse_html = getattr(CompiledParser, method)
+        api_args = API_ARGS[parse_api]
+        timings = [
+            min(timeit.repeat(parse, number=rounds, repeat=3))
+            for parse in (
+                lambda: parse_html(parsel.Selector(text=html), *html_args),
+                lambda: parse_api(_api.parse_page(body), *api_args),
+            )
+        ]
+        html_us, json_us = (timing / rounds / num_listings * 1e6 for timing in timings)
+        print(
+            f"{page:<12}{len(html.encode()) / num_listings:>10.0f}{len(body) / num_listings:>10.0f}"
+            f"{html_us:>10.1f}{json_us:>10.1f}{html_us / json_us:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,92 @@
+"""Benchmark of LIANJIA_PARSE_WORKERS: parse throughput and event loop stalls.
+
+Replays the recorded list and detail pages through the spider callbacks on an asyncio
+loop, as many at a time as the downloader would hand over, while a ticker measures
+how late the loop wakes it up: the delay every download, timer and pipeline write
+waits for while a callback runs.
+
+Usage: python -m tests.bench_parse_workers [--pages 400] [--workers 0 2 4]
+"""
+
+import argparse
+import asyncio
+import inspect
+import os
+import time
+from unittest import mock
+
+from .replay import REPLAY_DATE, create_spider, load_fixture_pages
+
+_TICK = 0.001
+
+
+async def _ticker(lags: list, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + _TICK
+        await asyncio.sleep(_TICK)
+        lags.append(loop.time() - expected)
+
+
+async def _crawl(spider, pages, concurrency: int) -> list:
+    queue = asyncio.Queue()
+    for page in pages:
+        queue.put_nowait(page)
+    lags: list = []
+    stop = asyncio.Event()
+    ticker = asyncio.ensure_future(_ticker(lags, stop))
+
+    async def consume():
+        while not queue.empty():
+            page = queue.get_nowait()
+            outputs = getattr(spider, page.callback)(page.response, **page.cb_kwargs)
+            if inspect.iscoroutine(outputs):
+                outputs = await outputs
+            list(outputs)
+            # the engine goes back to the loop between responses
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(consume() for _ in range(concurrency)))
+    stop.set()
+    await ticker
+    return lags
+
+
+def bench(workers: int, pages, concurrency: int):
+    with mock.patch(
+        "dragon_talon.spiders.lianjia._lianjia.is_asyncio_reactor_installed", return_value=True
+    ), mock.patch("dragon_talon.spiders.lianjia._lianjia.crawl_date", return_value=REPLAY_DATE):
+        spider = create_spider({"LIANJIA_PARSE_WORKERS": workers})
+        try:
+            if workers:
+                # start the workers outside of the measure
+                asyncio.run(_crawl(spider, pages[:workers], workers))
+            started = time.perf_counter()
+            lags = asyncio.run(_crawl(spider, pages, concurrency))
+            elapsed = time.perf_counter() - started
+        finally:
+            spider.closed("finished")
+    lags.sort()
+    print(
+        f"{workers:>8}{len(pages) / elapsed:>12.1f}"
+        f"{lags[len(lags) // 2] * 1000:>12.2f}{lags[int(len(lags) * 0.99)] * 1000:>12.2f}"
+        f"{lags[-1] * 1000:>12.2f}"
+    )
+
+
+def main(args):
+    # the callbacks parsing a page, the home page is left to the reactor thread anyway
+    fixture_pages = [page for page in load_fixture_pages() if page.callback != "_parse_home"]
+    pages = [fixture_pages[i % len(fixture_pages)] for i in range(args.pages)]
+    print(f"{len(pages)} pages, {args.concurrency} in flight, {os.cpu_count()} cpus")
+    print(f"{'workers':>8}{'pages/s':>12}{'lag p50 ms':>12}{'lag p99 ms':>12}{'lag max ms':>12}")
+    for workers in args.workers:
+        bench(workers, pages, args.concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    main(parser.parse_args())
@@ -0,0 +1,249 @@
+"""Load test of the read-side query service against a local Mongo stand-in.
+
+The service runs in a child process over an in-memory mongomock database seeded with
+a synthetic city (xiaoqu, daily price rollups, listings), so the numbers cover the
+service, its cache and the query layer, not a Mongo server. Clients hammer a skewed
+mix of detail, listing and price series requests over keep-alive connections, with
+and without the result cache; the child can record a finished crawl every few seconds
+to show the cache being dropped.
+
+Usage: python -m tests.bench_web [--seconds 10] [--clients 8] [--xiaoqu 200]
+"""
+
+import argparse
+import http.client
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, urlencode
+
+import mongomock
+from pymongo import ASCENDING, IndexModel
+
+from dragon_talon import db, items, queries, rollups
+from dragon_talon.web import QueryService, ResultCache
+
+_TZ = timezone(timedelta(hours=8))
+_DISTRICTS = ("浦东", "闵行", "徐汇", "静安", "长宁", "普陀")
+_DAYS = 365
+_LISTINGS = 30
+
+
+def _xiaoqu_id(i: int) -> str:
+    return str(5011000010000 + i)
+
+
+def _district(i: int) -> str:
+    return _DISTRICTS[i % len(_DISTRICTS)]
+
+
+def seed(database, num_xiaoqu: int):
+    rng = random.Random(0)
+    first_day = datetime(2021, 1, 1, tzinfo=_TZ)
+    days = [first_day + timedelta(days=day) for day in range(_DAYS)]
+    database.get_collection(items.XiaoquInfo.item_name).insert_many(
+        {
+            "xiaoqu_id": _xiaoqu_id(i),
+            "name": f"小区{i}",
+            "district": _district(i),
+            "area": f"板块{i % 20}",
+            "built_year": 1990 + i % 30,
+            "tags": ["近地铁"],
+        }
+        for i in range(num_xiaoqu)
+    )
+    series = []
+    for level, keys in (
+        (rollups.XIAOQU, [_xiaoqu_id(i) for i in range(num_xiaoqu)]),
+        (rollups.DISTRICT, _DISTRICTS),
+    ):
+        for key in keys:
+            for date_ in days:
+                price = rng.randint(30000, 90000)
+                series.append(
+                    {
+                        "level": level,
+                        "key": key,
+                        "date_": date_,
+                        "count": 10,
+                        "sum": price * 10,
+                        "hist": {str(price // 500 * 500): 10},
+                        "mean": float(price),
+                        "median": float(price),
+                    }
+                )
+    database.get_collection(rollups.COLLECTION).insert_many(series)
+    listings = []
+    for i in range(num_xiaoqu):
+        for date_ in days[-2:]:
+            for house in range(_LISTINGS):
+                listings.append(
+                    {
+                        "house_id": 107100000000 + i * 1000 + house,
+                        "date_": date_,
+                        "description": "南北通透 满五唯一",
+                        "room_type": "2室1厅",
+                        "total_area": 89.5,
+                        "towards": "南 北",
+                        "decoration": "精装",
+                        "floor_location": "中楼层",
+                        "building_type": "板楼",
+                        "five_years_status": 5,
+                        "ask_total_w": rng.randint(300, 900),
+                        "ask_avg_price": rng.randint(30000, 90000),
+                        "ask_duration_days": house,
+                        "num_of_followers": house * 2,
+                        "xiaoqu_id": _xiaoqu_id(i),
+                        "xiaoqu_name": f"小区{i}",
+                    }
+                )
+    database.get_collection(items.ForSale.item_name).insert_many(listings)
+    database.get_collection(items.ForSale.item_name).create_indexes(
+        [IndexModel([("xiaoqu_id", ASCENDING), ("date_", ASCENDING)])]
+    )
+
+
+def serve(args):
+    from twisted.internet import reactor, task
+    from twisted.web import server
+
+    database = mongomock.MongoClient(tz_aware=True).get_database(db.DB_NAME)
+    seed(database, args.xiaoqu)
+    queries.record_crawl(database, "lianjia", datetime.now(timezone.utc))
+    service = QueryService(
+        database, ResultCache(args.cache_size, 300), crawl_poll_seconds=args.crawl_poll
+    )
+    port = reactor.listenTCP(0, server.Site(service), interface="127.0.0.1")
+    if args.crawl_every:
+        crawl = task.LoopingCall(
+            lambda: queries.record_crawl(database, "lianjia", datetime.now(timezone.utc))
+        )
+        crawl.start(args.crawl_every, now=False)
+    print(port.getHost().port, flush=True)
+    reactor.run()
+
+
+def _paths(num_xiaoqu: int, rng: random.Random):
+    """Request paths, the popular xiaoqu (a Zipf-like rank) asked for most"""
+    while True:
+        i = min(int(rng.paretovariate(1.2)) - 1, num_xiaoqu - 1)
+        kind = rng.random()
+        if kind < 0.3:
+            yield f"/xiaoqu/{_xiaoqu_id(i)}"
+        elif kind < 0.6:
+            yield f"/xiaoqu/{_xiaoqu_id(i)}/listings?limit=20"
+        elif kind < 0.9:
+            yield f"/prices/xiaoqu?{urlencode({'key': _xiaoqu_id(i), 'since': '2021-10-01'})}"
+        else:
+            yield f"/prices/district?key={quote(_district(i))}&limit=1000"
+
+
+def _client(port: int, deadline: float, seed_: int, num_xiaoqu: int, results: list):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    paths = _paths(num_xiaoqu, random.Random(seed_))
+    while time.perf_counter() < deadline:
+        path = next(paths)
+        started = time.perf_counter()
+        connection.request("GET", path)
+        response = connection.getresponse()
+        body = response.read()
+        elapsed = time.perf_counter() - started
+        assert response.status == 200, (path, body)
+        results.append((elapsed, response.getheader("X-Cache") == "hit"))
+    connection.close()
+
+
+def _first_byte_ms(port: int, path: str) -> tuple:
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    started = time.perf_counter()
+    connection.request("GET", path)
+    response = connection.getresponse()
+    response.read(1)
+    first_byte = time.perf_counter() - started
+    body = response.read()
+    total = time.perf_counter() - started
+    connection.close()
+    return first_byte * 1000, total * 1000, len(body) + 1
+
+
+def run(args, label: str, cache_size: int, crawl_every: float = 0):
+    child = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "tests.bench_web",
+            "--serve",
+            "--xiaoqu",
+            str(args.xiaoqu),
+            "--cache-size",
+            str(cache_size),
+            "--crawl-every",
+            str(crawl_every),
+            "--crawl-poll",
+            str(min(crawl_every, 1) if crawl_every else 5),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        port = int(child.stdout.readline())
+        results: list = []
+        deadline = time.perf_counter() + args.seconds
+        clients = [
+            threading.Thread(
+                target=_client, args=(port, deadline, seed_, args.xiaoqu, results)
+            )
+            for seed_ in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        latencies = sorted(elapsed for elapsed, _ in results)
+        hits = sum(hit for _, hit in results)
+        print(
+            f"{label:<24}{len(results) / args.seconds:>10.1f}"
+            f"{latencies[len(latencies) // 2] * 1000:>10.2f}"
+            f"{latencies[int(len(latencies) * 0.99)] * 1000:>10.2f}"
+            f"{hits / len(results):>10.1%}"
+        )
+        if not cache_size:
+            first_byte_ms, total_ms, size = _first_byte_ms(
+                port, f"/prices/district?key={quote(_DISTRICTS[0])}&limit=1000"
+            )
+            print(
+                f"  {size / 1024:.0f}KB series page: first items after {first_byte_ms:.1f}ms, "
+                f"last after {total_ms:.1f}ms"
+            )
+    finally:
+        child.terminate()
+        child.wait()
+
+
+def main(args):
+    print(
+        f"{args.xiaoqu} xiaoqu x {_DAYS} days, {args.clients} clients for {args.seconds}s each"
+    )
+    print(f"{'':<24}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'hits':>10}")
+    run(args, "no cache", cache_size=0)
+    run(args, "cache", cache_size=1024)
+    run(args, f"cache, crawl every {args.seconds / 4:.1f}s", 1024, crawl_every=args.seconds / 4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--xiaoqu", type=int, default=200)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--cache-size", type=int, default=1024, help=argparse.SUPPRESS)
+    parser.add_argument("--crawl-every", type=float, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--crawl-poll", type=float, default=5, help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+    if parsed.serve:
+        serve(parsed)
+    else:
+        main(parsed)
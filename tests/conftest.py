@@ -0,0 +1,12 @@
+from dataclasses import is_dataclass
+
+import pytest
+
+from .replay import create_spider, load_fixture_pages, replay
+
+
+@pytest.fixture(scope="session")
+def scraped_items():
+    """The items of the recorded fixture pages"""
+    results = replay(create_spider(), load_fixture_pages())
+    return [output for result in results for output in result.outputs if is_dataclass(output)]
@@ -0,0 +1,418 @@
+"""Local stand-in for lianjia, to exercise AccountPoolMiddleware and the JSON fetch mode.
+
+``POST /login`` sets a session cookie for a known username/password and refuses the
+others with a 401. ``/chengjiao/[pg<N>]c<xiaoqu id>/`` lists the deals of a xiaoqu,
+newest first and one day apart, for a valid session and redirects to the login page
+otherwise. A session expires after a few pages.
+
+The app's list endpoints serve the recorded tests/fixtures/lianjia/api_*.json entries,
+repeated under new ids up to the wanted total and paged by offset/limit, and the
+desktop ershoufang pages serve the recorded HTML. The spider reaches the server as its
+http proxy, under the real host names.
+
+Running the module crawls either the deals of a few xiaoqu through three accounts, one
+with a wrong password, or a district and its listings in the JSON fetch mode, one of
+them through a failing endpoint, and prints a JSON summary:
+
+Usage: python -m tests.fake_lianjia [--delay 0.3] [--distributed]
+       python -m tests.fake_lianjia --api [--page-size 25] [--frontier path [--max-pages N]]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+
+import scrapy
+from scrapy.crawler import CrawlerProcess
+
+from dragon_talon.spiders.lianjia import LianjiaSpider
+
+FIXTURE_DIR = pathlib.Path(__file__).parent / "fixtures" / "lianjia"
+NEWEST_DEAL = datetime(2021, 1, 31, tzinfo=timezone(timedelta(hours=8)))
+PAGE_SIZE = 10
+
+_CHENGJIAO_PATH = re.compile(r"^/chengjiao/(?:pg(\d+))?c(\d+)/$")
+_ERSHOUFANG_PATH = re.compile(r"^/ershoufang/(?:pg\d+)?c\d+/$")
+# endpoint -> (fixture, id field)
+_API_FIXTURES = {
+    "/house/community/search": ("api_community", "community_id"),
+    "/house/ershoufang/search": ("api_ershoufang", "house_code"),
+}
+_DEAL = (
+    '<li><a class="img" href="/chengjiao/{house_id}.html"></a>'
+    '<div class="info"><div class="title"><a href="/chengjiao/{house_id}.html">'
+    "小区 2室1厅 60平米</a></div>"
+    '<div class="address"><div class="houseInfo">南 北 | 精装</div>'
+    '<div class="dealDate">{date}</div>'
+    '<div class="totalPrice"><span class="number">480</span>万</div></div>'
+    '<div class="flood"><div class="positionInfo">高楼层(共18层) 板楼</div>'
+    '<div class="unitPrice"><span class="number">68000</span>元/平</div></div>'
+    '<div class="dealCycleeInfo"><span class="dealCycleTxt">'
+    "<span>挂牌500万</span><span>成交周期10天</span></span></div></div></li>"
+)
+
+
+def deal_date(index: int) -> datetime:
+    return NEWEST_DEAL - timedelta(days=index)
+
+
+def chengjiao_page(xiaoqu_id: str, page: int, num_deals: int) -> bytes:
+    total_page = max(1, -(-num_deals // PAGE_SIZE))
+    deals = "".join(
+        _DEAL.format(house_id=int(xiaoqu_id) * 1000 + i, date=deal_date(i).strftime("%Y.%m.%d"))
+        for i in range((page - 1) * PAGE_SIZE, min(page * PAGE_SIZE, num_deals))
+    )
+    page_data = json.dumps({"totalPage": total_page, "curPage": page})
+    return (
+        f'<html><body><ul class="listContent">{deals}</ul>'
+        f'<div class="page-box house-lst-page-box" page-url="/chengjiao/pg{{page}}c{xiaoqu_id}/" '
+        f"page-data='{page_data}'></div></body></html>"
+    ).encode()
+
+
+def api_entries(fixture: str, id_field: str, total: int) -> List[dict]:
+    recorded = json.loads((FIXTURE_DIR / f"{fixture}.json").read_text(encoding="utf-8"))
+    recorded = recorded["data"]["list"]
+    entries = []
+    for i in range(total):
+        entry = dict(recorded[i % len(recorded)])
+        entry[id_field] = str(int(entry[id_field]) + i // len(recorded) * 10 ** 6)
+        entries.append(entry)
+    return entries
+
+
+class _LianjiaHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if self.path != "/login":
+            return self._send(404)
+        form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+        username = form.get("username", [""])[0]
+        with server.lock:
+            server.logins.append(username)
+            if server.accounts.get(username) != form.get("password", [""])[0]:
+                return self._send(401)
+            token = f"{username}-{next(server.token_ids)}"
+            server.tokens[token] = [username, server.session_pages]
+        self._send(200, b"ok", {"Set-Cookie": f"lianjia_token={token}; Path=/"})
+
+    def do_GET(self):
+        server = self.server
+        # absolute urls when the server is the crawler's proxy
+        url = urlsplit(self.path)
+        if url.path in _API_FIXTURES:
+            return self._send_api(url.path, parse_qs(url.query))
+        if _ERSHOUFANG_PATH.match(url.path):
+            return self._send_recorded(url.path, (FIXTURE_DIR / "ershoufang.html").read_bytes())
+        matched = _CHENGJIAO_PATH.match(self.path)
+        if matched is None:
+            return self._send(404)
+        page, xiaoqu_id = int(matched.group(1) or 1), matched.group(2)
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        token = cookie["lianjia_token"].value if "lianjia_token" in cookie else None
+        with server.lock:
+            session = server.tokens.get(token)
+            username = session[0] if session else None
+            server.seen.append({"path": self.path, "account": username, "at": time.monotonic()})
+            if session is None or session[1] <= 0:
+                return self._send(302, headers={"Location": f"/login/?redirect={self.path}"})
+            session[1] -= 1
+        self._send(200, chengjiao_page(xiaoqu_id, page, server.deals[xiaoqu_id]))
+
+    def _send_api(self, path: str, query: Dict[str, List[str]]):
+        server = self.server
+        condition = query["condition"][0]
+        if condition in server.api_errors:
+            body = json.dumps({"errno": 20001, "error": "system busy", "data": None})
+            return self._send_recorded(path, body.encode())
+        offset, limit = int(query["offset"][0]), int(query["limit"][0])
+        fixture, id_field = _API_FIXTURES[path]
+        total = server.api_totals[path]
+        end = offset + limit
+        entries = api_entries(fixture, id_field, total)[offset:end]
+        body = json.dumps(
+            {"errno": 0, "error": "", "data": {"total_count": total, "list": entries}},
+            ensure_ascii=False,
+        )
+        self._send_recorded(path, body.encode(), "application/json")
+
+    def _send_recorded(self, path: str, body: bytes, content_type="text/html; charset=utf-8"):
+        with self.server.lock:
+            self.server.seen.append({"path": path, "account": None, "bytes": len(body)})
+        self._send(200, body, {"Content-Type": content_type})
+
+    def _send(self, status: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None):
+        headers = {"Content-Type": "text/html; charset=utf-8", **(headers or {})}
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeLianjia(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        accounts: Optional[Dict[str, str]] = None,
+        deals: Optional[Dict[str, int]] = None,
+        session_pages: int = 3,
+        api_totals: Optional[Dict[str, int]] = None,
+        api_errors: Set[str] = frozenset(),
+    ):
+        super().__init__(("127.0.0.1", 0), _LianjiaHandler)
+        self.accounts = accounts or {}
+        self.deals = deals or {}
+        self.session_pages = session_pages
+        # endpoint -> total_count, and the conditions the endpoints fail for
+        self.api_totals = api_totals or {}
+        self.api_errors = api_errors
+        self.tokens: Dict[str, list] = {}
+        self.token_ids = itertools.count()
+        self.logins: List[str] = []
+        self.seen: List[dict] = []
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class _ChengjiaoCheckSpider(LianjiaSpider):
+    name = "chengjiao_check"
+    allowed_domains = None
+
+    def __init__(
+        self,
+        base_url: str,
+        xiaoqu_ids: List[str],
+        newest_deal_dates: Dict[str, datetime],
+        **kwargs,
+    ):
+        super().__init__(chengjiao="1", **kwargs)
+        self._base_url = base_url
+        self._xiaoqu_ids = xiaoqu_ids
+        self._newest_deal_dates = newest_deal_dates
+
+    def _load_newest_deal_dates(self):
+        # given, not read from Mongo
+        pass
+
+    async def start(self):  # scrapy >= 2.13
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+        for xiaoqu_id in self._xiaoqu_ids:
+            yield scrapy.Request(
+                f"{self._base_url}/chengjiao/c{xiaoqu_id}/",
+                callback=self._parse_chengjiao,
+                cb_kwargs={"xiaoqu_id": xiaoqu_id, "xiaoqu_name": "小区"},
+                meta=self._CHENGJIAO_PAGE_META,
+            )
+
+
+class _ApiCheckSpider(LianjiaSpider):
+    name = "api_check"
+
+    def __init__(self, district_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self._district_url = district_url
+
+    async def start(self):  # scrapy >= 2.13
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+        yield self._api_request(self._district_url, offset=0)
+
+    def _is_seen(self, request):
+        # no detail page is served, go straight to the listings
+        return True
+
+
+def _run(spider_cls, settings: dict, **spider_kwargs) -> dict:
+    settings = {
+        "DOWNLOAD_DELAY": 0,
+        "ROBOTSTXT_OBEY": False,
+        "LOG_LEVEL": "WARNING",
+        "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor",
+        **settings,
+    }
+    scraped = []
+
+    # signal handlers are weakly referenced, keep it in this frame
+    def item_scraped(item, **kwargs):
+        scraped.append(item)
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(spider_cls)
+    crawler.signals.connect(item_scraped, signal=scrapy.signals.item_scraped)
+    process.crawl(crawler, **spider_kwargs)
+    process.start()
+    return {"items": scraped, "stats": crawler.stats.get_stats()}
+
+
+def crawl_chengjiao(
+    base_url: str,
+    accounts: List[str],
+    xiaoqu_ids: List[str],
+    newest_deal_dates: Dict[str, datetime],
+    delay: float,
+    distributed: bool = False,
+) -> dict:
+    with tempfile.NamedTemporaryFile("wt", suffix=".txt") as accounts_file:
+        # the queue of a one-worker distributed crawl
+        with tempfile.TemporaryDirectory() as queue_dir:
+            accounts_file.write("\n".join(accounts) + "\n")
+            accounts_file.flush()
+            settings = {
+                "DOWNLOADER_MIDDLEWARES": {
+                    "dragon_talon.middelwares.AccountPoolMiddleware": 670,
+                },
+                "LIANJIA_ACCOUNTS_FILE": accounts_file.name,
+                "LIANJIA_LOGIN_URL": f"{base_url}/login",
+                "LIANJIA_ACCOUNT_DELAY": delay,
+                "CONCURRENT_REQUESTS_PER_DOMAIN": 8,
+            }
+            if distributed:
+                settings.update(
+                    SCHEDULER="dragon_talon.distributed.DistributedScheduler",
+                    DISTRIBUTED_QUEUE_BACKEND="dragon_talon.distributed.SqliteRequestQueue",
+                    DISTRIBUTED_SQLITE_PATH=os.path.join(queue_dir, "crawl_queue.sqlite"),
+                    DISTRIBUTED_POLL_SECS=0.1,
+                )
+            return _run(
+                _ChengjiaoCheckSpider,
+                settings,
+                base_url=base_url,
+                newest_deal_dates=newest_deal_dates,
+                xiaoqu_ids=xiaoqu_ids,
+            )
+
+
+def crawl_api(proxy_url: str, page_size: int, frontier_path: str = "", max_pages: int = 0) -> dict:
+    # HttpProxyMiddleware picks the proxy from the environment
+    os.environ["http_proxy"] = proxy_url
+    settings = {
+        "LIANJIA_FETCH_MODE": "api",
+        "LIANJIA_API_URL": "http://app.api.lianjia.com",
+        "LIANJIA_API_PAGE_SIZE": page_size,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": 8,
+        "CLOSESPIDER_PAGECOUNT": max_pages,
+    }
+    if frontier_path:
+        settings.update(
+            SPIDER_MIDDLEWARES={"dragon_talon.frontier.FrontierMiddleware": 50},
+            FRONTIER_PATH=frontier_path,
+            FRONTIER_CHECKPOINT_SECS=0.2,
+        )
+    district_url = "http://sh.lianjia.com/xiaoqu/pudong/su1y4bp5ep10000/"
+    return _run(_ApiCheckSpider, settings, district_url=district_url)
+
+
+def check_chengjiao(args):
+    # 1001 was never crawled, 1002 up to its 13th deal, 1003 up to its newest one
+    deals = {"1001": 45, "1002": 45, "1003": 30}
+    newest_deal_dates = {"1002": deal_date(12), "1003": deal_date(0)}
+    accounts = {"alice": "pw-a", "bob": "pw-b"}
+    with FakeLianjia(accounts, deals, session_pages=3) as server:
+        result = crawl_chengjiao(
+            server.url,
+            ["alice:pw-a", "bob:pw-b", "mallory:wrong"],
+            sorted(deals),
+            newest_deal_dates,
+            args.delay,
+            args.distributed,
+        )
+        fetched = [seen for seen in server.seen if seen["account"] is not None]
+        intervals = {}
+        for account in accounts:
+            times = sorted(seen["at"] for seen in fetched if seen["account"] == account)
+            intervals[account] = min((b - a for a, b in zip(times, times[1:])), default=None)
+        return {
+            "transactions": {
+                xiaoqu_id: sum(item.xiaoqu_id == xiaoqu_id for item in result["items"])
+                for xiaoqu_id in deals
+            },
+            "pages_served": sorted({seen["path"] for seen in fetched}),
+            "logins": sorted(server.logins),
+            "requests_per_account": {
+                account: sum(seen["account"] == account for seen in fetched) for account in accounts
+            },
+            "min_interval": intervals,
+            "pages_skipped": result["stats"].get("lianjia/chengjiao_pages_skipped", 0),
+            "login_failed": result["stats"].get("account_pool/login_failed", 0),
+            "duplicates": result["stats"].get("distributed/duplicates", 0),
+        }
+
+
+def check_api(args):
+    api_totals = {"/house/community/search": 40, "/house/ershoufang/search": 75}
+    # the for-sale endpoint of this xiaoqu fails, its desktop pages are crawled instead
+    failing_xiaoqu = "5011000010037"
+    with FakeLianjia(api_totals=api_totals, api_errors={f"c{failing_xiaoqu}"}) as server:
+        result = crawl_api(server.url, args.page_size, args.frontier, args.max_pages)
+        served: Dict[str, List[int]] = {}
+        for seen in server.seen:
+            kind = "ershoufang_html" if seen["path"].startswith("/ershoufang/") else seen["path"]
+            served.setdefault(kind, []).append(seen["bytes"])
+    for_sales = [item for item in result["items"] if item.item_name == "for_sale"]
+    daily_stats = [item for item in result["items"] if item.item_name == "xiaoqu_daily_stats"]
+    return {
+        "requests": {kind: len(sizes) for kind, sizes in served.items()},
+        "bytes": {kind: sum(sizes) for kind, sizes in served.items()},
+        "xiaoqu_daily_stats": len(daily_stats),
+        "for_sale_xiaoqu": len({item.xiaoqu_id for item in for_sales}),
+        "for_sale_houses": len({(item.xiaoqu_id, item.house_id) for item in for_sales}),
+        "failing_xiaoqu_houses": len(
+            {item.house_id for item in for_sales if item.xiaoqu_id == failing_xiaoqu}
+        ),
+        "api_fallback": result["stats"].get("lianjia/api_fallback", 0),
+        "finish_reason": result["stats"]["finish_reason"],
+        "resumed": result["stats"].get("frontier/resumed", 0),
+        "for_sale_ids": sorted(f"{item.xiaoqu_id}/{item.house_id}" for item in for_sales),
+    }
+
+
+def main(args):
+    summary = check_api(args) if args.api else check_chengjiao(args)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--delay", type=float, default=0.3)
+    parser.add_argument("--api", action="store_true", help="crawl in the JSON fetch mode")
+    parser.add_argument(
+        "--distributed", action="store_true", help="schedule through DistributedScheduler"
+    )
+    parser.add_argument("--page-size", type=int, default=25)
+    parser.add_argument("--frontier", default="", help="FRONTIER_PATH of a resumable crawl")
+    parser.add_argument("--max-pages", type=int, default=0, help="stop after so many pages")
+    main(parser.parse_args())
@@ -0,0 +1,140 @@
+"""Local fake HTTP proxies answering for lianjia, to exercise ProxySessionPoolMiddleware.
+
+A proxy either serves a listing page for any absolute URL it is asked for, or answers
+like an anti-bot gate with a redirect to a captcha page. Running the module crawls
+through a few of them and prints a JSON summary:
+
+Usage: python -m tests.fake_proxy [--pages 30]
+"""
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import scrapy
+from scrapy.crawler import CrawlerProcess
+
+LISTING_BODY = b"<html><body><ul><li class='clear xiaoquListItem'>1</li></ul></body></html>"
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.seen.append(
+                {"url": self.path, "user_agent": self.headers.get("User-Agent", "")}
+            )
+        if server.blocked:
+            self.send_response(302)
+            self.send_header("Location", "https://hip.lianjia.com/captcha?redirect=1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(LISTING_BODY)))
+        self.end_headers()
+        self.wfile.write(LISTING_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeProxy(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, blocked: bool = False):
+        super().__init__(("127.0.0.1", 0), _ProxyHandler)
+        self.blocked = blocked
+        self.seen: List[dict] = []
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class _PoolCheckSpider(scrapy.Spider):
+    name = "pool_check"
+
+    def __init__(self, num_pages: int, **kwargs):
+        super().__init__(**kwargs)
+        self._num_pages = num_pages
+
+    async def start(self):  # scrapy >= 2.13
+        for request in self.start_requests():
+            yield request
+
+    def start_requests(self):
+        for page in range(1, self._num_pages + 1):
+            yield scrapy.Request(
+                f"http://sh.lianjia.com/xiaoqu/pudong/pg{page}/",
+                meta={"throttle_expect_marker": "xiaoquListItem"},
+            )
+
+    def parse(self, response):
+        yield {"url": response.url, "session": response.meta["proxy_session"]}
+
+
+def crawl(proxy_urls: List[str], num_pages: int) -> dict:
+    settings = {
+        "DOWNLOADER_MIDDLEWARES": {
+            "dragon_talon.middelwares.AdaptiveThrottleMiddleware": 650,
+            "dragon_talon.middelwares.ProxySessionPoolMiddleware": 660,
+        },
+        "PROXY_POOL": proxy_urls,
+        "PROXY_POOL_USER_AGENTS": ["agent-a", "agent-b", "agent-c"],
+        "ADAPTIVE_THROTTLE_ENABLED": True,
+        "ADAPTIVE_THROTTLE_MIN_DELAY": 0,
+        "DOWNLOAD_DELAY": 0,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": 1,
+        "ROBOTSTXT_OBEY": False,
+        "LOG_LEVEL": "WARNING",
+        "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor",
+    }
+    scraped = []
+
+    # signal handlers are weakly referenced, keep it in this frame
+    def item_scraped(item, **kwargs):
+        scraped.append(item)
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(_PoolCheckSpider)
+    crawler.signals.connect(item_scraped, signal=scrapy.signals.item_scraped)
+    process.crawl(crawler, num_pages=num_pages)
+    process.start()
+    return {"items": scraped, "stats": crawler.stats.get_stats()}
+
+
+def main(args):
+    with FakeProxy() as good1, FakeProxy() as good2, FakeProxy(blocked=True) as blocked:
+        result = crawl([good1.url, good2.url, blocked.url], args.pages)
+        proxies = {"good1": good1, "good2": good2, "blocked": blocked}
+        summary = {
+            "scraped_urls": sorted(item["url"] for item in result["items"]),
+            "scraped_sessions": sorted({item["session"] for item in result["items"]}),
+            "quarantined": result["stats"].get("proxy_pool/quarantined", 0),
+            "proxy_requests": {name: len(proxy.seen) for name, proxy in proxies.items()},
+            "proxy_user_agents": {
+                name: sorted({seen["user_agent"] for seen in proxy.seen})
+                for name, proxy in proxies.items()
+            },
+        }
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=30)
+    main(parser.parse_args())
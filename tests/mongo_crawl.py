@@ -0,0 +1,34 @@
+"""Write replayed items through MongoPipeline into a mongomock database."""
+
+from unittest import mock
+
+from twisted.internet import defer
+
+from dragon_talon import db
+from dragon_talon.pipelines import MongoPipeline
+
+from .replay import create_spider
+
+
+def crawl(mongo_cli, scraped_items, times: int = 1, **settings):
+    """Write the items `times` times with the given settings, return the crawl database"""
+    spider = create_spider({"MONGO_BATCH_SIZE": 10, **settings})
+    with mock.patch.object(db, "get_mongo_client", return_value=mongo_cli):
+        pipeline = MongoPipeline.from_crawler(spider.crawler)
+    # write on the calling thread, there is no running reactor here
+    with mock.patch(
+        "dragon_talon.pipelines.threads.deferToThread", side_effect=defer.maybeDeferred
+    ):
+        pipeline.open_spider(spider)
+        for _ in range(times):
+            for item in scraped_items:
+                pipeline.process_item(item, spider)
+        pipeline.close_spider(spider)
+    return mongo_cli.get_database(db.DB_NAME)
+
+
+def index_keys(collection) -> set:
+    return {
+        (tuple(field for field, _ in info["key"]), info.get("unique", False))
+        for info in collection.index_information().values()
+    }
@@ -0,0 +1,209 @@
+"""Replay recorded lianjia pages through the spider callbacks without the network.
+
+Pages come either from tests/fixtures/lianjia or from the HTTPCACHE_DIR of a previous
+crawl (SqliteCacheStorage or scrapy's FilesystemCacheStorage).
+"""
+
+import asyncio
+import inspect
+import json
+import pathlib
+import pickle
+import re
+import time
+from dataclasses import asdict, dataclass, is_dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+from unittest import mock
+
+import scrapy
+from scrapy.http import HtmlResponse
+from scrapy.http.headers import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.test import get_crawler
+from w3lib.http import headers_raw_to_dict
+
+from dragon_talon.httpcache import iter_cached_responses
+from dragon_talon.spiders.lianjia import LianjiaSpider
+
+FIXTURE_DIR = pathlib.Path(__file__).parent / "fixtures" / "lianjia"
+EXPECTED_OUTPUT_FILE = FIXTURE_DIR / "expected_output.json"
+REPLAY_DATE = datetime(2021, 1, 18, tzinfo=timezone(timedelta(hours=8)))
+
+
+@dataclass
+class ReplayPage:
+    callback: str
+    response: scrapy.http.Response
+    cb_kwargs: dict
+
+
+@dataclass
+class ReplayResult:
+    page: ReplayPage
+    outputs: list
+    seconds: float
+
+
+def _xiaoqu_kwargs(xiaoqu_id: str) -> dict:
+    return {
+        "xiaoqu_id": xiaoqu_id,
+        "name": "联洋花园",
+        "district": "浦东",
+        "area": "联洋",
+        "built_year": 2005,
+        "tags": [],
+    }
+
+
+def _listing_kwargs(xiaoqu_id: str) -> dict:
+    return {"xiaoqu_id": xiaoqu_id, "xiaoqu_name": "联洋花园"}
+
+
+def _fixture_response(page: str, url: str) -> HtmlResponse:
+    body = (FIXTURE_DIR / f"{page}.html").read_bytes()
+    return HtmlResponse(url=url, body=body, encoding="utf-8")
+
+
+def load_fixture_pages() -> List[ReplayPage]:
+    base_url = "https://sh.lianjia.com"
+    return [
+        ReplayPage(
+            "_parse_home",
+            _fixture_response("home", f"{base_url}/xiaoqu/su1y4bp5ep10000"),
+            {},
+        ),
+        ReplayPage(
+            "_parse_disctrict_first_page",
+            _fixture_response("district", f"{base_url}/xiaoqu/pudong/su1y4bp5ep10000/"),
+            {},
+        ),
+        ReplayPage(
+            "_parse_district_page",
+            _fixture_response("district", f"{base_url}/xiaoqu/pudong/pg2su1y4bp5ep10000/"),
+            {},
+        ),
+        ReplayPage(
+            "_parse_xiaoqu",
+            _fixture_response("xiaoqu", f"{base_url}/xiaoqu/5011000010000/"),
+            _xiaoqu_kwargs("5011000010000"),
+        ),
+        ReplayPage(
+            "_parse_ershoufang",
+            _fixture_response("ershoufang", f"{base_url}/ershoufang/c5011000010000/"),
+            _listing_kwargs("5011000010000"),
+        ),
+        ReplayPage(
+            "_parse_chengjiao",
+            _fixture_response("chengjiao", f"{base_url}/chengjiao/c5011000010000/"),
+            _listing_kwargs("5011000010000"),
+        ),
+    ]
+
+
+# url path -> (callback, xiaoqu id group -> cb_kwargs factory)
+_URL_PATTERNS = [
+    (re.compile(r"^/xiaoqu/su1"), "_parse_home", None),
+    (re.compile(r"^/xiaoqu/(\d+)/?$"), "_parse_xiaoqu", _xiaoqu_kwargs),
+    (re.compile(r"^/xiaoqu/[a-z]+/su1"), "_parse_disctrict_first_page", None),
+    (re.compile(r"^/xiaoqu/[a-z]+/pg\d+su1"), "_parse_district_page", None),
+    (re.compile(r"^/ershoufang/(?:pg\d+)?c(\d+)"), "_parse_ershoufang", _listing_kwargs),
+    (re.compile(r"^/chengjiao/(?:pg\d+)?c(\d+)"), "_parse_chengjiao", _listing_kwargs),
+]
+
+
+def _page_for_response(response: scrapy.http.Response) -> Optional[ReplayPage]:
+    path = response.url.split(".lianjia.com", 1)[-1]
+    for pattern, callback, kwargs_factory in _URL_PATTERNS:
+        matched = pattern.match(path)
+        if matched:
+            cb_kwargs = kwargs_factory(matched.group(1)) if kwargs_factory else {}
+            return ReplayPage(callback, response, cb_kwargs)
+    return None
+
+
+def _cached_response(url: str, status: int, headers: Headers, body: bytes):
+    respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+    return respcls(url=url, headers=headers, status=status, body=body)
+
+
+def load_httpcache_pages(cache_dir: str, spider_name: str = "lianjia") -> Iterator[ReplayPage]:
+    """Read responses stored by SqliteCacheStorage or scrapy's FilesystemCacheStorage"""
+    sqlite_path = pathlib.Path(cache_dir, f"{spider_name}.sqlite")
+    if sqlite_path.exists():
+        for cached in iter_cached_responses(str(sqlite_path)):
+            page = _page_for_response(_cached_response(*cached))
+            if page is not None:
+                yield page
+        return
+    for meta_path in sorted(pathlib.Path(cache_dir, spider_name).glob("*/*/pickled_meta")):
+        entry_dir = meta_path.parent
+        with open(meta_path, "rb") as fs:
+            metadata = pickle.load(fs)
+        headers = Headers(headers_raw_to_dict((entry_dir / "response_headers").read_bytes()))
+        body = (entry_dir / "response_body").read_bytes()
+        url = metadata.get("response_url") or metadata["url"]
+        page = _page_for_response(_cached_response(url, metadata["status"], headers, body))
+        if page is not None:
+            yield page
+
+
+def create_spider(settings: Optional[dict] = None) -> LianjiaSpider:
+    crawler = get_crawler(LianjiaSpider, settings)
+    crawler.spider = LianjiaSpider.from_crawler(crawler)
+    return crawler.spider
+
+
+def replay(spider: LianjiaSpider, pages: List[ReplayPage]) -> List[ReplayResult]:
+    results = []
+    with mock.patch("dragon_talon.spiders.lianjia._lianjia.crawl_date", return_value=REPLAY_DATE):
+        for page in pages:
+            callback = getattr(spider, page.callback)
+            response = page.response
+            if response.request is None:
+                # as the engine hands it to the callback
+                request = scrapy.Request(response.url, callback, cb_kwargs=page.cb_kwargs)
+                response = response.replace(request=request)
+            started = time.perf_counter()
+            outputs = callback(response, **page.cb_kwargs)
+            # parsed in the process pool, see LIANJIA_PARSE_WORKERS
+            if inspect.iscoroutine(outputs):
+                outputs = asyncio.run(outputs)
+            outputs = list(outputs)
+            results.append(ReplayResult(page, outputs, time.perf_counter() - started))
+    return results
+
+
+def _to_record(output) -> dict:
+    if isinstance(output, scrapy.Request):
+        return {
+            "request": output.url,
+            "callback": output.callback.__name__,
+            "cb_kwargs": output.cb_kwargs,
+        }
+    assert is_dataclass(output), f"unexpected callback output {output!r}"
+    fields = asdict(output)
+    fields.pop("crawled_at", None)  # wall clock, not page content
+    for name, value in fields.items():
+        if isinstance(value, datetime):
+            fields[name] = value.isoformat()
+    return {"item": output.item_name, **fields}
+
+
+def to_records(results: List[ReplayResult]) -> Dict[str, list]:
+    records: Dict[str, list] = {}
+    for result in results:
+        key = f"{result.page.callback} {result.page.response.url}"
+        records[key] = [_to_record(output) for output in result.outputs]
+    return records
+
+
+def update_expected_output():
+    records = to_records(replay(create_spider(), load_fixture_pages()))
+    with open(EXPECTED_OUTPUT_FILE, "wt", encoding="utf-8") as fs:
+        json.dump(records, fs, ensure_ascii=False, indent=1, sort_keys=True)
+        fs.write("\n")
+
+
+if __name__ == "__main__":
+    update_expected_output()
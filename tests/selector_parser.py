@@ -0,0 +1,348 @@
+"""Reference implementation of the lianjia parsers built on parsel selectors
+
+The spider parses with dragon_talon.spiders.lianjia._parsers.CompiledParser; this is
+the straightforward version it was derived from, which the tests and benchmarks
+check it against.
+"""
+
+import json
+import re
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import parsel
+
+from dragon_talon import items
+from dragon_talon.spiders.lianjia._parsers import (
+    _XIAOQU_LABEL_TO_FIELD_NAME,
+    PageBox,
+    XiaoquDetail,
+    XiaoquListEntry,
+    _count_dropped,
+)
+
+
+class SelectorParser:
+    """Reference implementation built on parsel selectors"""
+
+    @staticmethod
+    def parse_home(selector: parsel.Selector) -> List[str]:
+        return selector.xpath("//div[@data-role='ershoufang']/div[1]/a/@href").getall()
+
+    @staticmethod
+    def parse_page_box(selector: parsel.Selector) -> Optional[PageBox]:
+        page_box_node = selector.xpath("//div[@class='page-box house-lst-page-box']")
+        page_url = page_box_node.xpath("@page-url").get()
+        page_data = page_box_node.xpath("@page-data").get()
+        if page_url is None or page_data is None:
+            return None
+        page_data = json.loads(page_data)
+        return PageBox(page_url, page_data["totalPage"], page_data.get("curPage", 1))
+
+    @classmethod
+    def parse_district_page(
+        cls, selector: parsel.Selector, date_: datetime, dropped: Optional[Counter] = None
+    ) -> List[XiaoquListEntry]:
+        entries = []
+        xiaoqu_nodes = selector.xpath("//li[@class='clear xiaoquListItem']")
+        for xiaoqu_node in xiaoqu_nodes:
+            xiaoqu_id: Optional[str] = xiaoqu_node.xpath("@data-id").get()
+            if xiaoqu_id is None:
+                continue
+            try:
+                info_node = xiaoqu_node.xpath("div[@class='info']")[0]
+                pos_info = info_node.xpath("div[@class='positionInfo']")[0]
+            except IndexError:
+                continue
+            name = info_node.xpath("div[@class='title']/a/text()").get()
+            district = pos_info.xpath("a[@class='district']/text()").get()
+            area = pos_info.xpath("a[@class='bizcircle']/text()").get()
+            pos_info_txt = pos_info.get()
+            built_matched = re.search(r"(\d+)年建成", pos_info_txt)
+            built_year = built_matched.group(1) if built_matched else None
+            tags = info_node.xpath("div[@class='tagList']/span/text()").getall()
+            entries.append(
+                XiaoquListEntry(
+                    xiaoqu_id=xiaoqu_id,
+                    name=name,
+                    district=district,
+                    area=area,
+                    built_year=int(built_year) if built_year else None,
+                    tags=tags,
+                    detail_url=xiaoqu_node.xpath("a/@href").get(),
+                    ershoufang_url=xiaoqu_node.xpath(".//a[@class='totalSellCount']/@href").get(),
+                    daily_stats=cls._parse_xiaoqu_daily_stats(xiaoqu_node, xiaoqu_id, name, date_),
+                )
+            )
+        _count_dropped(dropped, "xiaoqu", len(xiaoqu_nodes), len(entries))
+        return entries
+
+    @staticmethod
+    def _parse_xiaoqu_daily_stats(
+        xiaoqu_node, xiaoqu_id: str, xiaoqu_name: str, date_: datetime
+    ) -> Optional[items.XiaoquDailyStats]:
+        houseinfo_nodes = xiaoqu_node.xpath("div[@class='info']/div[@class='houseInfo']/a")
+        for_rent = 0
+        deal_in_90days = 0
+        for houseinfo_node in houseinfo_nodes:
+            title = houseinfo_node.xpath("@title").get()
+            if title.endswith("网签"):
+                matched = re.match(r"90天成交(\d+)", houseinfo_node.xpath("text()").get())
+                deal_in_90days = matched.group(1) if matched else None
+            elif title.endswith("租房"):
+                matched = re.match(r"(\d+)套正在出租", houseinfo_node.xpath("text()").get())
+                for_rent = matched.group(1) if matched else None
+        ask_avg_price = xiaoqu_node.xpath(
+            ".//div[@class='xiaoquListItemPrice']/div[@class='totalPrice']/span/text()"
+        ).get()
+        on_sale_count = xiaoqu_node.xpath(".//a[@class='totalSellCount']/span/text()").get()
+        try:
+            return items.XiaoquDailyStats(
+                date_=date_,
+                xiaoqu_id=xiaoqu_id,
+                name=xiaoqu_name,
+                for_rent=int(for_rent),
+                on_sale_count=int(on_sale_count),
+                deal_in_90days=int(deal_in_90days),
+                ask_avg_price=int(ask_avg_price),
+            )
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _fill_label_content(xiaoqu_label: str, xiaoqu_content: str, fields: dict):
+        field_name = _XIAOQU_LABEL_TO_FIELD_NAME.get(xiaoqu_label)
+        if field_name is None:
+            return
+        if field_name == "num_of_buildings" or field_name == "num_of_units":
+            num_matched = re.match(r"(\d+).*", xiaoqu_content)
+            if num_matched:
+                fields[field_name] = int(num_matched.group(1))
+            else:
+                fields[field_name] = -1
+        else:
+            fields[field_name] = xiaoqu_content
+
+    @classmethod
+    def parse_xiaoqu(cls, selector: parsel.Selector) -> XiaoquDetail:
+        fields: Dict = {}
+        xiaoqu_info_items = selector.xpath("//div[@class='xiaoquInfoItem']")
+        for info_item in xiaoqu_info_items:
+            info_label = info_item.xpath("span[@class='xiaoquInfoLabel']/text()").get()
+            if info_label == "附近门店":
+                xiaoqu_latitude = info_item.xpath(
+                    "span[@class='xiaoquInfoContent']/span/@xiaoqu"
+                ).get()
+                try:
+                    north_latitude, east_latitude = json.loads(xiaoqu_latitude)
+                except TypeError:
+                    continue
+                else:
+                    fields["north_latitude"] = north_latitude
+                    fields["east_latitude"] = east_latitude
+            else:
+                info_content = info_item.xpath("span[@class='xiaoquInfoContent']/text()").get()
+                cls._fill_label_content(info_label, info_content, fields)
+        return XiaoquDetail(
+            fields=fields,
+            ershoufang_url=selector.xpath("//div[@class='goodSellHeader clear']/a/@href").get(),
+            chengjiao_url=selector.xpath("//div[@id='frameDeal']/a/@href").get(),
+        )
+
+    @staticmethod
+    def parse_chengjiao(
+        selector: parsel.Selector,
+        xiaoqu_id: str,
+        xiaoqu_name: str,
+        dropped: Optional[Counter] = None,
+    ) -> List[items.Transaction]:
+        transactions = []
+        li_nodes = selector.xpath("//ul[@class='listContent']/li")
+        for li_node in li_nodes:
+            transaction = SelectorParser._parse_transaction(li_node, xiaoqu_id, xiaoqu_name)
+            if transaction is not None:
+                transactions.append(transaction)
+        _count_dropped(dropped, "chengjiao", len(li_nodes), len(transactions))
+        return transactions
+
+    @staticmethod
+    def _parse_transaction(li_node, xiaoqu_id: str, xiaoqu_name: str) -> Optional[items.Transaction]:
+        trans_url = li_node.xpath("a/@href").get()
+        house_id_matched = re.search(r"/(\d+).html", trans_url)
+        if not house_id_matched:
+            return None
+        try:
+            house_id = int(house_id_matched.group(1))
+        except ValueError:
+            return None
+        trans_node = li_node.xpath("div[@class='info']")
+        title = trans_node.xpath("div[@class='title']/a/text()").get()
+        splitted_title = title.split()
+        if len(splitted_title) < 3 or splitted_title[1] == "车位":
+            return None
+        total_area_matched = re.match(r"(\d+\.{0,1}\d*)平米", splitted_title[2])
+        if not total_area_matched:
+            return None
+        deal = SelectorParser._parse_deal(trans_node)
+        if deal is None:
+            return None
+        return items.Transaction(
+            house_id=house_id,
+            room_type=splitted_title[1],
+            total_area=float(total_area_matched.group(1)),
+            xiaoqu_id=xiaoqu_id,
+            xiaoqu_name=xiaoqu_name,
+            **deal,
+        )
+
+    @staticmethod
+    def _parse_deal(trans_node) -> Optional[dict]:
+        address_node = trans_node.xpath("div[@class='address']")
+        houseinfo_text = address_node.xpath("div[@class='houseInfo']/text()").get()
+        towards, decoration = houseinfo_text.split("|")
+
+        trans_date_str = address_node.xpath("div[@class='dealDate']/text()").get()
+        trans_date = datetime.strptime(trans_date_str, "%Y.%m.%d")
+        trans_date = trans_date.replace(tzinfo=timezone(timedelta(hours=8)))
+
+        delt_total_w = address_node.xpath(
+            "div[@class='totalPrice']/span[@class='number']/text()"
+        ).get()
+        try:
+            delt_total_w = int(delt_total_w)
+        except ValueError:
+            return None
+        flood_node = trans_node.xpath("div[@class='flood']")
+        positioninfo_text = flood_node.xpath("div[@class='positionInfo']/text()").get()
+        floor_location, building_type = positioninfo_text.split()
+        delt_avg_price = flood_node.xpath(
+            "div[@class='unitPrice']/span[@class='number']/text()"
+        ).get()
+        try:
+            delt_avg_price = int(delt_avg_price)
+        except ValueError:
+            return None
+        deal_cycle = SelectorParser._parse_deal_cycle(trans_node)
+        if deal_cycle is None:
+            return None
+        return dict(
+            date_=trans_date,
+            towards=towards.strip(),
+            decoration=decoration.strip(),
+            floor_location=floor_location,
+            building_type=building_type,
+            delt_avg_price=delt_avg_price,
+            delt_total_w=delt_total_w,
+            ask_total_w=deal_cycle[0],
+            ask_duration_days=deal_cycle[1],
+        )
+
+    @staticmethod
+    def _parse_deal_cycle(trans_node) -> Optional[Tuple[int, int]]:
+        deal_cycle_node = trans_node.xpath(
+            "div[@class='dealCycleeInfo']/span[@class='dealCycleTxt']"
+        )
+        deal_cycle_txts = deal_cycle_node.xpath("span/text()").getall()
+        if len(deal_cycle_txts) < 2:
+            return None
+        ask_price_matched = re.match(r"挂牌(\d+)万", deal_cycle_txts[0])
+        ask_duration_matched = re.match(r"成交周期(\d+)天", deal_cycle_txts[1])
+        if not ask_price_matched or not ask_duration_matched:
+            return None
+        try:
+            return int(ask_price_matched.group(1)), int(ask_duration_matched.group(1))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def parse_ershoufang(
+        selector: parsel.Selector,
+        date_: datetime,
+        xiaoqu_id: str,
+        xiaoqu_name: str,
+        dropped: Optional[Counter] = None,
+    ) -> List[items.ForSale]:
+        for_sales = []
+        sale_nodes = selector.xpath("//div[@class='leftContent']/ul/li")
+        for sale_node in sale_nodes:
+            info_node = sale_node.xpath("div[@class='info clear']")
+            title_node = info_node.xpath("div[@class='title']")
+            detail_url = title_node.xpath("a/@href").get()
+            house_id_matched = re.search(r"/(\d+).html", detail_url)
+            if not house_id_matched:
+                continue
+            try:
+                house_id = int(house_id_matched.group(1))
+            except ValueError:
+                continue
+            description = title_node.xpath("a/text()").get()
+
+            houseinfo_txt = info_node.xpath(
+                "div[@class='address']/div[@class='houseInfo']/text()"
+            ).get()
+            splitted_houseinfo = houseinfo_txt.split("|")
+            (
+                room_type,
+                area_txt,
+                towards,
+                decoration,
+                floor_location,
+                *_,
+                building_type,
+            ) = [entry.strip() for entry in splitted_houseinfo]
+            total_area_matched = re.match(r"(\d+\.{0,1}\d*)平米", area_txt)
+            if not total_area_matched:
+                continue
+            total_area = float(total_area_matched.group(1))
+            tag_node = info_node.xpath("div[@class='tag']")
+            gt_2_years = tag_node.xpath("span[@class='five']").get()
+            gt_5_years = tag_node.xpath("span[@class='taxfree']").get()
+            if gt_2_years:
+                five_years_status = 2
+            elif gt_5_years:
+                five_years_status = 5
+            else:
+                five_years_status = 0
+            priceinfo_node = info_node.xpath("div[@class='priceInfo']")
+            total_price = int(
+                float(
+                    priceinfo_node.xpath("div[@class='totalPrice totalPrice2']/span/text()").get()
+                )
+            )
+            avg_price = int(priceinfo_node.xpath("div[@class='unitPrice']/@data-price").get())
+            followinfo_txt = info_node.xpath("div[@class='followInfo']/text()").get()
+            followers_txt, ask_duration_txt = followinfo_txt.split("/")
+            followers_matched = re.match(r"(\d+)人关注", followers_txt.strip())
+            if followers_matched:
+                num_of_followers = int(followers_matched.group(1))
+            else:
+                num_of_followers = 0
+            ask_duration_matched = re.match(r"(\d+)天以前发布", ask_duration_txt.strip())
+            if ask_duration_matched:
+                ask_duration_days = int(ask_duration_matched.group(1))
+            else:
+                ask_duration_days = 0
+
+            for_sales.append(
+                items.ForSale(
+                    house_id=house_id,
+                    date_=date_,
+                    description=description,
+                    room_type=room_type,
+                    total_area=total_area,
+                    towards=towards,
+                    decoration=decoration,
+                    floor_location=floor_location,
+                    building_type=building_type,
+                    five_years_status=five_years_status,
+                    ask_total_w=total_price,
+                    ask_avg_price=avg_price,
+                    num_of_followers=num_of_followers,
+                    ask_duration_days=ask_duration_days,
+                    xiaoqu_id=xiaoqu_id,
+                    xiaoqu_name=xiaoqu_name,
+                )
+            )
+        _count_dropped(dropped, "ershoufang", len(sale_nodes), len(for_sales))
+        return for_sales
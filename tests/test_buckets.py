@@ -0,0 +1,68 @@
+"""Tests of the monthly bucketed storage layout."""
+
+import dataclasses
+from datetime import timedelta
+from unittest import mock
+
+import mongomock
+from twisted.internet import defer
+
+from dragon_talon import buckets, db, items
+from dragon_talon.pipelines import MongoPipeline
+
+from .replay import create_spider, load_fixture_pages, replay
+
+NUM_DAYS = 3
+
+
+def _write_days(layout: str):
+    spider = create_spider({"MONGO_BATCH_SIZE": 50, "MONGO_STORAGE_LAYOUT": layout})
+    first_day = [
+        output
+        for result in replay(spider, load_fixture_pages())
+        for output in result.outputs
+        if isinstance(output, (items.ForSale, items.XiaoquDailyStats))
+    ]
+    # same listings crawled on following days, with prices moving
+    scraped_items = [
+        dataclasses.replace(
+            item, date_=item.date_ + timedelta(days=day), ask_avg_price=item.ask_avg_price + day
+        )
+        for day in range(NUM_DAYS)
+        for item in first_day
+    ]
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    with mock.patch.object(db, "get_mongo_client", return_value=mongo_cli):
+        pipeline = MongoPipeline.from_crawler(spider.crawler)
+    with mock.patch(
+        "dragon_talon.pipelines.threads.deferToThread", side_effect=defer.maybeDeferred
+    ):
+        for item in scraped_items:
+            pipeline.process_item(item, spider)
+        pipeline.close_spider(spider)
+    return mongo_cli.get_database(db.DB_NAME), scraped_items
+
+
+def test_bucket_layout_keeps_one_document_per_month():
+    db_inst, scraped_items = _write_days("bucket")
+    for item_cls in (items.ForSale, items.XiaoquDailyStats):
+        collection = db_inst.get_collection(buckets.bucket_collection_name(item_cls))
+        (key_field,) = item_cls.bucket_key
+        entity_ids = {getattr(item, key_field) for item in scraped_items if type(item) is item_cls}
+        assert collection.count_documents({}) == len(entity_ids)
+        assert db_inst.get_collection(item_cls.item_name).count_documents({}) == 0
+
+
+def test_price_history_reads_back_daily_documents():
+    db_inst, scraped_items = _write_days("bucket")
+    for_sale = [item for item in scraped_items if isinstance(item, items.ForSale)]
+    house_id = for_sale[0].house_id
+    expected = sorted(
+        (item.to_document() for item in for_sale if item.house_id == house_id),
+        key=lambda doc: doc["date_"],
+    )
+    collection = db_inst.get_collection(buckets.bucket_collection_name(items.ForSale))
+    history = list(buckets.price_history(collection, items.ForSale, house_id))
+    assert history == expected
+    since = expected[1]["date_"]
+    assert list(buckets.price_history(collection, items.ForSale, house_id, since)) == expected[1:]
@@ -0,0 +1,162 @@
+"""Tests of ChangeDetectionPipeline across consecutive crawls."""
+
+import dataclasses
+from datetime import timedelta
+from unittest import mock
+
+import mongomock
+import pytest
+from twisted.internet import defer
+
+from dragon_talon import db, items, signals
+from dragon_talon.pipelines import ChangeDetectionPipeline
+
+from .replay import create_spider, load_fixture_pages, replay
+
+
+@pytest.fixture(scope="module")
+def for_sale():
+    spider = create_spider()
+    return [
+        output
+        for result in replay(spider, load_fixture_pages())
+        for output in result.outputs
+        if isinstance(output, items.ForSale)
+    ]
+
+
+def _crawl(index_path, scraped_items, mongo_cli=None, listed_xiaoqu_ids=None, reason="finished"):
+    """Run one crawl through the pipeline, return (forwarded items, written events)
+
+    The list pages of `listed_xiaoqu_ids` (default: every scraped xiaoqu) were all parsed.
+    """
+    spider = create_spider({"CHANGE_DETECTION_INDEX_PATH": str(index_path), "MONGO_BATCH_SIZE": 2})
+    crawler = spider.crawler
+    mongo_cli = mongo_cli or mongomock.MongoClient(tz_aware=True)
+    collection = mongo_cli.get_database(db.DB_NAME).get_collection(items.ListingEvent.item_name)
+    stored_ids = {doc["_id"] for doc in collection.find()}
+    pipeline = ChangeDetectionPipeline.from_crawler(crawler)
+    if listed_xiaoqu_ids is None:
+        listed_xiaoqu_ids = {item.xiaoqu_id for item in scraped_items}
+    with mock.patch.object(db, "get_mongo_client", return_value=mongo_cli), mock.patch(
+        "dragon_talon.pipelines.threads.deferToThread", side_effect=defer.maybeDeferred
+    ):
+        pipeline.open_spider(spider)
+        forwarded = []
+        for item in scraped_items:
+            dfd = defer.maybeDeferred(pipeline.process_item, item, spider)
+            dfd.addCallback(forwarded.append)
+        for xiaoqu_id in listed_xiaoqu_ids:
+            crawler.signals.send_catch_log(
+                signals.listings_complete, xiaoqu_id=xiaoqu_id, spider=spider
+            )
+        assert pipeline.close_spider(spider).called
+        pipeline._spider_closed(spider, reason)
+    events = [
+        items.ListingEvent(**{name: doc[name] for name in items.ListingEvent.__slots__})
+        for doc in collection.find({"_id": {"$nin": list(stored_ids)}})
+    ]
+    return forwarded, events
+
+
+def _next_day(item: items.ForSale, **changes) -> items.ForSale:
+    changes.setdefault("num_of_followers", item.num_of_followers + 1)
+    return dataclasses.replace(item, date_=item.date_ + timedelta(days=1), **changes)
+
+
+def test_only_new_and_changed_listings_are_forwarded(tmp_path, for_sale):
+    index_path = tmp_path / "listing_index.sqlite"
+    forwarded, events = _crawl(index_path, for_sale)
+    assert forwarded == for_sale
+    assert {event.kind for event in events} == {items.ListingEvent.NEW}
+    assert len(events) == len(for_sale)
+
+    dropped, changed, delisted, *unchanged = for_sale
+    next_day = [
+        _next_day(dropped, ask_total_w=dropped.ask_total_w - 10),
+        _next_day(changed, decoration=changed.decoration + "x"),
+    ] + [_next_day(item) for item in unchanged]
+    forwarded, events = _crawl(index_path, next_day)
+
+    assert forwarded[:2] == next_day[:2]
+    assert all(isinstance(item, items.ListingHeartbeat) for item in forwarded[2:])
+    assert [item.num_of_followers for item in forwarded[2:]] == [
+        item.num_of_followers for item in next_day[2:]
+    ]
+    kind2house_id = {event.kind: event.house_id for event in events}
+    assert kind2house_id == {
+        items.ListingEvent.PRICE_DROP: dropped.house_id,
+        items.ListingEvent.CHANGED: changed.house_id,
+        items.ListingEvent.DELISTED: delisted.house_id,
+    }
+    (drop_event,) = [event for event in events if event.kind == items.ListingEvent.PRICE_DROP]
+    assert drop_event.prev_ask_total_w - drop_event.ask_total_w == 10
+
+
+def test_only_a_finished_crawl_delists_and_only_in_listed_xiaoqus(tmp_path, for_sale):
+    index_path = tmp_path / "listing_index.sqlite"
+    _crawl(index_path, for_sale)
+    delisted, *kept = for_sale
+    next_day = [_next_day(item) for item in kept]
+
+    def delisted_ids(events):
+        return [event.house_id for event in events if event.kind == items.ListingEvent.DELISTED]
+
+    # interrupted, or a list page of the xiaoqu failed: its missing listings may be on it
+    assert delisted_ids(_crawl(index_path, next_day, reason="shutdown")[1]) == []
+    assert delisted_ids(_crawl(index_path, next_day, listed_xiaoqu_ids=set())[1]) == []
+    assert delisted_ids(_crawl(index_path, next_day)[1]) == [delisted.house_id]
+    assert delisted_ids(_crawl(index_path, next_day)[1]) == []
+
+
+def test_index_is_warmed_from_latest_documents_and_heartbeats(tmp_path, for_sale):
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    database = mongo_cli.get_database(db.DB_NAME)
+    changed, relisted, *unchanged = for_sale
+    changed_next_day = _next_day(changed, decoration=changed.decoration + "x")
+    database.get_collection(items.ForSale.item_name).insert_many(
+        [item.to_document() for item in for_sale] + [changed_next_day.to_document()]
+    )
+    # the crawl of the next day stored heartbeats of the unchanged listings only
+    database.get_collection(items.ListingHeartbeat.item_name).insert_many(
+        [
+            {"house_id": item.house_id, "date_": _next_day(item).date_, "xiaoqu_id": item.xiaoqu_id}
+            for item in unchanged
+        ]
+    )
+    database.get_collection(items.ListingEvent.item_name).insert_one(
+        {
+            "house_id": relisted.house_id,
+            "date_": _next_day(relisted).date_,
+            "kind": items.ListingEvent.DELISTED,
+        }
+    )
+    third_day = [_next_day(changed_next_day)] + [
+        _next_day(_next_day(item)) for item in [relisted] + unchanged
+    ]
+    forwarded, events = _crawl(tmp_path / "listing_index.sqlite", third_day, mongo_cli)
+    assert [(event.kind, event.house_id) for event in events] == [
+        (items.ListingEvent.NEW, relisted.house_id)
+    ]
+    assert forwarded[1] == third_day[1]
+    assert all(isinstance(item, items.ListingHeartbeat) for item in forwarded[:1] + forwarded[2:])
+
+
+def test_events_are_written_in_batches_and_on_checkpoint(tmp_path, for_sale):
+    spider = create_spider(
+        {"CHANGE_DETECTION_INDEX_PATH": str(tmp_path / "index.sqlite"), "MONGO_BATCH_SIZE": 2}
+    )
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    collection = mongo_cli.get_database(db.DB_NAME).get_collection(items.ListingEvent.item_name)
+    pipeline = ChangeDetectionPipeline.from_crawler(spider.crawler)
+    with mock.patch.object(db, "get_mongo_client", return_value=mongo_cli), mock.patch(
+        "dragon_talon.pipelines.threads.deferToThread", side_effect=defer.maybeDeferred
+    ):
+        pipeline.open_spider(spider)
+        for item in for_sale[:3]:
+            pipeline.process_item(item, spider)
+        assert collection.count_documents({}) == 2
+        spider.crawler.signals.send_catch_log(signals.checkpoint)
+        assert collection.count_documents({}) == 3
+        pipeline.close_spider(spider)
+        pipeline._spider_closed(spider, "shutdown")
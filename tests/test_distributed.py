@@ -0,0 +1,153 @@
+"""Tests of DistributedScheduler workers sharing a request queue."""
+
+from unittest import mock
+
+import mongomock
+import pytest
+import scrapy
+from scrapy.http import HtmlResponse
+from twisted.python.failure import Failure
+
+from dragon_talon import distributed
+from dragon_talon.dupefilter import SeenUrlDupeFilter, SeenUrlIndex, compact_fingerprint
+
+from .replay import create_spider
+
+
+@pytest.fixture(params=["mongo", "sqlite"])
+def make_queue(request, tmp_path):
+    mongo_cli = mongomock.MongoClient()
+    path = str(tmp_path / "crawl_queue.sqlite")
+
+    def make_queue():
+        if request.param == "mongo":
+            return distributed.MongoRequestQueue(mongo_cli)
+        return distributed.SqliteRequestQueue(path)
+
+    return make_queue
+
+
+def _worker(make_queue, worker_id: str, **kwargs) -> distributed.DistributedScheduler:
+    spider = create_spider({"FRONTIER_JOB": "lianjia-test"})
+    scheduler = distributed.DistributedScheduler(
+        spider.crawler, make_queue(), "lianjia-test", worker_id, poll_secs=0, **kwargs
+    )
+    # no reactor here, the heartbeat is driven by the tests
+    with mock.patch.object(distributed.task.LoopingCall, "start"):
+        scheduler.open(spider)
+    return scheduler
+
+
+def _request(spider, path: str, **kwargs) -> scrapy.Request:
+    return scrapy.Request(
+        f"https://sh.lianjia.com{path}", callback=spider._parse_district_page, **kwargs
+    )
+
+
+def test_workers_seed_once_and_split_requests(make_queue):
+    worker1 = _worker(make_queue, "worker-1", lease_batch=2)
+    worker2 = _worker(make_queue, "worker-2", lease_batch=2)
+    spider = worker1._spider
+    home = _request(spider, "/xiaoqu/", dont_filter=True)
+    assert worker1.enqueue_request(home)
+    assert not worker2.enqueue_request(home.copy())
+    for page in range(2, 5):
+        assert worker2.enqueue_request(_request(spider, f"/xiaoqu/pudong/pg{page}/"))
+
+    urls1 = [worker1.next_request().url for _ in range(2)]
+    urls2 = [worker2.next_request().url for _ in range(2)]
+    assert len(set(urls1 + urls2)) == 4
+    assert worker1.next_request() is None
+    assert worker2.next_request() is None
+
+
+def test_expired_leases_move_to_another_worker(make_queue):
+    worker1 = _worker(make_queue, "worker-1", lease_secs=60)
+    worker2 = _worker(make_queue, "worker-2", lease_secs=60)
+    spider = worker1._spider
+    worker1.enqueue_request(_request(spider, "/xiaoqu/pudong/pg2/"))
+    assert worker1.next_request() is not None
+    assert worker2.next_request() is None
+
+    # worker-1 died, its lease runs out
+    with mock.patch.object(distributed.time, "time", return_value=distributed.time.time() + 61):
+        request = worker2.next_request()
+    assert request.url.endswith("/xiaoqu/pudong/pg2/")
+    assert request.callback == worker2._spider._parse_district_page
+
+    worker2._request_left(request, spider)
+    assert worker2._queue.unfinished("lianjia-test", 3) == 1
+    worker2._page_parsed(HtmlResponse(request.url, request=request), spider)
+    assert worker2._queue.unfinished("lianjia-test", 3) == 0
+
+
+def test_downloaded_requests_are_acked_once_parsed(make_queue):
+    worker1 = _worker(make_queue, "worker-1", lease_secs=60, lease_batch=3)
+    worker2 = _worker(make_queue, "worker-2", lease_secs=60)
+    spider = worker1._spider
+    for page in range(2, 5):
+        worker1.enqueue_request(_request(spider, f"/xiaoqu/pudong/pg{page}/"))
+    parsed, failed, crashed = [worker1.next_request() for _ in range(3)]
+    for request in (parsed, failed, crashed):
+        worker1._request_left(request, spider)
+    worker1._page_parsed(HtmlResponse(parsed.url, request=parsed), spider)
+    worker1._spider_error(Failure(ValueError()), HtmlResponse(failed.url, request=failed), spider)
+    assert worker1._queue.unfinished("lianjia-test", 3) == 1
+
+    # worker-1 died while parsing the last one
+    with mock.patch.object(distributed.time, "time", return_value=distributed.time.time() + 61):
+        request = worker2.next_request()
+    assert request.url == crashed.url
+
+
+def test_requests_not_reaching_their_callback_are_acked_on_idle(make_queue):
+    worker = _worker(make_queue, "worker-1")
+    spider = worker._spider
+    worker.enqueue_request(_request(spider, "/xiaoqu/pudong/pg2/"))
+    worker._request_left(worker.next_request(), spider)
+    worker._spider_idle(spider)
+    assert worker._queue.unfinished("lianjia-test", 3) == 0
+
+
+def test_local_requests_skip_the_shared_queue(make_queue):
+    worker1 = _worker(make_queue, "worker-1")
+    worker2 = _worker(make_queue, "worker-2")
+    spider = worker1._spider
+    login = _request(spider, "/login/", meta={"distributed_local": True}, dont_filter=True)
+    assert worker1.enqueue_request(login)
+    assert worker2.next_request() is None
+    assert worker1.next_request() is login
+    assert worker1._queue.unfinished("lianjia-test", 3) == 0
+
+
+def test_the_dupefilter_is_consulted(make_queue, tmp_path):
+    index = SeenUrlIndex(str(tmp_path / "seen_urls.sqlite"))
+    dupefilter = SeenUrlDupeFilter(index, [], 3600)
+    worker = _worker(make_queue, "worker-1", dupefilter=dupefilter)
+    spider = worker._spider
+    fresh = _request(spider, "/xiaoqu/5011000010000/")
+    index.add(compact_fingerprint(fresh), distributed.time.time() + 3600)
+    assert not worker.enqueue_request(fresh)
+    assert worker.enqueue_request(fresh.replace(dont_filter=True))
+    assert worker.enqueue_request(_request(spider, "/xiaoqu/pudong/pg2/"))
+    worker.close("finished")
+
+
+def test_heartbeat_keeps_leases_and_close_releases_buffered(make_queue):
+    worker1 = _worker(make_queue, "worker-1", lease_secs=60, lease_batch=2)
+    worker2 = _worker(make_queue, "worker-2", lease_secs=60)
+    spider = worker1._spider
+    for page in range(2, 4):
+        worker1.enqueue_request(_request(spider, f"/xiaoqu/pudong/pg{page}/"))
+    downloading = worker1.next_request()
+    later = distributed.time.time() + 50
+    with mock.patch.object(distributed.time, "time", return_value=later):
+        worker1._renew_leases()
+    with mock.patch.object(distributed.time, "time", return_value=later + 30):
+        assert worker2.next_request() is None
+
+    worker1.close("shutdown")
+    released = worker2.next_request()
+    assert released is not None and released.url != downloading.url
+    with pytest.raises(distributed.DontCloseSpider):
+        worker2._spider_idle(spider)
@@ -0,0 +1,93 @@
+"""Tests for the persistent seen-url dupefilter."""
+
+import pytest
+from scrapy import Request
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+
+from dragon_talon import signals
+from dragon_talon.dupefilter import SeenUrlDupeFilter, SeenUrlIndex
+from dragon_talon.middelwares import PageParsedMiddleware
+
+TTLS = [(r"/xiaoqu/\d+/", 30 * 24 * 3600), (r"/ershoufang/", 0)]
+
+
+def fetched(dupefilter, request, status=200, body=b""):
+    dupefilter._page_parsed(Response(request.url, status=status, body=body, request=request), None)
+
+
+def test_filters_within_run_and_until_ttl_expires(tmp_path):
+    path = str(tmp_path / "seen.sqlite")
+    detail = Request("https://sh.lianjia.com/xiaoqu/5011000010000/")
+    listing = Request("https://sh.lianjia.com/ershoufang/c5011000010000/")
+
+    dupefilter = SeenUrlDupeFilter(SeenUrlIndex(path), TTLS, default_ttl=3600)
+    dupefilter.open()
+    assert not dupefilter.request_seen(detail)
+    assert not dupefilter.request_seen(listing)
+    assert dupefilter.request_seen(detail)
+    fetched(dupefilter, detail)
+    fetched(dupefilter, listing)
+    dupefilter.close("finished")
+
+    dupefilter = SeenUrlDupeFilter(SeenUrlIndex(path), TTLS, default_ttl=3600)
+    dupefilter.open()
+    assert dupefilter.request_seen(detail)
+    # expired listing page is scheduled again
+    assert not dupefilter.request_seen(listing)
+    dupefilter.close("finished")
+
+
+def test_failed_responses_are_not_recorded(tmp_path):
+    path = str(tmp_path / "seen.sqlite")
+    detail = Request("https://sh.lianjia.com/xiaoqu/5011000010000/")
+    dupefilter = SeenUrlDupeFilter(SeenUrlIndex(path), TTLS, default_ttl=3600)
+    dupefilter.request_seen(detail)
+    fetched(dupefilter, detail, status=302)
+    dupefilter.close("shutdown")
+
+    dupefilter = SeenUrlDupeFilter(SeenUrlIndex(path), TTLS, default_ttl=3600)
+    assert not dupefilter.request_seen(detail)
+
+
+def test_pages_the_throttle_gave_up_on_are_not_recorded(tmp_path):
+    path = str(tmp_path / "seen.sqlite")
+    district = Request(
+        "https://sh.lianjia.com/xiaoqu/pudong/", meta={"throttle_expect_marker": "xiaoquListItem"}
+    )
+    captcha = Request("https://hip.lianjia.com/captcha?redirect=1")
+    dupefilter = SeenUrlDupeFilter(SeenUrlIndex(path), TTLS, default_ttl=3600)
+    fetched(dupefilter, district, body=b"<html>busy</html>")
+    fetched(dupefilter, captcha)
+    dupefilter.close("finished")
+
+    dupefilter = SeenUrlDupeFilter(SeenUrlIndex(path), TTLS, default_ttl=3600)
+    assert not dupefilter.request_seen(district)
+    assert not dupefilter.request_seen(captcha)
+
+
+def test_page_parsed_is_sent_after_the_callback_output_only():
+    crawler = get_crawler()
+    parsed = []
+
+    # signal handlers are weakly referenced, keep it in this frame
+    def page_parsed(response, spider):
+        parsed.append(response.url)
+
+    crawler.signals.connect(page_parsed, signal=signals.page_parsed)
+    middleware = PageParsedMiddleware.from_crawler(crawler)
+    response = Response("https://sh.lianjia.com/xiaoqu/5011000010000/")
+
+    def callback(fail: bool):
+        yield {"name": "联洋花园"}
+        assert not parsed
+        if fail:
+            raise ValueError("layout changed")
+
+    with pytest.raises(ValueError):
+        list(middleware.process_spider_output(response, callback(fail=True), None))
+    assert parsed == []
+    assert list(middleware.process_spider_output(response, callback(fail=False), None)) == [
+        {"name": "联洋花园"}
+    ]
+    assert parsed == [response.url]
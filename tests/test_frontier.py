@@ -0,0 +1,165 @@
+"""Tests for the resumable crawl frontier."""
+
+import json
+import pathlib
+import sqlite3
+import subprocess
+import sys
+from unittest import mock
+
+from scrapy.http import HtmlResponse
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.test import get_crawler
+
+from dragon_talon.frontier import FrontierMiddleware, SqliteFrontier
+from dragon_talon.spiders.lianjia import LianjiaSpider
+
+from .fake_lianjia import api_entries
+from .replay import load_fixture_pages
+
+
+def create_middleware(tmp_path, job="lianjia-test"):
+    crawler = get_crawler(
+        LianjiaSpider, {"FRONTIER_PATH": str(tmp_path / "frontier.sqlite"), "FRONTIER_JOB": job}
+    )
+    spider = LianjiaSpider.from_crawler(crawler)
+    return FrontierMiddleware.from_crawler(crawler), spider
+
+
+def checkpoint(middleware):
+    # no pipeline is connected to the signal, so it is sent without a reactor
+    signal_manager = middleware._crawler.signals
+    with mock.patch.object(signal_manager, "send_catch_log_async", mock.AsyncMock()):
+        dfd = middleware._checkpoint()
+    assert dfd.called
+
+
+def parse_home(middleware, spider, start_request):
+    home_page = load_fixture_pages()[0]
+    response = HtmlResponse(
+        start_request.url, body=home_page.response.body, encoding="utf-8", request=start_request
+    )
+    result = spider._parse_home(response)
+    return list(middleware.process_spider_output(response, result, spider))
+
+
+def test_restart_resumes_unfinished_requests(tmp_path):
+    middleware, spider = create_middleware(tmp_path)
+    [start_request] = middleware.process_start_requests(spider.start_requests(), spider)
+    district_requests = parse_home(middleware, spider, start_request)
+    assert district_requests
+    checkpoint(middleware)
+    middleware._spider_closed(spider, "shutdown")
+
+    middleware, spider = create_middleware(tmp_path)
+    resumed = list(middleware.process_start_requests(spider.start_requests(), spider))
+    assert sorted(request.url for request in resumed) == sorted(
+        request.url for request in district_requests
+    )
+    assert resumed[0].callback == spider._parse_disctrict_first_page
+    # the home page is done, yielding it again is dropped
+    assert list(middleware._record_requests(spider.start_requests(), spider)) == []
+
+
+def test_parsed_requests_wait_for_checkpoint(tmp_path):
+    middleware, spider = create_middleware(tmp_path)
+    [start_request] = middleware.process_start_requests(spider.start_requests(), spider)
+    parse_home(middleware, spider, start_request)
+    frontier = middleware._frontier
+    assert frontier.count(SqliteFrontier.PARSED) == 1
+    assert frontier.count(SqliteFrontier.DONE) == 0
+    checkpoint(middleware)
+    assert frontier.count(SqliteFrontier.DONE) == 1
+
+
+def test_requests_lost_by_a_finished_crawl_do_not_hold_the_job(tmp_path):
+    middleware, spider = create_middleware(tmp_path, job=None)
+    # the start request never reached its callback, e.g. a download error
+    [start_request] = middleware.process_start_requests(spider.start_requests(), spider)
+    middleware._spider_closed(spider, "finished")
+    assert spider.crawler.stats.get_value("frontier/failed") == 1
+    # the next crawl is a new job starting from the start requests
+    middleware, spider = create_middleware(tmp_path, job=None)
+    assert middleware._frontier.count(SqliteFrontier.FAILED) == 0
+    assert [
+        request.url
+        for request in middleware.process_start_requests(spider.start_requests(), spider)
+    ] == [start_request.url]
+    assert "frontier/resumed" not in spider.crawler.stats.get_stats()
+
+
+def test_failed_requests_are_not_resumed(tmp_path):
+    middleware, spider = create_middleware(tmp_path)
+    [start_request] = middleware.process_start_requests(spider.start_requests(), spider)
+    district_requests = parse_home(middleware, spider, start_request)
+    checkpoint(middleware)
+    # a 404 district page, HttpErrorMiddleware raises before the callback
+    failed = district_requests[0]
+    response = HtmlResponse(failed.url, status=404, body=b"", request=failed)
+    assert middleware.process_spider_exception(response, HttpError(response), spider) is None
+    middleware._spider_closed(spider, "shutdown")
+
+    middleware, spider = create_middleware(tmp_path)
+    resumed = list(middleware.process_start_requests(spider.start_requests(), spider))
+    assert sorted(request.url for request in resumed) == sorted(
+        request.url for request in district_requests[1:]
+    )
+    assert middleware._frontier.count(SqliteFrontier.FAILED) == 1
+
+
+def test_finished_job_is_cleared(tmp_path):
+    middleware, spider = create_middleware(tmp_path, job=None)
+    [start_request] = middleware.process_start_requests(spider.start_requests(), spider)
+    response = HtmlResponse(start_request.url, body=b"", request=start_request)
+    assert list(middleware.process_spider_output(response, [], spider)) == []
+    middleware._spider_closed(spider, "finished")
+    middleware, spider = create_middleware(tmp_path, job=None)
+    assert middleware._frontier.count(SqliteFrontier.DONE) == 0
+    [start_request] = middleware.process_start_requests(spider.start_requests(), spider)
+    assert "frontier/resumed" not in spider.crawler.stats.get_stats()
+
+
+def test_restart_resumes_the_newest_unfinished_job(tmp_path):
+    middleware, spider = create_middleware(tmp_path, job=None)
+    job = middleware._job
+    assert job.startswith("lianjia-")
+    [start_request] = middleware.process_start_requests(spider.start_requests(), spider)
+    middleware._spider_closed(spider, "shutdown")
+    # restarted on whatever day, it is the same job
+    middleware, spider = create_middleware(tmp_path, job=None)
+    assert middleware._job == job
+    assert [request.url for request in middleware.process_start_requests([], spider)] == [
+        start_request.url
+    ]
+
+
+def crawl_fake_lianjia(frontier_path, *args) -> dict:
+    completed = subprocess.run(
+        [sys.executable, "-m", "tests.fake_lianjia", "--api", "--frontier", str(frontier_path)]
+        + list(args),
+        capture_output=True,
+        check=True,
+        cwd=pathlib.Path(__file__).parent.parent,
+        timeout=120,
+    )
+    return json.loads(completed.stdout.decode().strip().splitlines()[-1])
+
+
+def test_interrupted_crawl_resumes_in_a_real_crawler(tmp_path):
+    frontier_path = tmp_path / "frontier.sqlite"
+    first = crawl_fake_lianjia(frontier_path, "--max-pages", "5")
+    assert first["finish_reason"] == "closespider_pagecount"
+    assert first["resumed"] == 0 and first["for_sale_ids"]
+
+    second = crawl_fake_lianjia(frontier_path)
+    assert second["finish_reason"] == "finished" and second["resumed"] > 0
+    # the xiaoqu list pages were parsed by the first run, the second one starts below them
+    assert "/house/community/search" not in second["requests"]
+    assert not set(first["for_sale_ids"]) & set(second["for_sale_ids"])
+    communities = api_entries("api_community", "community_id", 40)
+    on_sale = [entry for entry in communities if entry["sell_num"]]
+    # as many listings as one uninterrupted crawl, see test_api_crawl_against_fake_lianjia
+    houses = set(first["for_sale_ids"]) | set(second["for_sale_ids"])
+    assert len(houses) == (len(on_sale) - 1) * 75 + 30
+    with sqlite3.connect(frontier_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM frontier").fetchone() == (0,)
@@ -0,0 +1,120 @@
+"""Tests of the xiaoqu locations and the nearest-xiaoqu queries."""
+
+import math
+import random
+from unittest import mock
+
+import mongomock
+import pytest
+
+from dragon_talon import geo, items
+
+from .mongo_crawl import crawl, index_keys
+
+
+def _haversine_m(lon1, lat1, lon2, lat2) -> float:
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(
+        (lon2 - lon1) / 2
+    ) ** 2
+    return 2 * geo.EARTH_RADIUS_M * math.asin(math.sqrt(h))
+
+
+def test_location_normalizes_the_page_coordinates():
+    point = {"type": "Point", "coordinates": [121.562411, 31.226381]}
+    assert geo.location(121.562411, 31.226381) == point
+    assert geo.location(31.226381, 121.562411) == point
+    assert geo.location(None, 31.226381) is None
+    assert geo.location(0, 0) is None
+    assert geo.location(200.0, 31.2) is None
+
+
+@pytest.mark.parametrize("layout", ["document", "bucket"])
+def test_pipeline_stores_indexed_locations(scraped_items, layout):
+    database = crawl(
+        mongomock.MongoClient(tz_aware=True), scraped_items, MONGO_STORAGE_LAYOUT=layout
+    )
+    collection = database.get_collection(items.XiaoquInfo.item_name)
+    assert (("location",), False) in index_keys(collection)
+    ((info_key, index_type),) = [
+        info["key"][0]
+        for info in collection.index_information().values()
+        if info["key"][0][0] == "location"
+    ]
+    assert index_type == "2dsphere"
+    (doc,) = collection.find()
+    assert doc["location"] == {"type": "Point", "coordinates": [121.562411, 31.226381]}
+
+    stats = next(
+        item
+        for item in scraped_items
+        if isinstance(item, items.XiaoquDailyStats) and item.xiaoqu_id == doc["xiaoqu_id"]
+    )
+    snapshot = geo.XiaoquSnapshot.load(database, bucketed=layout == "bucket")
+    (nearby,) = snapshot.within_radius(121.5624, 31.2264, radius_m=500)
+    assert nearby.xiaoqu_id == doc["xiaoqu_id"] and nearby.distance_m < 5
+    assert nearby.price.ask_avg_price == stats.ask_avg_price
+    assert nearby.price.date_ == stats.date_
+    assert snapshot.within_radius(121.60, 31.2264, radius_m=2000) == []
+
+
+def test_nearest_joins_the_latest_price():
+    database = mongomock.MongoClient(tz_aware=True).get_database("geo")
+    stats = database.get_collection(items.XiaoquDailyStats.item_name)
+    for day, price in [(1, 60000), (3, 62000), (2, 61000)]:
+        stats.insert_one({"xiaoqu_id": "1", "date_": day, "ask_avg_price": price})
+    near = {
+        "xiaoqu_id": "1",
+        "name": "联洋花园",
+        "location": {"type": "Point", "coordinates": [121.56, 31.22]},
+        "distance_m": 120.0,
+    }
+    far = dict(near, xiaoqu_id="2", distance_m=800.0)
+    # mongomock has no $geoNear
+    xiaoqu_info = mock.Mock()
+    xiaoqu_info.aggregate.return_value = [near, far]
+    with mock.patch.object(
+        database,
+        "get_collection",
+        side_effect=lambda name: xiaoqu_info if name == items.XiaoquInfo.item_name else stats,
+    ):
+        found = geo.nearest(database, 121.56, 31.22, k=2)
+    ((pipeline,), _) = xiaoqu_info.aggregate.call_args
+    assert pipeline[0]["$geoNear"]["near"]["coordinates"] == [121.56, 31.22]
+    assert pipeline[1] == {"$limit": 2}
+    assert [(nearby.xiaoqu_id, nearby.distance_m) for nearby in found] == [
+        ("1", 120.0),
+        ("2", 800.0),
+    ]
+    assert found[0].price == geo.LatestPrice(3, 62000) and found[1].price is None
+
+
+def test_snapshot_matches_brute_force():
+    rng = random.Random(7)
+    docs = [
+        {
+            "xiaoqu_id": str(i),
+            "name": f"xiaoqu {i}",
+            "location": geo.location(rng.uniform(121.2, 121.8), rng.uniform(30.9, 31.5)),
+        }
+        for i in range(3000)
+    ]
+    snapshot = geo.XiaoquSnapshot(docs)
+    assert len(snapshot) == len(docs)
+    for _ in range(50):
+        lon, lat = rng.uniform(121.2, 121.8), rng.uniform(30.9, 31.5)
+        distances = sorted(
+            (_haversine_m(lon, lat, *doc["location"]["coordinates"]), doc["xiaoqu_id"])
+            for doc in docs
+        )
+        nearest = snapshot.nearest(lon, lat, k=5)
+        assert [nearby.xiaoqu_id for nearby in nearest] == [
+            xiaoqu_id for _, xiaoqu_id in distances[:5]
+        ]
+        assert [nearby.distance_m for nearby in nearest] == pytest.approx(
+            [distance for distance, _ in distances[:5]]
+        )
+        within = snapshot.within_radius(lon, lat, 2000)
+        assert [nearby.xiaoqu_id for nearby in within] == [
+            xiaoqu_id for distance, xiaoqu_id in distances if distance <= 2000
+        ]
@@ -0,0 +1,178 @@
+"""Tests of the sqlite http cache storage."""
+
+import time
+from unittest import mock
+
+import pytest
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.http import HtmlResponse, Request, Response
+from scrapy.settings import Settings
+
+from dragon_talon import httpcache
+
+from .replay import create_spider, load_fixture_pages, load_httpcache_pages
+
+
+XIAOQU_URL = "https://sh.lianjia.com/xiaoqu/1/"
+
+
+def _storage(cache_dir, **settings) -> httpcache.SqliteCacheStorage:
+    return httpcache.SqliteCacheStorage(
+        Settings({"HTTPCACHE_DIR": str(cache_dir), "HTTPCACHE_EXPIRATION_SECS": 0, **settings})
+    )
+
+
+@pytest.fixture
+def spider():
+    return create_spider()
+
+
+def _store_fixture_pages(storage, spider):
+    pages = load_fixture_pages()
+    storage.open_spider(spider)
+    for page in pages:
+        storage.store_response(spider, Request(page.response.url), page.response)
+    storage.close_spider(spider)
+    return pages
+
+
+def test_round_trip(tmp_path, spider):
+    pages = _store_fixture_pages(_storage(tmp_path), spider)
+    storage = _storage(tmp_path)
+    storage.open_spider(spider)
+    for page in pages:
+        request = Request(page.response.url)
+        cached = storage.retrieve_response(spider, request)
+        assert isinstance(cached, HtmlResponse)
+        assert cached.body == page.response.body
+        assert cached.headers == page.response.headers
+        assert "cache_timestamp" in request.meta
+    assert storage.retrieve_response(spider, Request("https://sh.lianjia.com/nowhere/")) is None
+    storage.close_spider(spider)
+    # replays read the cache like the filesystem one
+    assert [page.callback for page in load_httpcache_pages(str(tmp_path))] == [
+        page.callback for page in pages
+    ]
+
+
+def test_expired_responses_are_evicted_on_open(tmp_path, spider):
+    pages = _store_fixture_pages(_storage(tmp_path), spider)
+    url = pages[0].response.url
+    storage = _storage(tmp_path, HTTPCACHE_EXPIRATION_SECS=60)
+    storage.open_spider(spider)
+    assert storage.retrieve_response(spider, Request(url)) is not None
+    later = time.time() + 61
+    with mock.patch.object(httpcache.time, "time", return_value=later):
+        assert storage.retrieve_response(spider, Request(url)) is None
+    storage.close_spider(spider)
+
+    with mock.patch.object(httpcache.time, "time", return_value=later):
+        storage.open_spider(spider)
+    count = storage._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    storage.close_spider(spider)
+    assert count == 0
+
+
+def test_zlib_entries_stay_readable(tmp_path, spider):
+    with mock.patch.object(httpcache, "zstandard", None):
+        pages = _store_fixture_pages(_storage(tmp_path), spider)
+    storage = _storage(tmp_path)
+    storage.open_spider(spider)
+    cached = storage.retrieve_response(spider, Request(pages[0].response.url))
+    storage.close_spider(spider)
+    assert cached.body == pages[0].response.body
+
+
+def _policy(**settings) -> httpcache.PageTypeCachePolicy:
+    return httpcache.PageTypeCachePolicy(
+        Settings(
+            {
+                "HTTPCACHE_DEFAULT_TTL_SECS": 60,
+                "HTTPCACHE_CALLBACK_TTLS": {
+                    "_parse_district_page": httpcache.TTL_DAILY,
+                    "_parse_xiaoqu": 3600,
+                },
+                **settings,
+            }
+        )
+    )
+
+
+def _cached_request(callback, age_secs: float, url="https://sh.lianjia.com/xiaoqu/1/", **meta):
+    meta["cache_timestamp"] = time.time() - age_secs
+    return Request(url, callback=callback, meta=meta)
+
+
+def test_ttl_per_callback_and_url(spider):
+    policy = _policy(HTTPCACHE_URL_TTLS={r"/xiaoqu/\d+/$": 10})
+    cached = Response("https://sh.lianjia.com/")
+    assert not policy.is_cached_response_fresh(cached, _cached_request(spider._parse_xiaoqu, 20))
+    assert policy.is_cached_response_fresh(
+        cached, _cached_request(spider._parse_xiaoqu, 20, url="https://sh.lianjia.com/xiaoqu/1")
+    )
+    policy = _policy()
+    assert policy.is_cached_response_fresh(cached, _cached_request(spider._parse_xiaoqu, 3000))
+    assert not policy.is_cached_response_fresh(cached, _cached_request(spider._parse_xiaoqu, 4000))
+    assert not policy.is_cached_response_fresh(cached, _cached_request(spider.parse, 61))
+    assert policy.is_cached_response_fresh(
+        cached, _cached_request(spider.parse, 600, cache_ttl=3600)
+    )
+
+    today = time.time()
+    yesterday = today - 24 * 3600
+    for stored_at, fresh in [(today, True), (yesterday, False)]:
+        request = Request("https://sh.lianjia.com/xiaoqu/pudong/pg2/")
+        request = request.replace(
+            callback=spider._parse_district_page, meta={"cache_timestamp": stored_at}
+        )
+        assert policy.is_cached_response_fresh(cached, request) is fresh
+
+
+def test_refresh_and_prefer_override_ttl(spider):
+    policy = _policy()
+    cached = Response("https://sh.lianjia.com/")
+    must_refresh = _cached_request(spider._parse_xiaoqu, 0, cache_policy=httpcache.CACHE_REFRESH)
+    assert not policy.is_cached_response_fresh(cached, must_refresh)
+    preferred = _cached_request(spider.parse, 10 ** 6, cache_policy=httpcache.CACHE_PREFER)
+    assert policy.is_cached_response_fresh(cached, preferred)
+
+    # stale entries stand in for server errors, except for requests to refresh
+    stale = _cached_request(spider._parse_xiaoqu, 4000)
+    error = Response("https://sh.lianjia.com/", status=503)
+    assert policy.is_cached_response_valid(cached, error, stale)
+    assert not policy.is_cached_response_valid(cached, Response("https://sh.lianjia.com/"), stale)
+    assert not policy.is_cached_response_valid(cached, error, must_refresh)
+
+
+@pytest.mark.parametrize(
+    "response, meta",
+    [
+        (Response(XIAOQU_URL, status=302, headers={"Location": "/captcha?x=1"}), {}),
+        (Response(XIAOQU_URL, status=301, headers={"Location": "/xiaoqu/2/"}), {}),
+        (Response(XIAOQU_URL, status=403), {}),
+        (HtmlResponse(XIAOQU_URL, body=b"<html></html>"), {"throttle_expect_marker": "xiaoqu"}),
+    ],
+)
+# the spider argument is deprecated in recent scrapy versions, required by older ones
+@pytest.mark.filterwarnings("ignore::scrapy.exceptions.ScrapyDeprecationWarning")
+def test_blocked_responses_are_not_cached(tmp_path, response, meta):
+    spider = create_spider(
+        {
+            "HTTPCACHE_ENABLED": True,
+            "HTTPCACHE_DIR": str(tmp_path),
+            "HTTPCACHE_STORAGE": "dragon_talon.httpcache.SqliteCacheStorage",
+            "HTTPCACHE_POLICY": "dragon_talon.httpcache.PageTypeCachePolicy",
+        }
+    )
+    middleware = HttpCacheMiddleware.from_crawler(spider.crawler)
+    middleware.spider_opened(spider)
+    request = Request(XIAOQU_URL, callback=spider._parse_xiaoqu, meta=meta)
+    assert middleware.process_request(request, spider) is None
+    middleware.process_response(request, response.replace(request=request), spider)
+    # the throttle's retry goes to the network
+    retry = request.replace(dont_filter=True)
+    assert middleware.process_request(retry, spider) is None
+    page = HtmlResponse(XIAOQU_URL, body=b"<html>xiaoqu</html>", request=retry)
+    middleware.process_response(retry, page, spider)
+    assert middleware.process_request(request.copy(), spider).body == page.body
+    middleware.spider_closed(spider)
@@ -0,0 +1,102 @@
+"""Tests of the lianjia spider's crawl modes."""
+
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import mongomock
+import pytest
+import scrapy
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.test import get_crawler
+
+from dragon_talon import db, items
+from dragon_talon.httpcache import CACHE_REFRESH
+from dragon_talon.spiders.lianjia import LianjiaSpider
+
+from .replay import load_fixture_pages, replay
+
+
+def _spider(**kwargs) -> LianjiaSpider:
+    crawler = get_crawler(LianjiaSpider)
+    crawler.spider = LianjiaSpider.from_crawler(crawler, **kwargs)
+    return crawler.spider
+
+
+def _district_outputs(spider) -> list:
+    district_page = load_fixture_pages()[1]
+    assert district_page.callback == "_parse_disctrict_first_page"
+    (result,) = replay(spider, [district_page])
+    return result.outputs
+
+
+def _requests(outputs: list, callback_name: str) -> dict:
+    """xiaoqu id -> the request of that callback"""
+    return {
+        output.cb_kwargs["xiaoqu_id"]: output
+        for output in outputs
+        if isinstance(output, scrapy.Request) and output.callback.__name__ == callback_name
+    }
+
+
+def test_incremental_mode_skips_fresh_xiaoqu_but_not_their_listings():
+    full_crawl = _district_outputs(_spider())
+    on_sale_ids = [
+        output.xiaoqu_id
+        for output in full_crawl
+        if isinstance(output, items.XiaoquDailyStats) and output.on_sale_count > 0
+    ]
+    fresh_id, stale_id = on_sale_ids[:2]
+    # without the incremental mode, a listed xiaoqu is reached through its detail page
+    assert {fresh_id, stale_id} <= set(_requests(full_crawl, "_parse_xiaoqu"))
+    assert not _requests(full_crawl, "_parse_ershoufang")
+
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    now = datetime.now(timezone.utc)
+    mongo_cli.get_database(db.DB_NAME).get_collection(items.XiaoquInfo.item_name).insert_many(
+        [
+            {"xiaoqu_id": fresh_id, "crawled_at": now - timedelta(days=2)},
+            {"xiaoqu_id": stale_id, "crawled_at": now - timedelta(days=8)},
+        ]
+    )
+    spider = _spider(incremental="1", refresh_days="7")
+    with mock.patch.object(db, "get_mongo_client", return_value=mongo_cli):
+        spider._spider_opened(spider)
+    assert spider._fresh_xiaoqu_ids == {fresh_id}
+
+    outputs = _district_outputs(spider)
+    details = _requests(outputs, "_parse_xiaoqu")
+    assert fresh_id not in details
+    # the stale detail page is downloaded again, not served from the cache
+    assert details[stale_id].meta["cache_policy"] == CACHE_REFRESH
+    # the listings of the skipped xiaoqu are still crawled
+    listings = _requests(outputs, "_parse_ershoufang")
+    assert list(listings) == [fresh_id]
+    assert listings[fresh_id].cb_kwargs["xiaoqu_name"]
+    assert spider.crawler.stats.get_value("lianjia/xiaoqu_detail_skipped") == 1
+    # the daily stats of every xiaoqu are still collected
+    assert [output for output in outputs if isinstance(output, items.XiaoquDailyStats)] == [
+        output for output in full_crawl if isinstance(output, items.XiaoquDailyStats)
+    ]
+
+
+def test_several_cities_in_one_crawl():
+    spider = _spider(cities="bj,sh")
+    start_requests = list(spider.start_requests())
+    assert [urlparse_cached(request).hostname for request in start_requests] == [
+        "bj.lianjia.com",
+        "sh.lianjia.com",
+    ]
+    # the pages of a city stay on its subdomain, whose downloader slot keeps its own pace
+    home_page = load_fixture_pages()[0]
+    for start_request in start_requests:
+        response = home_page.response.replace(url=start_request.url, request=start_request)
+        district_requests = list(spider._parse_home(response))
+        assert district_requests
+        assert {urlparse_cached(request).hostname for request in district_requests} == {
+            urlparse_cached(start_request).hostname
+        }
+    assert [request.url for request in _spider().start_requests()] == [
+        "https://sh.lianjia.com/xiaoqu/su1y4bp5ep10000"
+    ]
+    with pytest.raises(AssertionError):
+        _spider(cities="bj,xx")
@@ -0,0 +1,119 @@
+"""Tests for the JSON fetch mode of the lianjia spider."""
+
+import json
+import pathlib
+import subprocess
+import sys
+
+import pytest
+from scrapy.http import Request, TextResponse
+
+from dragon_talon import signals
+from dragon_talon.spiders.lianjia import _api
+
+from .fake_lianjia import api_entries
+from .replay import REPLAY_DATE, ReplayPage, create_spider, replay
+from .selector_parser import SelectorParser
+from .test_lianjia_parsers import FIXTURE_DIR, load_selector
+
+API_SETTINGS = {"LIANJIA_FETCH_MODE": "api", "LIANJIA_API_URL": "https://app.api.lianjia.com"}
+
+
+def load_api_page(fixture: str) -> _api.ApiPage:
+    return _api.parse_page((FIXTURE_DIR / f"{fixture}.json").read_bytes())
+
+
+def test_api_communities_match_the_district_page():
+    entries = _api.parse_communities(
+        load_api_page("api_community"), "https://sh.lianjia.com", REPLAY_DATE
+    )
+    expected = SelectorParser.parse_district_page(load_selector("district"), REPLAY_DATE)
+    assert entries == expected
+
+
+def test_api_listings_match_the_ershoufang_page():
+    args = (REPLAY_DATE, "5011000010000", "联洋花园")
+    for_sales = _api.parse_ershoufang(load_api_page("api_ershoufang"), *args)
+    assert for_sales == SelectorParser.parse_ershoufang(load_selector("ershoufang"), *args)
+
+
+@pytest.mark.parametrize(
+    "body", [b"<html>busy</html>", b'{"errno": 20001, "error": "system busy", "data": null}']
+)
+def test_failing_endpoint_falls_back_to_html(body):
+    spider = create_spider(API_SETTINGS)
+    html_url = "https://sh.lianjia.com/ershoufang/c5011000010000/"
+    request = spider._api_request(
+        html_url, offset=0, xiaoqu_id="5011000010000", xiaoqu_name="联洋花园"
+    )
+    assert "condition=c5011000010000" in request.url and "limit=100" in request.url
+    response = TextResponse(request.url, body=body, request=request)
+    [result] = replay(spider, [ReplayPage("_parse_api_ershoufang", response, request.cb_kwargs)])
+    [fallback] = result.outputs
+    assert isinstance(fallback, Request)
+    assert fallback.url == html_url and fallback.callback == spider._parse_ershoufang
+    assert fallback.cb_kwargs == {"xiaoqu_id": "5011000010000", "xiaoqu_name": "联洋花园"}
+    assert spider.crawler.stats.get_value("lianjia/api_fallback") == 1
+
+
+def test_xiaoqu_is_listed_once_every_page_is_parsed():
+    spider = create_spider(API_SETTINGS)
+    listed = []
+
+    def listings_complete(xiaoqu_id, spider):
+        listed.append(xiaoqu_id)
+
+    spider.crawler.signals.connect(listings_complete, signal=signals.listings_complete)
+    page = json.loads((FIXTURE_DIR / "api_ershoufang.json").read_bytes())
+    page["data"]["total_count"] = 150
+    html_url = "https://sh.lianjia.com/ershoufang/c5011000010000/"
+
+    def replay_offset(offset):
+        request = spider._api_request(
+            html_url, offset=offset, xiaoqu_id="5011000010000", xiaoqu_name="联洋花园"
+        )
+        response = TextResponse(request.url, body=json.dumps(page).encode(), request=request)
+        replay(spider, [ReplayPage("_parse_api_ershoufang", response, request.cb_kwargs)])
+
+    replay_offset(0)
+    assert listed == []
+    replay_offset(100)
+    replay_offset(100)
+    assert listed == ["5011000010000"]
+
+
+def test_html_mode_does_not_use_the_endpoints():
+    spider = create_spider()
+    assert spider._api_request("https://sh.lianjia.com/ershoufang/c1/", offset=0) is None
+
+
+def test_api_crawl_against_fake_lianjia():
+    # a district and its listings from the recorded JSON, served by a local stand-in
+    completed = subprocess.run(
+        [sys.executable, "-m", "tests.fake_lianjia", "--api", "--page-size", "25"],
+        capture_output=True,
+        check=True,
+        cwd=pathlib.Path(__file__).parent.parent,
+        timeout=120,
+    )
+    summary = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+    communities = api_entries("api_community", "community_id", 40)
+    on_sale = [entry for entry in communities if entry["sell_num"]]
+    # 40 communities in pages of 25, 75 listings of each xiaoqu on sale in pages of 25,
+    # but the 3 desktop pages of the one with a failing endpoint
+    assert summary["requests"] == {
+        "/house/community/search": 2,
+        "/house/ershoufang/search": (len(on_sale) - 1) * 3 + 1,
+        "ershoufang_html": 3,
+    }
+    assert summary["xiaoqu_daily_stats"] == sum(
+        entry["avg_unit_price"] is not None for entry in communities
+    )
+    assert summary["for_sale_xiaoqu"] == len(on_sale)
+    assert summary["for_sale_houses"] == (len(on_sale) - 1) * 75 + 30
+    assert summary["failing_xiaoqu_houses"] == 30
+    assert summary["api_fallback"] == 1
+    listings = summary["requests"]["/house/ershoufang/search"] * 25
+    html_listings = summary["requests"]["ershoufang_html"] * 30
+    api_bytes = summary["bytes"]["/house/ershoufang/search"] / listings
+    assert api_bytes * 3 < summary["bytes"]["ershoufang_html"] / html_listings
@@ -0,0 +1,38 @@
+"""Tests for the compiled lianjia parsers against recorded page fixtures."""
+
+import pathlib
+
+import parsel
+import pytest
+
+from dragon_talon.spiders.lianjia._parsers import CompiledParser, crawl_date
+
+from .selector_parser import SelectorParser
+
+FIXTURE_DIR = pathlib.Path(__file__).parent / "fixtures" / "lianjia"
+DATE_ = crawl_date()
+PARSE_CASES = [
+    ("home", "parse_home", ()),
+    ("district", "parse_district_page", (DATE_,)),
+    ("xiaoqu", "parse_xiaoqu", ()),
+    ("ershoufang", "parse_ershoufang", (DATE_, "5011000010000", "联洋花园")),
+    ("chengjiao", "parse_chengjiao", ("5011000010000", "联洋花园")),
+]
+
+
+def load_selector(page: str) -> parsel.Selector:
+    return parsel.Selector(text=(FIXTURE_DIR / f"{page}.html").read_text(encoding="utf-8"))
+
+
+@pytest.mark.parametrize("page,method,args", PARSE_CASES)
+def test_compiled_parser_matches_selector_parser(page, method, args):
+    selector = load_selector(page)
+    expected = getattr(SelectorParser, method)(selector, *args)
+    assert expected
+    assert getattr(CompiledParser, method)(selector, *args) == expected
+
+
+@pytest.mark.parametrize("page", ["home", "district", "xiaoqu", "ershoufang", "chengjiao"])
+def test_compiled_page_box_matches_selector_page_box(page):
+    selector = load_selector(page)
+    assert CompiledParser.parse_page_box(selector) == SelectorParser.parse_page_box(selector)
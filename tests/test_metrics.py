@@ -0,0 +1,144 @@
+"""Tests of the CrawlMetrics extension and its reporters."""
+
+import asyncio
+from collections import Counter
+from unittest import mock
+
+import mongomock
+import pytest
+import scrapy
+from twisted.web.test.requesthelper import DummyRequest
+
+from dragon_talon import db, items, metrics
+from dragon_talon.pipelines import MongoPipeline
+from dragon_talon.spiders.lianjia._parsers import CompiledParser, crawl_date
+
+from .replay import create_spider, load_fixture_pages
+from .selector_parser import SelectorParser
+
+METRICS_SETTINGS = {
+    "EXTENSIONS": {"dragon_talon.metrics.CrawlMetrics": 500},
+    "METRICS_ENABLED": True,
+    "METRICS_PORT": 0,
+}
+
+
+@pytest.fixture
+def spider():
+    return create_spider(METRICS_SETTINGS)
+
+
+def _replay_timed(spider, middleware) -> list:
+    outputs = []
+    for page in load_fixture_pages():
+        callback = getattr(spider, page.callback)
+        response = page.response.replace(request=scrapy.Request(page.response.url, callback))
+        result = callback(response, **page.cb_kwargs)
+        outputs.extend(middleware.process_spider_output(response, result, spider))
+    return outputs
+
+
+def test_disabled_by_default():
+    settings = dict(METRICS_SETTINGS, METRICS_ENABLED=False)
+    assert metrics.get_metrics(create_spider(settings).crawler) is None
+
+
+def test_parse_timing_and_prometheus_page(spider):
+    crawler = spider.crawler
+    crawl_metrics = metrics.get_metrics(crawler)
+    outputs = _replay_timed(spider, metrics.ParseTimingMiddleware.from_crawler(crawler))
+    for item in outputs:
+        if isinstance(item, items._Document):
+            crawl_metrics._item_scraped(item, None, spider)
+
+    for page in load_fixture_pages():
+        histogram = crawl_metrics.histogram("parse_seconds", callback=page.callback)
+        assert histogram.count == 1 and histogram.sum > 0
+
+    request = DummyRequest([b"metrics"])
+    page = metrics._MetricsResource(crawl_metrics).render_GET(request).decode()
+    assert request.responseHeaders.getRawHeaders(b"Content-Type")[0].startswith(b"text/plain")
+    assert 'dragon_talon_parse_seconds_count{callback="_parse_xiaoqu"} 1' in page
+    assert 'dragon_talon_parse_seconds_bucket{callback="_parse_xiaoqu",le="+Inf"} 1' in page
+    num_for_sale = sum(isinstance(item, items.ForSale) for item in outputs)
+    assert f'dragon_talon_items_total{{type="for_sale"}} {num_for_sale}' in page
+
+    summary = crawl_metrics.summary()
+    assert any(line.startswith("  parse_seconds _parse_xiaoqu: n=1") for line in summary)
+    assert crawler.stats.get_value("metrics/items_per_sec/for_sale") > 0
+
+
+def test_parse_timing_of_async_and_pool_callbacks(spider):
+    crawl_metrics = metrics.get_metrics(spider.crawler)
+    middleware = metrics.ParseTimingMiddleware.from_crawler(spider.crawler)
+
+    async def _parse_async(response):
+        await asyncio.sleep(0.01)
+        yield {"url": response.url}
+
+    async def _parse_in_pool(response):
+        return [{"url": response.url}]
+
+    async def collect(result):
+        return [output async for output in result]
+
+    request = scrapy.Request("https://sh.lianjia.com/a", _parse_async)
+    response = scrapy.http.Response(request.url, request=request)
+    outputs = asyncio.run(
+        collect(middleware.process_spider_output_async(response, _parse_async(response), spider))
+    )
+    assert outputs == [{"url": request.url}]
+    assert crawl_metrics.histogram("parse_seconds", callback="_parse_async").sum >= 0.01
+
+    # the coroutine has run already, it reports its own time
+    request = scrapy.Request("https://sh.lianjia.com/b", _parse_in_pool)
+    response = scrapy.http.Response(request.url, request=request)
+    result = asyncio.run(_parse_in_pool(response))
+    response.meta["parse_seconds"] = 0.5
+    assert list(middleware.process_spider_output(response, result, spider)) == result
+    assert crawl_metrics.histogram("parse_seconds", callback="_parse_in_pool").sum == 0.5
+
+
+def test_download_latency_per_subdomain(spider):
+    crawl_metrics = metrics.get_metrics(spider.crawler)
+    for url, latency in [("https://sh.lianjia.com/a", 0.2), ("https://bj.lianjia.com/b", 0.4)]:
+        request = scrapy.Request(url, meta={"download_latency": latency})
+        crawl_metrics._response_received(scrapy.http.Response(url), request, spider)
+    cached = scrapy.Request("https://sh.lianjia.com/c", meta={"download_latency": 9})
+    crawl_metrics._response_received(
+        scrapy.http.Response(cached.url, flags=["cached"]), cached, spider
+    )
+    assert crawl_metrics.histogram("download_latency_seconds", host="sh.lianjia.com").max == 0.2
+    assert crawl_metrics.histogram("download_latency_seconds", host="bj.lianjia.com").max == 0.4
+
+
+@pytest.mark.parametrize("parser", [SelectorParser, CompiledParser])
+def test_dropped_listings_are_counted(parser):
+    response = load_fixture_pages()[4].response
+    assert response.url.endswith("/ershoufang/c5011000010000/")
+    marker = b'<ul class="sellListContent" log-mod="list">'
+    advert = b'<li><div class="info clear"><div class="title"><a href="/ad/"></a></div></div></li>'
+    response = response.replace(body=response.body.replace(marker, marker + advert))
+    dropped = Counter()
+    for_sales = parser.parse_ershoufang(response.selector, crawl_date(), "1", "x", dropped)
+    assert len(for_sales) == 30
+    assert dropped == {"ershoufang": 1}
+
+
+def test_mongo_pipeline_reports_queue_and_writes(spider):
+    crawl_metrics = metrics.get_metrics(spider.crawler)
+    with mock.patch.object(db, "get_mongo_client", return_value=mongomock.MongoClient()):
+        pipeline = MongoPipeline.from_crawler(spider.crawler)
+    outputs = [
+        output
+        for page in load_fixture_pages()
+        for output in getattr(spider, page.callback)(page.response, **page.cb_kwargs)
+        if isinstance(output, items.ForSale)
+    ]
+    for item in outputs:
+        pipeline.process_item(item, spider)
+    assert crawl_metrics._gauges["pipeline_pending_items"][()] == len(outputs)
+
+    pipeline._write_batch(items.ForSale.item_name, [item.to_document() for item in outputs])
+    histogram = crawl_metrics.histogram("mongo_write_seconds", collection=items.ForSale.item_name)
+    assert histogram.count == 1
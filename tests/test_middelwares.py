@@ -0,0 +1,335 @@
+"""Tests for the downloader middlewares."""
+
+import json
+import pathlib
+import pickle
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import HtmlResponse, Request, Response
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+from dragon_talon.middelwares import (
+    AccountPoolMiddleware,
+    AdaptiveThrottleMiddleware,
+    ProxySessionPoolMiddleware,
+    _Account,
+)
+
+SLOT_KEY = "sh.lianjia.com"
+
+
+@pytest.fixture
+def throttle():
+    crawler = get_crawler(
+        settings_dict={
+            "ADAPTIVE_THROTTLE_ENABLED": True,
+            "DOWNLOAD_DELAY": 5,
+            "CONCURRENT_REQUESTS_PER_DOMAIN": 1,
+            "ADAPTIVE_THROTTLE_RAMP_INTERVAL": 5,
+        }
+    )
+    slot = SimpleNamespace(concurrency=1, delay=5)
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(slots={SLOT_KEY: slot}))
+    return AdaptiveThrottleMiddleware.from_crawler(crawler), slot
+
+
+def fetch(middleware, response, latency=0.2, **meta):
+    meta.update(download_slot=SLOT_KEY, download_latency=latency)
+    request = Request(response.url, meta=meta)
+    return middleware.process_response(request, response, None)
+
+
+def listing_page():
+    return HtmlResponse(
+        f"https://{SLOT_KEY}/xiaoqu/pudong/", body=b"<li class='clear xiaoquListItem'></li>"
+    )
+
+
+def test_ramps_up_while_responses_are_healthy(throttle):
+    middleware, slot = throttle
+    for _ in range(40):
+        assert isinstance(fetch(middleware, listing_page()), HtmlResponse)
+    assert slot.delay == pytest.approx(1.0)
+    assert slot.concurrency == 4
+
+
+CAPTCHA_REDIRECT = Response(
+    f"https://{SLOT_KEY}/x", status=302, headers={"Location": "https://hip.lianjia.com/captcha"}
+)
+EMPTY_LISTING = HtmlResponse(f"https://{SLOT_KEY}/x", body=b"<ul></ul>")
+
+
+@pytest.mark.parametrize(
+    "response,meta",
+    [
+        (CAPTCHA_REDIRECT, {}),
+        (Response(f"https://{SLOT_KEY}/x", status=429), {}),
+        (EMPTY_LISTING, {"throttle_expect_marker": "xiaoquListItem"}),
+    ],
+)
+def test_backs_off_and_retries_when_blocked(throttle, response, meta):
+    middleware, slot = throttle
+    for _ in range(10):
+        fetch(middleware, listing_page())
+    assert slot.concurrency > 1
+    retry_request = fetch(middleware, response, **meta)
+    assert isinstance(retry_request, Request)
+    assert retry_request.meta["throttle_retry_times"] == 1 and retry_request.meta["dont_cache"]
+    assert slot.concurrency == 1
+    assert slot.delay > 5
+
+
+def test_gives_up_after_max_retries(throttle):
+    middleware, slot = throttle
+    blocked = Response(f"https://{SLOT_KEY}/x", status=403)
+    assert fetch(middleware, blocked, throttle_retry_times=3) is blocked
+    assert slot.delay == pytest.approx(20.0)
+
+
+def test_ignores_cached_responses(throttle):
+    middleware, slot = throttle
+    response = listing_page()
+    response.flags.append("cached")
+    fetch(middleware, response)
+    assert slot.delay == 5
+
+
+@pytest.fixture
+def pool():
+    crawler = get_crawler(
+        settings_dict={
+            "PROXY_POOL": ["http://127.0.0.1:8001", "http://127.0.0.1:8002", "direct"],
+            "PROXY_POOL_USER_AGENTS": ["agent-a", "agent-b"],
+            "PROXY_POOL_QUARANTINE_SECS": 60,
+        }
+    )
+    return ProxySessionPoolMiddleware.from_crawler(crawler)
+
+
+def send(middleware, url=f"https://{SLOT_KEY}/xiaoqu/pudong/", **meta):
+    request = Request(url, meta=meta)
+    middleware.process_request(request, None)
+    return request
+
+
+def test_pool_spreads_requests_over_sessions(pool):
+    requests = [send(pool) for _ in range(6)]
+    assert {request.meta["proxy"] for request in requests} == {
+        "http://127.0.0.1:8001",
+        "http://127.0.0.1:8002",
+        None,
+    }
+    # every session is its own slot, with its own cookies and User-Agent
+    assert len({request.meta["download_slot"] for request in requests}) == 3
+    assert len({request.meta["cookiejar"] for request in requests}) == 3
+    assert {request.headers["User-Agent"] for request in requests} == {b"agent-a", b"agent-b"}
+
+
+def test_pool_quarantines_blocked_session(pool):
+    request = send(pool)
+    blocked_session = request.meta["proxy_session"]
+    blocked_jar = request.meta["cookiejar"]
+    pool.process_response(request, CAPTCHA_REDIRECT, None)
+
+    retry = send(pool, **request.meta)
+    assert retry.meta["proxy_session"] != blocked_session
+    assert all(send(pool).meta["proxy_session"] != blocked_session for _ in range(6))
+    session = pool._sessions[blocked_session]
+    assert session.strikes == 1 and session.failures == 1
+    assert session.cookiejar != blocked_jar
+
+
+def test_pool_counts_each_failure_once(pool):
+    failing = Response(f"https://{SLOT_KEY}/x", status=503)
+    request = send(pool)
+    session = pool._sessions[request.meta["proxy_session"]]
+    # PROXY_POOL_MAX_FAILURES in a row quarantine the session
+    for _ in range(3):
+        pool.process_response(request, failing, None)
+        request = send(pool, proxy_session=session.name)
+    assert session.strikes == 1 and session.failures == 3
+    assert request.meta["proxy_session"] != session.name
+
+
+def test_pool_prefers_fast_reliable_sessions(pool):
+    fast, slow, failing = [send(pool) for _ in range(3)]
+    for request, latency, response in (
+        (fast, 0.2, listing_page()),
+        (slow, 3.0, listing_page()),
+        (failing, 0.2, Response(f"https://{SLOT_KEY}/x", status=503)),
+    ):
+        request.meta["download_latency"] = latency
+        pool.process_response(request, response, None)
+    assert send(pool).meta["proxy_session"] == fast.meta["proxy_session"]
+    # until it has enough requests in flight
+    assert send(pool).meta["proxy_session"] != fast.meta["proxy_session"]
+
+
+def test_pool_against_fake_proxies():
+    # a real crawl through local proxies, one of them answering with captcha redirects
+    completed = subprocess.run(
+        [sys.executable, "-m", "tests.fake_proxy", "--pages", "20"],
+        capture_output=True,
+        check=True,
+        cwd=pathlib.Path(__file__).parent.parent,
+        timeout=120,
+    )
+    summary = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+    assert len(summary["scraped_urls"]) == 20
+    assert summary["scraped_sessions"] == ["session0", "session1"]
+    assert summary["quarantined"] >= 1
+    assert summary["proxy_requests"]["good1"] > 0 and summary["proxy_requests"]["good2"] > 0
+    assert summary["proxy_user_agents"]["good1"] != summary["proxy_user_agents"]["good2"]
+
+
+@pytest.fixture
+def account_pool(tmp_path):
+    accounts_file = tmp_path / "accounts.txt"
+    accounts_file.write_text("# test accounts\nalice:pw-a\n\nbob:pw-b\n")
+    crawler = get_crawler(
+        settings_dict={
+            "LIANJIA_ACCOUNTS_FILE": str(accounts_file),
+            "LIANJIA_LOGIN_URL": f"https://{SLOT_KEY}/login/",
+            "LIANJIA_ACCOUNT_DELAY": 10,
+        }
+    )
+    return AccountPoolMiddleware.from_crawler(crawler)
+
+
+CHENGJIAO_URL = f"https://{SLOT_KEY}/chengjiao/c5011000010000/"
+LOGIN_REDIRECT = Response(CHENGJIAO_URL, status=302, headers={"Location": "/login/?redirect=1"})
+
+
+def test_account_pool_logs_in_before_the_first_request(account_pool):
+    request = Request(CHENGJIAO_URL, meta={"login_required": True})
+    login = account_pool.process_request(request, None)
+    assert login.url == f"https://{SLOT_KEY}/login/"
+    assert login.meta["cookiejar"] == request.meta["cookiejar"] == "account:alice"
+    assert b"username=alice" in login.body
+    # the next request goes to bob, the one after waits for alice's login
+    other = Request(CHENGJIAO_URL, meta={"login_required": True})
+    assert account_pool.process_request(other, None).meta["account"] == "bob"
+    waiting = Request(CHENGJIAO_URL, meta={"login_required": True})
+    waiter = account_pool.process_request(waiting, None)
+    assert waiting.meta["account"] == "alice"
+    assert isinstance(waiter, defer.Deferred) and not waiter.called
+
+    assert account_pool.process_request(login, None) is None
+    retried = account_pool.process_response(login, Response(login.url, status=200), None)
+    assert retried.url == CHENGJIAO_URL and retried.dont_filter
+    # leased by a DistributedScheduler, the shared queue would drop it as a duplicate
+    assert retried.meta["distributed_local"]
+    assert waiter.called
+    # alice's next request slot went to the waiting request
+    throttled = account_pool.process_request(retried, None)
+    assert isinstance(throttled, defer.Deferred) and not throttled.called
+    throttled.addErrback(lambda failure: None)
+    throttled.cancel()
+
+
+def test_account_pool_logs_in_again_after_the_session_expired(account_pool):
+    request = Request(CHENGJIAO_URL, meta={"login_required": True})
+    login = account_pool.process_request(request, None)
+    account_pool.process_response(login, Response(login.url, status=200), None)
+
+    retry = account_pool.process_response(request, LOGIN_REDIRECT, None)
+    assert retry.meta["account_relogins"] == 1 and retry.meta["distributed_local"]
+    assert account_pool.process_request(retry, None).url.endswith("/login/")
+    retry.meta["account_relogins"] = 2
+    with pytest.raises(IgnoreRequest):
+        account_pool.process_response(retry, LOGIN_REDIRECT, None)
+
+
+def test_account_pool_drops_refused_accounts(account_pool):
+    logins = [
+        account_pool.process_request(Request(CHENGJIAO_URL, meta={"login_required": True}), None)
+        for _ in range(2)
+    ]
+    for login in logins:
+        account_pool.process_response(login, Response(login.url, status=401), None)
+    with pytest.raises(IgnoreRequest):
+        account_pool.process_request(Request(CHENGJIAO_URL, meta={"login_required": True}), None)
+
+
+@pytest.mark.parametrize(
+    "login_cookie, response, logged_in",
+    [
+        (None, Response("https://x/login/", status=302, headers={"Location": "/"}), True),
+        (None, Response("https://x/login/", status=302, headers={"Location": "/login/?e=1"}), False),
+        ("lianjia_token", Response("https://x/login/", status=200), False),
+        (
+            "lianjia_token",
+            Response(
+                "https://x/login/",
+                status=302,
+                headers={"Location": "/", "Set-Cookie": "lianjia_token=t1; Path=/"},
+            ),
+            True,
+        ),
+    ],
+)
+def test_account_pool_login_outcome(account_pool, login_cookie, response, logged_in):
+    account_pool._login_cookie = login_cookie
+    request = Request(CHENGJIAO_URL, meta={"login_required": True})
+    login = account_pool.process_request(request, None)
+    # only a token travels with the login, which stays out of a shared request queue
+    assert isinstance(login.meta["account_login_for"], str)
+    assert login.meta["distributed_local"]
+    pickle.dumps(login.meta)
+    retried = account_pool.process_response(login, response.replace(url=login.url), None)
+    assert retried.url == CHENGJIAO_URL
+    assert account_pool._accounts["alice"].state == (
+        _Account.LOGGED_IN if logged_in else _Account.FAILED
+    )
+    assert account_pool._token2request == {}
+
+
+def test_account_pool_against_fake_lianjia():
+    # a real crawl through logged-in sessions, of the chengjiao pages not stored yet
+    completed = subprocess.run(
+        [sys.executable, "-m", "tests.fake_lianjia", "--delay", "0.3"],
+        capture_output=True,
+        check=True,
+        cwd=pathlib.Path(__file__).parent.parent,
+        timeout=120,
+    )
+    summary = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+    assert summary["transactions"] == {"1001": 45, "1002": 13, "1003": 1}
+    assert summary["pages_served"] == [
+        "/chengjiao/c1001/",
+        "/chengjiao/c1002/",
+        "/chengjiao/c1003/",
+        "/chengjiao/pg2c1001/",
+        "/chengjiao/pg2c1002/",
+        "/chengjiao/pg3c1001/",
+        "/chengjiao/pg4c1001/",
+        "/chengjiao/pg5c1001/",
+    ]
+    assert summary["pages_skipped"] == 5
+    assert summary["login_failed"] == 1
+    # sessions expire after 3 pages: the accounts logged in again
+    assert summary["logins"].count("alice") >= 2 and summary["logins"].count("bob") >= 2
+    assert all(count > 0 for count in summary["requests_per_account"].values())
+    assert all(interval > 0.2 for interval in summary["min_interval"].values())
+
+
+def test_account_pool_through_a_distributed_scheduler():
+    # resumed and retried requests are leased already, they must not reach the shared queue
+    completed = subprocess.run(
+        [sys.executable, "-m", "tests.fake_lianjia", "--delay", "0.3", "--distributed"],
+        capture_output=True,
+        check=True,
+        cwd=pathlib.Path(__file__).parent.parent,
+        timeout=120,
+    )
+    summary = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+    assert summary["transactions"] == {"1001": 45, "1002": 13, "1003": 1}
+    assert len(summary["pages_served"]) == 8
+    assert summary["duplicates"] == 0
+    # 8 pages and sessions of 3 pages for 2 accounts: at least one session expired
+    assert len(summary["logins"]) >= 4
@@ -0,0 +1,111 @@
+"""Round trip of ParquetPipeline through pyarrow."""
+
+import dataclasses
+import pathlib
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from twisted.internet import defer
+
+from dragon_talon import items
+from dragon_talon.pipelines import ParquetPipeline, arrow_schema
+
+from .replay import REPLAY_DATE, create_spider
+
+pyarrow = pytest.importorskip("pyarrow")
+pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+
+
+def _export(tmp_path, scraped_items, **kwargs):
+    spider = create_spider()
+    stats = spider.crawler.stats
+    pipeline = ParquetPipeline(stats, str(tmp_path), **kwargs)
+    # write on the calling thread, there is no running reactor here
+    with mock.patch(
+        "dragon_talon.pipelines.threads.deferToThread", side_effect=defer.maybeDeferred
+    ):
+        for item in scraped_items:
+            pipeline.process_item(item, spider)
+        pipeline.close_spider(spider)
+    return stats
+
+
+def _partitions(tmp_path, item_cls) -> dict:
+    item_dir = pathlib.Path(tmp_path) / item_cls.item_name
+    return {
+        partition.name: sorted(partition.iterdir()) for partition in sorted(item_dir.iterdir())
+    }
+
+
+def test_items_round_trip_per_crawl_date(tmp_path, scraped_items):
+    for_sales = [item for item in scraped_items if isinstance(item, items.ForSale)]
+    # the crawl went on past midnight
+    next_day = [
+        dataclasses.replace(item, date_=item.date_ + timedelta(days=1)) for item in for_sales[:5]
+    ]
+    # every 10 rows a row group, every row group a new file
+    stats = _export(tmp_path, scraped_items + next_day, batch_size=10, max_file_mb=0)
+
+    partitions = _partitions(tmp_path, items.ForSale)
+    assert list(partitions) == ["crawl_date=2021-01-18", "crawl_date=2021-01-19"]
+    files = partitions["crawl_date=2021-01-18"]
+    assert len(files) == -(-len(for_sales) // 10)
+    assert all(path.suffix == ".parquet" for paths in partitions.values() for path in paths)
+    tables = [pyarrow_parquet.read_table(path) for path in files]
+    assert all(table.schema.equals(arrow_schema(items.ForSale)) for table in tables)
+    rows = pyarrow.concat_tables(tables).to_pylist()
+    assert len(rows) == len(for_sales)
+    assert sorted(row["house_id"] for row in rows) == sorted(item.house_id for item in for_sales)
+    first = next(item for item in for_sales if item.house_id == rows[0]["house_id"])
+    assert rows[0] == dataclasses.asdict(first)
+    assert rows[0]["date_"] == REPLAY_DATE
+    (next_day_file,) = partitions["crawl_date=2021-01-19"]
+    assert pyarrow_parquet.read_metadata(next_day_file).num_rows == 5
+    assert stats.get_value("parquet/for_sale/rows") == len(for_sales) + 5
+
+    # the deal date of a transaction is not its crawl date
+    transactions = [item for item in scraped_items if isinstance(item, items.Transaction)]
+    ((_, files),) = _partitions(tmp_path, items.Transaction).items()
+    assert sum(pyarrow_parquet.read_metadata(path).num_rows for path in files) == len(
+        transactions
+    )
+
+
+def test_files_are_renamed_once_closed(tmp_path, scraped_items):
+    stats = create_spider().crawler.stats
+    pipeline = ParquetPipeline(stats, str(tmp_path), batch_size=5)
+    daily_stats = [item for item in scraped_items if isinstance(item, items.XiaoquDailyStats)]
+    with mock.patch(
+        "dragon_talon.pipelines.threads.deferToThread", side_effect=defer.maybeDeferred
+    ):
+        for item in daily_stats[:5]:
+            pipeline.process_item(item, None)
+        # a row group written, the file still open
+        ((_, (path,)),) = _partitions(tmp_path, items.XiaoquDailyStats).items()
+        assert path.name.endswith(".parquet.tmp")
+        pipeline.close_spider(None)
+    ((_, (path,)),) = _partitions(tmp_path, items.XiaoquDailyStats).items()
+    assert path.suffix == ".parquet"
+    assert pyarrow_parquet.read_table(path).num_rows == 5
+
+
+def test_heartbeats_are_exported(tmp_path, scraped_items):
+    heartbeats = [
+        items.ListingHeartbeat(
+            house_id=item.house_id,
+            date_=item.date_,
+            xiaoqu_id=item.xiaoqu_id,
+            num_of_followers=item.num_of_followers,
+            ask_duration_days=item.ask_duration_days,
+        )
+        for item in scraped_items
+        if isinstance(item, items.ForSale)
+    ]
+    stats = _export(tmp_path, heartbeats)
+    ((partition, (path,)),) = _partitions(tmp_path, items.ListingHeartbeat).items()
+    assert partition == "crawl_date=2021-01-18"
+    assert pyarrow_parquet.read_table(path).to_pylist() == [
+        dataclasses.asdict(item) for item in heartbeats
+    ]
+    assert stats.get_value("parquet/for_sale_heartbeat/rows") == len(heartbeats)
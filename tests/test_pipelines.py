@@ -0,0 +1,243 @@
+"""Tests of the Mongo pipelines, AsyncMongoPipeline's run on a plain asyncio loop."""
+
+import asyncio
+import dataclasses
+from typing import Optional
+from unittest import mock
+
+import mongomock
+import pytest
+from twisted.internet import defer, reactor, task
+
+from dragon_talon import db, items, queries
+from dragon_talon.pipelines import AsyncMongoPipeline, MongoPipeline
+
+from .replay import create_spider
+
+
+def _mongo_pipeline(mongo_cli, **settings):
+    spider = create_spider({"MONGO_BATCH_SIZE": 10, **settings})
+    with mock.patch.object(db, "get_mongo_client", return_value=mongo_cli):
+        return spider, MongoPipeline.from_crawler(spider.crawler)
+
+
+def _on_calling_thread():
+    # there is no running reactor here
+    return mock.patch(
+        "dragon_talon.pipelines.threads.deferToThread", side_effect=defer.maybeDeferred
+    )
+
+
+def test_upserts_filter_on_their_own_unique_indexes(scraped_items):
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    spider, pipeline = _mongo_pipeline(mongo_cli, MONGO_WRITE_MODE="upsert")
+    database = mongo_cli.get_database(db.DB_NAME)
+    # built before the first write, each on the collection of its item
+    for item_cls in (items.ForSale, items.Transaction, items.XiaoquDailyStats, items.XiaoquInfo):
+        keys = {
+            (tuple(field for field, _ in info["key"]), info.get("unique", False))
+            for info in database.get_collection(item_cls.item_name).index_information().values()
+        }
+        assert keys == {(("_id",), False), (tuple(item_cls.natural_key), True)}
+
+    for_sales = [item for item in scraped_items if isinstance(item, items.ForSale)]
+    with _on_calling_thread():
+        for item in for_sales:
+            pipeline.process_item(item, spider)
+        pipeline.flush_all()
+        # the same day crawled again, with corrected prices
+        for item in for_sales:
+            pipeline.process_item(dataclasses.replace(item, ask_total_w=item.ask_total_w + 1), spider)
+        pipeline.close_spider(spider)
+    collection = database.get_collection(items.ForSale.item_name)
+    assert collection.count_documents({}) == len(for_sales)
+    first = for_sales[0]
+    document = collection.find_one({"date_": first.date_, "house_id": first.house_id})
+    assert document["ask_total_w"] == first.ask_total_w + 1
+
+
+class _Writes:
+    """deferToThread stand-in whose calls run when the test finishes them"""
+
+    def __init__(self):
+        self.pending = []
+
+    def __call__(self, func, *args, **kwargs):
+        dfd = defer.Deferred()
+        self.pending.append((dfd, func, args, kwargs))
+        return dfd
+
+    def batch_sizes(self) -> list:
+        # MongoPipeline._start_write: deferToThread(self._write_batch, colname, docs)
+        return [len(args[1]) for _, _, args, _ in self.pending]
+
+    def finish(self, count: Optional[int] = None):
+        count = len(self.pending) if count is None else count
+        pending, self.pending = self.pending[:count], self.pending[count:]
+        for dfd, func, args, kwargs in pending:
+            dfd.callback(func(*args, **kwargs))
+
+
+def _for_sales(scraped_items, count: int) -> list:
+    for_sales = [item for item in scraped_items if isinstance(item, items.ForSale)]
+    assert len(for_sales) >= count
+    return for_sales[:count]
+
+
+def test_batches_flush_on_size_and_on_time(scraped_items):
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    spider, pipeline = _mongo_pipeline(mongo_cli, MONGO_FLUSH_INTERVAL_MS=500)
+    clock = task.Clock()
+    writes = _Writes()
+    with mock.patch("dragon_talon.pipelines.threads.deferToThread", writes), mock.patch.object(
+        reactor, "callLater", clock.callLater
+    ):
+        for item in _for_sales(scraped_items, 15):
+            assert pipeline.process_item(item, spider) is item
+        # a full batch goes out at once, the rest waits for the flush interval
+        assert writes.batch_sizes() == [10]
+        clock.advance(0.4)
+        assert writes.batch_sizes() == [10]
+        clock.advance(0.1)
+        assert writes.batch_sizes() == [10, 5]
+        writes.finish()
+    collection = mongo_cli.get_database(db.DB_NAME).get_collection(items.ForSale.item_name)
+    assert collection.count_documents({}) == 15
+    assert spider.crawler.stats.get_value("mongo/for_sale/flush_count") == 2
+    assert not clock.getDelayedCalls()
+
+
+def test_backpressure_holds_items_until_a_flush(scraped_items):
+    spider, pipeline = _mongo_pipeline(
+        mongomock.MongoClient(tz_aware=True), MONGO_BATCH_SIZE=5, MONGO_MAX_PENDING_ITEMS=8
+    )
+    writes = _Writes()
+    for_sales = _for_sales(scraped_items, 10)
+    with mock.patch("dragon_talon.pipelines.threads.deferToThread", writes):
+        results = [pipeline.process_item(item, spider) for item in for_sales]
+        # 8 items pending from the 8th on, buffered or being written
+        assert results[:7] == for_sales[:7]
+        waiters = results[7:]
+        assert all(isinstance(waiter, defer.Deferred) and not waiter.called for waiter in waiters)
+        assert spider.crawler.stats.get_value("mongo/backpressure_waits") == 3
+        # the first batch is written, 5 items are left pending
+        writes.finish(1)
+    assert [waiter.result for waiter in waiters] == for_sales[7:]
+
+
+def test_close_drains_buffered_and_inflight_writes(scraped_items):
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    spider, pipeline = _mongo_pipeline(mongo_cli, MONGO_BATCH_SIZE=5)
+    writes = _Writes()
+    with mock.patch("dragon_talon.pipelines.threads.deferToThread", writes):
+        for item in _for_sales(scraped_items, 7):
+            pipeline.process_item(item, spider)
+        assert writes.batch_sizes() == [5]
+        closed = pipeline.close_spider(spider)
+        # the 2 buffered items are flushed, the crawl is recorded once both writes are done
+        assert writes.batch_sizes() == [5, 2]
+        writes.finish(1)
+        assert not closed.called
+        writes.finish()
+        writes.finish()
+    assert closed.called
+    database = mongo_cli.get_database(db.DB_NAME)
+    assert database.get_collection(items.ForSale.item_name).count_documents({}) == 7
+    assert database.get_collection(queries.CRAWL_LOG).count_documents({}) == 1
+    assert not pipeline._inflight
+
+
+def test_writes_done_at_once_leave_nothing_in_flight(scraped_items):
+    spider, pipeline = _mongo_pipeline(mongomock.MongoClient(tz_aware=True))
+    with _on_calling_thread():
+        for item in _for_sales(scraped_items, 10):
+            pipeline.process_item(item, spider)
+        assert not pipeline._inflight
+        assert pipeline.close_spider(spider).called
+
+
+class _ConcurrencyProbe:
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+
+class _AsyncCollection:
+    """Motor-like coroutine API over a mongomock collection"""
+
+    def __init__(self, collection, probe: _ConcurrencyProbe):
+        self._collection = collection
+        self._probe = probe
+        self.name = collection.name
+
+    async def _call(self, method: str, *args, **kwargs):
+        self._probe.current += 1
+        self._probe.peak = max(self._probe.peak, self._probe.current)
+        try:
+            # yield so that the other pending writes get a chance to start
+            await asyncio.sleep(0.01)
+            return getattr(self._collection, method)(*args, **kwargs)
+        finally:
+            self._probe.current -= 1
+
+    async def bulk_write(self, requests, **kwargs):
+        return await self._call("bulk_write", requests, **kwargs)
+
+    async def insert_many(self, documents, **kwargs):
+        return await self._call("insert_many", documents, **kwargs)
+
+
+class _AsyncDatabase:
+    def __init__(self, database, probe: _ConcurrencyProbe):
+        self._database = database
+        self._probe = probe
+
+    def get_collection(self, name: str) -> _AsyncCollection:
+        return _AsyncCollection(self._database.get_collection(name), self._probe)
+
+
+@pytest.mark.parametrize("write_mode", ["upsert", "insert"])
+def test_async_pipeline_bounds_inflight_writes(scraped_items, write_mode):
+    pytest.importorskip("motor")
+    spider = create_spider(
+        {"MONGO_BATCH_SIZE": 10, "MONGO_MAX_INFLIGHT_WRITES": 2, "MONGO_WRITE_MODE": write_mode}
+    )
+    mongo_cli = mongomock.MongoClient()
+    probe = _ConcurrencyProbe()
+    motor_cli = mock.Mock()
+    motor_cli.get_database.return_value = _AsyncDatabase(mongo_cli.get_database(db.DB_NAME), probe)
+
+    async def write_all():
+        with mock.patch.object(db, "get_mongo_client", return_value=mongo_cli), mock.patch.object(
+            db, "get_motor_client", return_value=motor_cli
+        ):
+            pipeline = AsyncMongoPipeline.from_crawler(spider.crawler)
+        writes = [
+            pipeline._write_batch_async(colname, docs)
+            for colname, docs in _batches(pipeline, scraped_items, 10)
+        ]
+        await asyncio.gather(*writes)
+
+    asyncio.run(write_all())
+
+    assert probe.peak == 2
+    assert spider.crawler.stats.get_value("mongo/inflight_writes_max") == 2
+    db_inst = mongo_cli.get_database(db.DB_NAME)
+    for item_cls in (items.XiaoquInfo, items.XiaoquDailyStats, items.ForSale, items.Transaction):
+        natural_keys = {
+            tuple(getattr(item, field) for field in item_cls.natural_key)
+            for item in scraped_items
+            if isinstance(item, item_cls)
+        }
+        assert db_inst.get_collection(item_cls.item_name).count_documents({}) == len(natural_keys)
+
+
+def _batches(pipeline, scraped_items, batch_size: int):
+    colname2docs = {}
+    for item in scraped_items:
+        pipeline._col2cls[item.item_name] = type(item)
+        colname2docs.setdefault(item.item_name, []).append(item.to_document())
+    for colname, docs in colname2docs.items():
+        for start in range(0, len(docs), batch_size):
+            end = start + batch_size
+            yield colname, docs[start:end]
@@ -0,0 +1,88 @@
+"""Tests of the declared indexes and the daily price rollups of MongoPipeline."""
+
+import statistics
+
+import mongomock
+import pytest
+
+from dragon_talon import db, items, rollups
+
+from .mongo_crawl import crawl, index_keys
+
+
+def test_indexes_follow_item_declarations(scraped_items):
+    database = crawl(mongomock.MongoClient(tz_aware=True), scraped_items)
+    for item_cls in (items.Transaction, items.ForSale, items.XiaoquDailyStats):
+        keys = index_keys(database.get_collection(item_cls.item_name))
+        assert (tuple(item_cls.natural_key), True) in keys
+        assert (("xiaoqu_id", "date_"), False) in keys
+
+
+@pytest.mark.parametrize("write_mode", ["upsert", "insert"])
+def test_collections_with_duplicates_fall_back_to_upserts(scraped_items, write_mode):
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    collection = mongo_cli.get_database(db.DB_NAME).get_collection(items.ForSale.item_name)
+    for_sale = [item for item in scraped_items if isinstance(item, items.ForSale)]
+    # written twice before the unique index was declared
+    collection.insert_many([item.to_document() for item in for_sale[:2] + for_sale[:1]])
+    crawl(mongo_cli, scraped_items, times=2, MONGO_WRITE_MODE=write_mode)
+    assert (tuple(items.ForSale.natural_key), True) not in index_keys(collection)
+    assert collection.count_documents({}) == len(for_sale) + 1
+
+
+def test_no_rollups_with_change_detection(scraped_items, tmp_path):
+    database = crawl(
+        mongomock.MongoClient(tz_aware=True),
+        scraped_items,
+        MONGO_PRICE_ROLLUPS=True,
+        CHANGE_DETECTION_INDEX_PATH=str(tmp_path / "listing_index.sqlite"),
+        ITEM_PIPELINES={"dragon_talon.pipelines.ChangeDetectionPipeline": 250},
+    )
+    assert database.get_collection(rollups.COLLECTION).count_documents({}) == 0
+
+
+def test_bucket_indexes_skip_the_bucket_key(scraped_items):
+    database = crawl(
+        mongomock.MongoClient(tz_aware=True), scraped_items, MONGO_STORAGE_LAYOUT="bucket"
+    )
+    assert index_keys(database.get_collection("for_sale_monthly")) == {
+        (("_id",), False),
+        (("house_id", "month"), True),
+        (("xiaoqu_id", "month"), False),
+    }
+    assert index_keys(database.get_collection("xiaoqu_daily_stats_monthly")) == {
+        (("_id",), False),
+        (("xiaoqu_id", "month"), True),
+    }
+
+
+@pytest.mark.parametrize("write_mode", ["upsert", "insert"])
+def test_rollups_count_each_listing_once(scraped_items, write_mode):
+    # every item twice, as a re-crawl of the day would
+    database = crawl(
+        mongomock.MongoClient(tz_aware=True),
+        scraped_items,
+        times=2,
+        MONGO_PRICE_ROLLUPS=True,
+        MONGO_WRITE_MODE=write_mode,
+    )
+    collection = database.get_collection(rollups.COLLECTION)
+    (xiaoqu_info,) = [item for item in scraped_items if isinstance(item, items.XiaoquInfo)]
+    prices = [item.ask_avg_price for item in scraped_items if isinstance(item, items.ForSale)]
+    for level, key in [
+        (rollups.XIAOQU, xiaoqu_info.xiaoqu_id),
+        (rollups.AREA, rollups.area_key(xiaoqu_info.district, xiaoqu_info.area)),
+        (rollups.DISTRICT, xiaoqu_info.district),
+    ]:
+        (day,) = rollups.price_trend(collection, level, key)
+        assert day["count"] == len(prices)
+        assert day["mean"] == pytest.approx(statistics.mean(prices))
+        assert abs(day["median"] - statistics.median(prices)) <= 500
+        # finalized when the spider closed
+        stored = collection.find_one({"level": level, "key": key})
+        assert stored["median"] == day["median"]
+
+
+def test_median_interpolates_within_bucket():
+    assert rollups.median({"1000": 1, "2000": 2, "3000": 1}, 4, 1000) == 2500
+    assert rollups.median({}, 0, 500) is None
@@ -0,0 +1,173 @@
+"""Tests of the read-side query service, rendered without a reactor."""
+
+import json
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import mongomock
+import pytest
+from twisted.internet import defer
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyRequest
+
+from dragon_talon import db, items, queries, rollups
+from dragon_talon.web import QueryService, ResultCache
+
+from .mongo_crawl import crawl
+
+_TZ = timezone(timedelta(hours=8))
+
+
+def _service(database, bucketed: bool = False, **kwargs) -> QueryService:
+    return QueryService(database, ResultCache(64, 300), bucketed=bucketed, **kwargs)
+
+
+def _get(service: QueryService, path: str, **args) -> DummyRequest:
+    request = DummyRequest([segment.encode() for segment in path.strip("/").split("/")])
+    for name, value in args.items():
+        request.addArg(name.encode(), str(value).encode())
+    with mock.patch("dragon_talon.web.threads.deferToThread", side_effect=defer.maybeDeferred):
+        assert service.render(request) == server.NOT_DONE_YET
+    assert request.finished
+    return request
+
+
+def _json(request: DummyRequest):
+    return json.loads(b"".join(request.written))
+
+
+def _pages(service: QueryService, path: str, **args) -> list:
+    pages = []
+    cursor = None
+    while True:
+        page = _json(_get(service, path, **args, **({"cursor": cursor} if cursor else {})))
+        pages.append(page["items"])
+        cursor = page["next"]
+        if cursor is None:
+            return pages
+
+
+def test_result_cache_evicts_least_recent_and_expired():
+    now = [0.0]
+    cache = ResultCache(2, ttl=10, clock=lambda: now[0])
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.put("c", b"3")
+    assert cache.get("b") is None and cache.get("a") == b"1"
+    now[0] = 10
+    assert cache.get("a") is None and cache.get("c") is None
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_price_series_pages_by_cursor():
+    database = mongomock.MongoClient(tz_aware=True).get_database(db.DB_NAME)
+    collection = database.get_collection(rollups.COLLECTION)
+    for day in range(1, 6):
+        doc = {
+            "level": rollups.DISTRICT,
+            "key": "浦东",
+            "date_": datetime(2021, 1, day, tzinfo=_TZ),
+            "count": 2,
+            "sum": 120000 + day * 1000,
+            "hist": {"60000": 2},
+        }
+        # the last day is still being crawled
+        if day < 5:
+            doc.update(mean=doc["sum"] / 2, median=60000.0 + day)
+        collection.insert_one(doc)
+    service = _service(database)
+    pages = _pages(service, "/prices/district", key="浦东", since="2021-01-02", limit=2)
+    assert [[day["date_"][:10] for day in page] for page in pages] == [
+        ["2021-01-02", "2021-01-03"],
+        ["2021-01-04", "2021-01-05"],
+    ]
+    assert [day["median"] for page in pages for day in page] == [60002, 60003, 60004, 60250]
+    assert pages[1][1]["mean"] == 62500
+
+    unknown = _get(service, "/prices/city", key="上海")
+    assert unknown.responseCode == 404
+    bad_cursor = _get(service, "/prices/district", key="浦东", cursor="nope")
+    assert bad_cursor.responseCode == 400 and "cursor" in _json(bad_cursor)["error"]
+    assert _get(service, "/prices/district", key="浦东", limit=5000).responseCode == 400
+
+
+@pytest.mark.parametrize("layout", ["document", "bucket"])
+def test_xiaoqu_detail_and_listings(scraped_items, layout):
+    database = crawl(
+        mongomock.MongoClient(tz_aware=True), scraped_items, MONGO_STORAGE_LAYOUT=layout
+    )
+    service = _service(database, bucketed=layout == "bucket", stream_batch=7)
+    (info,) = [item for item in scraped_items if isinstance(item, items.XiaoquInfo)]
+    detail = _json(_get(service, f"/xiaoqu/{info.xiaoqu_id}"))
+    assert detail["name"] == info.name and "north_latitude" not in detail
+    assert detail["location"]["coordinates"] == [121.562411, 31.226381]
+    assert detail["price"]["ask_avg_price"] == 60000
+    assert _get(service, "/xiaoqu/404").responseCode == 404
+
+    for_sales = sorted(
+        (item for item in scraped_items if isinstance(item, items.ForSale)),
+        key=lambda item: item.house_id,
+    )
+    pages = _pages(service, f"/xiaoqu/{info.xiaoqu_id}/listings", limit=10)
+    assert [len(page) for page in pages] == [10, 10, 10]
+    listings = [listing for page in pages for listing in page]
+    assert [listing["house_id"] for listing in listings] == [item.house_id for item in for_sales]
+    assert listings[0]["ask_total_w"] == for_sales[0].ask_total_w
+    assert datetime.fromisoformat(listings[0]["date_"]) == for_sales[0].date_
+    assert "xiaoqu_name" not in listings[0]
+
+
+def test_cache_is_dropped_after_a_crawl(scraped_items):
+    mongo_cli = mongomock.MongoClient(tz_aware=True)
+    database = crawl(mongo_cli, scraped_items)
+    assert queries.last_crawl(database) is not None
+    service = _service(database, crawl_poll_seconds=0)
+    (info,) = [item for item in scraped_items if isinstance(item, items.XiaoquInfo)]
+    path = f"/xiaoqu/{info.xiaoqu_id}/listings"
+    first = _get(service, path, limit=5)
+    second = _get(service, path, limit=5)
+    assert first.responseHeaders.getRawHeaders(b"x-cache") == [b"miss"]
+    assert second.responseHeaders.getRawHeaders(b"x-cache") == [b"hit"]
+    assert second.written == [b"".join(first.written)]
+
+    crawl(mongo_cli, scraped_items)
+    assert database.get_collection(queries.CRAWL_LOG).count_documents({}) == 2
+    third = _get(service, path, limit=5)
+    assert third.responseHeaders.getRawHeaders(b"x-cache") == [b"miss"]
+    assert _json(third) == _json(first)
+
+
+def test_listings_of_unchanged_listings_come_from_their_heartbeats(scraped_items):
+    database = crawl(mongomock.MongoClient(tz_aware=True), scraped_items)
+    (info,) = [item for item in scraped_items if isinstance(item, items.XiaoquInfo)]
+    changed, delisted, *unchanged = sorted(
+        (item for item in scraped_items if isinstance(item, items.ForSale)),
+        key=lambda item: item.house_id,
+    )
+    # the next crawl stored the changed listing and heartbeats of the unchanged ones
+    next_day = changed.date_ + timedelta(days=1)
+    database.get_collection(items.ForSale.item_name).insert_one(
+        dict(changed.to_document(), date_=next_day, ask_total_w=changed.ask_total_w - 10)
+    )
+    database.get_collection(items.ListingHeartbeat.item_name).insert_many(
+        [
+            items.ListingHeartbeat(
+                house_id=item.house_id,
+                date_=next_day,
+                xiaoqu_id=item.xiaoqu_id,
+                num_of_followers=item.num_of_followers + 1,
+                ask_duration_days=item.ask_duration_days + 1,
+            ).to_document()
+            for item in unchanged
+        ]
+    )
+    pages = _pages(_service(database), f"/xiaoqu/{info.xiaoqu_id}/listings", limit=10)
+    listings = [listing for page in pages for listing in page]
+    assert [listing["house_id"] for listing in listings] == [
+        item.house_id for item in [changed] + unchanged
+    ]
+    assert all(datetime.fromisoformat(listing["date_"]) == next_day for listing in listings)
+    assert listings[0]["ask_total_w"] == changed.ask_total_w - 10
+    assert listings[1]["num_of_followers"] == unchanged[0].num_of_followers + 1
+    assert listings[1]["description"] == unchanged[0].description